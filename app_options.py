@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+# settings used when an app does not name them
+DEFAULT_SERVICETYPE = "HTTP"
+DEFAULT_LBMETHOD = "ROUNDROBIN"
+DEFAULT_MONITOR_TYPE = "HTTP"
+
+# attributes the NetScaler does not change on an existing resource
+IMMUTABLE = frozenset(['servicetype', 'type'])
+
+
+def monitor_name(grpname):
+    """Name of the lbmonitor Nitrox manages for a service group"""
+    return "%s-monitor" % grpname
+
+
+def _normalise(value):
+    """NITRO returns numbers as strings, some enums in another case and
+    list attributes (e.g., respcode) as lists of unicode strings"""
+    if isinstance(value, (list, tuple)):
+        return [_normalise(v) for v in value]
+    return (u'%s' % value).lower()
+
+
+def _same(current, desired):
+    if current is None:
+        return desired is None
+    current, desired = _normalise(current), _normalise(desired)
+    # a single value may be configured for a list attribute
+    if isinstance(current, list) and not isinstance(desired, list):
+        desired = [desired]
+    return current == desired
+
+
+class AppOptions(object):
+    """NetScaler settings of one lbvserver/service group pair, from the
+    app's entry in APP_INFO:
+
+    '{"name": "api", "lbmethod": "LEASTCONNECTION", "servicetype": "TCP",
+      "lbvserver": {"cltimeout": 360},
+      "servicegroup": {"cka": "YES", "sp": "ON", "maxclient": 1000},
+      "monitor": {"type": "HTTP", "url": "/healthz", "interval": 2,
+                  "retries": 2, "downtime": 5}}'
+
+    `lbvserver` and `servicegroup` hold NITRO attributes of the resources,
+    `monitor` those of an lbmonitor bound to the service group; its `url`
+    is the path the monitor requests. A named port of the app may
+    override any of them. Only the settings that are named are
+    reconciled; the others are left as they are.
+    """
+
+    def __init__(self, lbmethod=None, servicetype=None, lbvserver=None,
+                 servicegroup=None, monitor=None):
+        self.lbmethod = lbmethod
+        self.servicetype = servicetype
+        self.lbvserver = dict(lbvserver or {})
+        self.servicegroup = dict(servicegroup or {})
+        self.monitor = dict(monitor or {})
+
+    @classmethod
+    def from_app(cls, app, port=None):
+        """:param dict app: entry of the app in APP_INFO
+        :param dict port: entry of one of its `ports`, whose settings
+            override the app's
+        """
+        port = port or {}
+        lbvserver = dict(app.get('lbvserver') or {})
+        lbvserver.update(port.get('lbvserver') or {})
+        servicegroup = dict(app.get('servicegroup') or {})
+        servicegroup.update(port.get('servicegroup') or {})
+        monitor = dict(app.get('monitor') or {})
+        monitor.update(port.get('monitor') or {})
+        return cls(lbmethod=port.get('lbmethod', app.get('lbmethod')),
+                   servicetype=port.get('servicetype',
+                                        app.get('servicetype')),
+                   lbvserver=lbvserver,
+                   servicegroup=servicegroup,
+                   monitor=monitor)
+
+    def servicegroup_settings(self):
+        """:returns: attributes of the service group, as reconciled"""
+        settings = dict(self.servicegroup)
+        if self.servicetype:
+            settings['servicetype'] = self.servicetype
+        return settings
+
+    def lbvserver_settings(self):
+        """:returns: attributes of the lbvserver, as reconciled"""
+        settings = dict(self.lbvserver)
+        if self.servicetype:
+            settings['servicetype'] = self.servicetype
+        if self.lbmethod:
+            settings['lbmethod'] = self.lbmethod
+        return settings
+
+    def monitor_settings(self, grpname):
+        """:returns: attributes of the service group's lbmonitor, None if
+            the app has no monitor"""
+        if not self.monitor:
+            return None
+        settings = dict(self.monitor)
+        settings.setdefault('type', DEFAULT_MONITOR_TYPE)
+        url = settings.pop('url', None)
+        if url:
+            # HTTP-ECV monitors send a raw request, HTTP ones a request line
+            key = 'send' if settings['type'].upper() == 'HTTP-ECV' \
+                else 'httprequest'
+            settings.setdefault(key, "GET %s" % url)
+        settings['monitorname'] = monitor_name(grpname)
+        return settings
+
+    def create_servicegroup(self):
+        """:returns: attributes to create the service group with"""
+        settings = self.servicegroup_settings()
+        settings.setdefault('servicetype', DEFAULT_SERVICETYPE)
+        return settings
+
+    def create_lbvserver(self):
+        """:returns: attributes to create the lbvserver with"""
+        settings = self.lbvserver_settings()
+        settings.setdefault('servicetype', DEFAULT_SERVICETYPE)
+        settings.setdefault('lbmethod', DEFAULT_LBMETHOD)
+        return settings
+
+
+def drift(resource, settings):
+    """Settings a NITRO resource read from the NetScaler differs from
+
+    :param resource: the resource, None if it does not exist
+    :param dict settings: attribute -> desired value
+    :returns: (attributes to update, immutable attributes that differ),
+        as attribute -> desired value
+    :rtype: tuple
+    """
+    changed = {}
+    fixed = {}
+    if resource is None:
+        return changed, fixed
+    for k, v in sorted(settings.items()):
+        if _same(getattr(resource, k, None), v):
+            continue
+        if k in IMMUTABLE:
+            fixed[k] = v
+        else:
+            changed[k] = v
+    return changed, fixed
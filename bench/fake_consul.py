@@ -0,0 +1,134 @@
+"""
+Fake Consul agent for benchmarks. Serves /v1/health/service/<name> from
+memory, including blocking queries on the per-service X-Consul-Index, and
+counts requests.
+"""
+import json
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeConsul(object):
+    """In-memory Consul. Start it, point ConsulInterface at `url`."""
+
+    def __init__(self, latency=0.0):
+        """Constructor
+
+        :param float latency: seconds added to every non-blocking response
+        """
+        self.latency = latency
+        # service name -> {instance id: (address, port, status)}
+        self.services = {}
+        self.indexes = {}  # service name -> modify index
+        self.index = 1  # raft index
+        self.requests = 0
+        self.blocking = 0
+        self._lock = threading.Condition()
+        self._server = None
+
+    def add_service(self, name, instances, nodes=10, port=20000):
+        for i in range(instances):
+            self.set_instance(name, '%s-%d' % (name, i),
+                              '10.2.%d.%d' % ((i % nodes) // 250,
+                                              (i % nodes) % 250),
+                              port + i, notify=False)
+
+    def set_instance(self, name, instance_id, address, port,
+                     status='passing', notify=True):
+        """Register or update an instance and bump the service's index"""
+        with self._lock:
+            self.services.setdefault(name, {})[instance_id] = \
+                (address, port, status)
+            self._bump(name)
+
+    def remove_instance(self, name, instance_id):
+        with self._lock:
+            self.services.get(name, {}).pop(instance_id, None)
+            self._bump(name)
+
+    def touch(self, name):
+        """Advance the index of a service without changing it, as Consul
+        does for, e.g., check output updates"""
+        with self._lock:
+            self._bump(name)
+
+    def _bump(self, name):
+        self.index += 1
+        self.indexes[name] = self.index
+        self._lock.notify_all()
+
+    def health(self, name, query):
+        """(index, entries) for a health query, blocking if it has an
+        index"""
+        with self._lock:
+            self.requests += 1
+            index = int(query.get('index', ['0'])[0])
+            if index:
+                self.blocking += 1
+                wait = query.get('wait', ['300s'])[0]
+                deadline = time.time() + float(wait.rstrip('s'))
+                while self.indexes.get(name, 1) <= index and \
+                        time.time() < deadline:
+                    self._lock.wait(deadline - time.time())
+            passing = 'passing' in query
+            entries = [{'Node': {'Node': 'node-%s' % address,
+                                 'Address': address},
+                        'Service': {'ID': instance_id, 'Service': name,
+                                    'Address': '', 'Port': port},
+                        'Checks': [{'Status': status}]}
+                       for instance_id, (address, port, status) in
+                       sorted(self.services.get(name, {}).items())
+                       if not passing or status == 'passing']
+            return self.indexes.get(name, 1), entries
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query, keep_blank_values=True)
+                prefix = '/v1/health/service/'
+                if not url.path.startswith(prefix):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                if fake.latency and 'index' not in query:
+                    threading.Event().wait(fake.latency)
+                index, entries = fake.health(url.path[len(prefix):], query)
+                data = json.dumps(entries).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('X-Consul-Index', str(index))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
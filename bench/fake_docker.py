@@ -0,0 +1,230 @@
+"""
+Fake Docker (Swarm) remote API for benchmarks. Serves container listings,
+inspect and a chunked event stream from memory, and counts requests.
+"""
+import json
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeDocker(object):
+    """In-memory Swarm. Start it, point DockerSwarmInterface at `url`."""
+
+    def __init__(self, app_key='com.citrix.lb.appname', latency=0.0):
+        """Constructor
+
+        :param str app_key: label that names a container's app
+        :param float latency: seconds added to every non-streaming response
+        """
+        self.app_key = app_key
+        self.latency = latency
+        self.containers = {}  # id -> container
+        self.requests = 0
+        self.streams = 0
+        self._ids = 0
+        self._events = []
+        self._generation = 0  # bumped to drop open event streams
+        self._lock = threading.Condition()
+        self._server = None
+
+    def add_app(self, name, containers, nodes=10, private_port=80):
+        for c in range(containers):
+            self.start_container(name, nodes=nodes,
+                                 private_port=private_port, notify=False)
+
+    def start_container(self, app, nodes=10, private_port=80, notify=True):
+        """Run a container of app publishing private_port on a node
+
+        :returns: the container id
+        """
+        with self._lock:
+            self._ids += 1
+            n = self._ids
+            c_id = '%064x' % n
+            self.containers[c_id] = {
+                'Id': c_id, 'State': 'running', 'Status': 'Up 1 second',
+                'Labels': {self.app_key: app},
+                'node': '10.3.%d.%d' % ((n % nodes) // 250,
+                                        (n % nodes) % 250),
+                'ports': [(private_port, 32000 + n)]}
+            if notify:
+                self._event('start', c_id)
+        return c_id
+
+    def stop_container(self, c_id, notify=True):
+        """Stop a container, emitting kill and die"""
+        with self._lock:
+            self.containers[c_id]['State'] = 'exited'
+            self.containers[c_id]['Status'] = 'Exited (0) 1 second ago'
+            if notify:
+                self._event('kill', c_id)
+                self._event('die', c_id)
+
+    def running(self, app):
+        """:returns: ids of the running containers of app"""
+        with self._lock:
+            return sorted(c_id for c_id, c in self.containers.items()
+                          if c['State'] == 'running' and
+                          c['Labels'].get(self.app_key) == app)
+
+    def disconnect(self):
+        """Close every open event stream"""
+        with self._lock:
+            self._generation += 1
+            self._lock.notify_all()
+
+    def _event(self, status, c_id):
+        c = self.containers[c_id]
+        self._events.append({'status': status, 'id': c_id,
+                             'from': 'image', 'Type': 'container',
+                             'Action': status,
+                             'Actor': {'ID': c_id,
+                                       'Attributes': dict(c['Labels'])},
+                             'time': int(time.time())})
+        self._lock.notify_all()
+
+    def _listing(self, c):
+        running = c['State'] == 'running'
+        return {'Id': c['Id'], 'State': c['State'], 'Status': c['Status'],
+                'Labels': dict(c['Labels']),
+                'Ports': [{'IP': c['node'], 'Type': 'tcp',
+                           'PublicPort': public, 'PrivatePort': private}
+                          if running else
+                          {'Type': 'tcp', 'PrivatePort': private}
+                          for private, public in c['ports']]}
+
+    def _inspect(self, c):
+        running = c['State'] == 'running'
+        return {'Id': c['Id'], 'Config': {'Labels': dict(c['Labels'])},
+                'State': {'Running': running},
+                'Node': {'IP': c['node']},
+                'NetworkSettings': {'Ports': dict(
+                    ('%d/tcp' % private,
+                     [{'HostIp': '0.0.0.0', 'HostPort': str(public)}]
+                     if running else None)
+                    for private, public in c['ports'])}}
+
+    def _matches(self, c, filters):
+        for label in filters.get('label', []):
+            k, _, v = label.partition('=')
+            if k not in c['Labels'] or (v and c['Labels'][k] != v):
+                return False
+        status = filters.get('status')
+        return not status or c['State'] in status
+
+    def handle(self, path, query):
+        with self._lock:
+            self.requests += 1
+            parts = path.strip('/').split('/')
+            if parts and parts[0].startswith('v1.'):
+                parts = parts[1:]
+            if parts == ['containers', 'json']:
+                filters = json.loads(query.get('filters', ['{}'])[0])
+                show_all = query.get('all', ['0'])[0] in ('1', 'True', 'true')
+                return 200, [self._listing(c)
+                             for c in self.containers.values()
+                             if (show_all or c['State'] == 'running') and
+                             self._matches(c, filters)]
+            if len(parts) == 3 and parts[0] == 'containers' and \
+                    parts[2] == 'json':
+                c = self.containers.get(parts[1])
+                if c is None:
+                    return 404, {'message': 'No such container: %s' %
+                                 parts[1]}
+                return 200, self._inspect(c)
+        return 404, {'message': 'page not found'}
+
+    def stream(self, filters):
+        """Yield events emitted after the call, until disconnect()"""
+        with self._lock:
+            self.requests += 1
+            self.streams += 1
+            position = len(self._events)
+            generation = self._generation
+        wanted = filters.get('event')
+        while True:
+            with self._lock:
+                while position == len(self._events) and \
+                        generation == self._generation:
+                    self._lock.wait()
+                if generation != self._generation:
+                    return
+                events = self._events[position:]
+                position = len(self._events)
+            for event in events:
+                if wanted and event['status'] not in wanted:
+                    continue
+                yield event
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 for chunked streams, as the real servers send them
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.rstrip('/').endswith('/events'):
+                    return self.do_events(
+                        json.loads(query.get('filters', ['{}'])[0]))
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                status, body = fake.handle(url.path, query)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_events(self, filters):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for event in fake.stream(filters):
+                        self.write_chunk(json.dumps(event).encode('utf-8') +
+                                         b'\n')
+                    self.write_chunk(b'')
+                except IOError:
+                    self.close_connection = True
+
+            def write_chunk(self, data):
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii') +
+                                 data + b'\r\n')
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    @property
+    def url(self):
+        """tcp:// URL, as DockerSwarmInterface expects it"""
+        return 'tcp://127.0.0.1:%d' % self._server.server_address[1]
+
+    def stop(self):
+        self.disconnect()
+        self._server.shutdown()
+        self._server.server_close()
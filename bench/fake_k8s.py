@@ -0,0 +1,260 @@
+"""
+Fake Kubernetes apiserver for benchmarks. Serves services, endpoints, pods
+and nodes from memory, supports list and watch with namespace, label and
+metadata.name field selectors, and counts requests. Object names must be
+unique across namespaces.
+"""
+import json
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeKubernetes(object):
+    """In-memory apiserver. Start it, point K8sClient at `url`."""
+
+    def __init__(self, latency=0.0):
+        """Constructor
+
+        :param float latency: seconds added to every response
+        """
+        self.latency = latency
+        self.services = {}
+        self.endpoints = {}
+        self.pods = {}
+        self.nodes = {}
+        self.requests = 0
+        self.resource_version = 1
+        # oldest resourceVersion a watch can resume from
+        self.compacted = 0
+        self._events = []  # (resourceVersion, resource, type, object)
+        self._lock = threading.Condition()
+        self._server = None
+
+    def _store(self, resource):
+        return {'services': self.services,
+                'endpoints': self.endpoints,
+                'pods': self.pods,
+                'nodes': self.nodes}[resource]
+
+    def put(self, resource, obj, event_type=None):
+        """Create or replace an object and emit a watch event"""
+        with self._lock:
+            store = self._store(resource)
+            name = obj['metadata']['name']
+            if event_type is None:
+                event_type = 'MODIFIED' if name in store else 'ADDED'
+            self.resource_version += 1
+            obj['metadata']['resourceVersion'] = str(self.resource_version)
+            if event_type == 'DELETED':
+                store.pop(name, None)
+            else:
+                store[name] = obj
+            self._events.append((self.resource_version, resource,
+                                 event_type, obj))
+            self._lock.notify_all()
+
+    def delete(self, resource, name):
+        self.put(resource, dict(self._store(resource)[name]), 'DELETED')
+
+    def compact(self):
+        """Forget past events; watches from older versions get a 410"""
+        with self._lock:
+            self.compacted = self.resource_version
+            self._events = []
+
+    def set_ready_pods(self, name, pods):
+        """Change the number of ready addresses of a service's endpoints"""
+        endpoints = self.endpoints[name]
+        # in the order add_service spread the pods over them
+        nodes = sorted(self.nodes, key=lambda n: int(n.rsplit('-', 1)[1]))
+        addresses = [{'ip': '172.16.%d.%d' % (p // 250, p % 250),
+                      'nodeName': nodes[p % len(nodes)],
+                      'targetRef': {'kind': 'Pod',
+                                    'name': '%s-%d' % (name, p)}}
+                     for p in range(pods)]
+        self.put('endpoints', {'metadata': dict(endpoints['metadata']),
+                               'subsets': [{'addresses': addresses,
+                                            'ports': [{'port': 80}]}]})
+
+    def _matches(self, obj, namespace, query):
+        meta = obj['metadata']
+        if namespace is not None and meta.get('namespace') != namespace:
+            return False
+        for kv in (query.get('labelSelector') or [''])[0].split(','):
+            if kv:
+                k, v = kv.split('=', 1)
+                if meta.get('labels', {}).get(k) != v:
+                    return False
+        for kv in (query.get('fieldSelector') or [''])[0].split(','):
+            if kv:
+                k, v = kv.split('=', 1)
+                if k != 'metadata.name' or meta['name'] != v:
+                    return False
+        return True
+
+    def watch(self, resource, since, timeout, namespace=None, query=None):
+        """Yield watch events for resource newer than since, until timeout
+        seconds pass without one"""
+        query = query or {}
+        with self._lock:
+            if since < self.compacted:
+                yield {'type': 'ERROR',
+                       'object': {'kind': 'Status', 'code': 410,
+                                  'message': 'too old resource version'}}
+                return
+        while True:
+            with self._lock:
+                events = [e for e in self._events
+                          if e[0] > since and e[1] == resource]
+                if not events:
+                    self._lock.wait(timeout)
+                    events = [e for e in self._events
+                              if e[0] > since and e[1] == resource]
+                    if not events:
+                        return
+            for rv, _, event_type, obj in events:
+                since = rv
+                if self._matches(obj, namespace, query):
+                    yield {'type': event_type, 'object': obj}
+
+    def add_service(self, name, pods, nodes, node_port=30080,
+                    with_node_name=True, namespace='default', labels=None):
+        """Create a NodePort service with `pods` running pods spread over
+        `nodes` nodes"""
+        meta = {'name': name, 'namespace': namespace,
+                'labels': dict(labels or {})}
+        for n in range(nodes):
+            nodename = 'node-%d' % n
+            self.nodes[nodename] = {
+                'metadata': {'name': nodename},
+                'status': {'addresses': [
+                    {'type': 'InternalIP',
+                     'address': '10.1.%d.%d' % (n // 250, n % 250)}]}}
+        self.services[name] = {
+            'metadata': dict(meta),
+            'spec': {'type': 'NodePort',
+                     'selector': {'app': name},
+                     'ports': [{'port': 80, 'nodePort': node_port}]}}
+        addresses = []
+        for p in range(pods):
+            podname = '%s-%d' % (name, p)
+            nodename = 'node-%d' % (p % nodes)
+            self.pods[podname] = {
+                'metadata': {'name': podname, 'namespace': namespace,
+                             'labels': {'app': name}},
+                'status': {'phase': 'Running',
+                           'hostIP': self.nodes[nodename]['status']
+                           ['addresses'][0]['address']}}
+            address = {'ip': '172.16.%d.%d' % (p // 250, p % 250),
+                       'targetRef': {'kind': 'Pod', 'name': podname}}
+            if with_node_name:
+                address['nodeName'] = nodename
+            addresses.append(address)
+        self.endpoints[name] = {
+            'metadata': dict(meta),
+            'subsets': [{'addresses': addresses,
+                         'ports': [{'port': 80}]}]}
+
+    def _list(self, items):
+        return {'metadata': {'resourceVersion': str(self.resource_version)},
+                'items': list(items)}
+
+    def handle(self, path, query):
+        """:returns: (status, body) for a GET of path"""
+        with self._lock:
+            self.requests += 1
+        parts = path.strip('/').split('/')
+        if parts[:2] == ['v1', 'nodes']:
+            return 200, self._list(self.nodes.values())
+        if parts[:2] != ['v1', 'namespaces'] or len(parts) < 4:
+            return 404, {'reason': 'NotFound'}
+        namespace = parts[2]
+        store = {'services': self.services,
+                 'endpoints': self.endpoints,
+                 'pods': self.pods}.get(parts[3])
+        if store is None:
+            return 404, {'reason': 'NotFound'}
+        if len(parts) == 5:
+            obj = store.get(parts[4])
+            if obj is not None and self._matches(obj, namespace, {}):
+                return 200, obj
+            return 404, {'reason': 'NotFound'}
+        return 200, self._list(i for i in store.values()
+                               if self._matches(i, namespace, query))
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 for chunked streams, as the real servers send them
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                if query.get('watch') == ['true']:
+                    return self.do_watch(url.path, query)
+                status, body = fake.handle(url.path, query)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_watch(self, path, query):
+                with fake._lock:
+                    fake.requests += 1
+                parts = path.strip('/').split('/')
+                resource = parts[-1]
+                namespace = parts[2] if parts[1] == 'namespaces' else None
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                since = int(query.get('resourceVersion', ['0'])[0])
+                timeout = float(query.get('timeoutSeconds', ['5'])[0])
+                try:
+                    for event in fake.watch(resource, since, timeout,
+                                            namespace, query):
+                        self.write_chunk(json.dumps(event).encode('utf-8') +
+                                         b'\n')
+                    self.write_chunk(b'')
+                except IOError:
+                    self.close_connection = True
+
+            def write_chunk(self, data):
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii') +
+                                 data + b'\r\n')
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
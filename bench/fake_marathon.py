@@ -0,0 +1,177 @@
+"""
+Fake Marathon for benchmarks. Serves apps and tasks from memory and a
+server-sent event stream of status_update_events, and counts requests.
+"""
+import json
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeMarathon(object):
+    """In-memory Marathon. Start it, point MarathonInterface at `url`."""
+
+    def __init__(self, latency=0.0, with_ports=True):
+        """Constructor
+
+        :param float latency: seconds added to every non-streaming response
+        :param bool with_ports: include ports in status_update_events, as
+            Marathon >= 1.0 does
+        """
+        self.latency = latency
+        self.with_ports = with_ports
+        self.apps = {}  # app id -> {task id: task}
+        self.requests = 0
+        self.streams = 0
+        self._events = []
+        self._generation = 0  # bumped to drop open event streams
+        self._lock = threading.Condition()
+        self._server = None
+
+    def add_app(self, name, tasks, hosts=10):
+        self.apps['/' + name] = {}
+        for t in range(tasks):
+            self.task_update(name, '%s.%d' % (name, t), 'TASK_RUNNING',
+                             'host-%d' % (t % hosts), 31000 + t,
+                             notify=False)
+
+    def task_update(self, name, task_id, status, host, port, notify=True):
+        """Change a task and emit a status_update_event"""
+        with self._lock:
+            tasks = self.apps.setdefault('/' + name, {})
+            if status == 'TASK_RUNNING':
+                tasks[task_id] = {'id': task_id, 'appId': '/' + name,
+                                  'host': host, 'ports': [port],
+                                  'state': 'TASK_RUNNING'}
+            else:
+                tasks.pop(task_id, None)
+            if notify:
+                event = {'eventType': 'status_update_event',
+                         'appId': '/' + name, 'taskId': task_id,
+                         'taskStatus': status, 'host': host,
+                         'timestamp': '2016-01-01T00:00:00.000Z'}
+                if self.with_ports:
+                    event['ports'] = [port]
+                self._events.append(('status_update_event', event))
+                self._lock.notify_all()
+
+    def other_event(self, event_type='api_post_event', size=1000):
+        """Emit an event nitrox does not care about"""
+        with self._lock:
+            self._events.append((event_type, {'eventType': event_type,
+                                              'payload': 'x' * size}))
+            self._lock.notify_all()
+
+    def disconnect(self):
+        """Close every open event stream"""
+        with self._lock:
+            self._generation += 1
+            self._lock.notify_all()
+
+    def handle(self, path, query):
+        with self._lock:
+            self.requests += 1
+            parts = path.strip('/').split('/')
+            if parts == ['v2', 'apps']:
+                embed = 'apps.tasks' in query.get('embed', [])
+                return 200, {'apps': [
+                    dict({'id': app_id},
+                         **({'tasks': list(tasks.values())} if embed else {}))
+                    for app_id, tasks in self.apps.items()]}
+            if parts[:2] == ['v2', 'apps'] and parts[-1] == 'tasks':
+                app_id = '/' + '/'.join(parts[2:-1])
+                if app_id not in self.apps:
+                    return 404, {'message': 'App not found'}
+                return 200, {'tasks': list(self.apps[app_id].values())}
+        return 404, {'message': 'Not found'}
+
+    def stream(self, wanted):
+        """Yield SSE events appended after the call, until disconnect()"""
+        with self._lock:
+            self.requests += 1
+            self.streams += 1
+            position = len(self._events)
+            generation = self._generation
+        while True:
+            with self._lock:
+                while position == len(self._events) and \
+                        generation == self._generation:
+                    self._lock.wait()
+                if generation != self._generation:
+                    return
+                events = self._events[position:]
+                position = len(self._events)
+            for event_type, event in events:
+                if wanted and event_type not in wanted:
+                    continue
+                yield event_type, event
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # HTTP/1.1 for chunked streams, as the real servers send them
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path.rstrip('/') == '/v2/events':
+                    return self.do_events(query.get('event_type', []))
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                status, body = fake.handle(url.path, query)
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_events(self, wanted):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                try:
+                    for event_type, event in fake.stream(wanted):
+                        self.write_chunk(('event: %s\ndata: %s\n\n' %
+                                          (event_type, json.dumps(event))
+                                          ).encode('utf-8'))
+                    self.write_chunk(b'')
+                except IOError:
+                    self.close_connection = True
+
+            def write_chunk(self, data):
+                self.wfile.write(('%x\r\n' % len(data)).encode('ascii') +
+                                 data + b'\r\n')
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self._server.server_address[1]
+
+    def stop(self):
+        self.disconnect()
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,402 @@
+"""
+Fake NetScaler NITRO REST API for benchmarks. Serves login/logout and the
+config resources nitrox uses from memory: top-level resources (lbvserver,
+servicegroup, ...) and their bindings, including bulk add/delete, count,
+filter and bulkbindings queries, and weight updates and (graceful)
+disable/enable of service group members. Every request is counted and
+can be delayed to model a loaded NetScaler.
+"""
+import itertools
+import json
+import threading
+import time
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+
+# top-level resource -> name attribute
+RESOURCES = {'lbvserver': 'name',
+             'servicegroup': 'servicegroupname',
+             'lbmonitor': 'monitorname',
+             'hanode': 'id'}
+# binding -> (attribute naming the bound-to resource, attributes that
+# identify one binding of it)
+BINDINGS = {'lbvserver_servicegroup_binding':
+            ('name', ('servicegroupname',)),
+            'servicegroup_servicegroupmember_binding':
+            ('servicegroupname', ('ip', 'port')),
+            'servicegroup_lbmonitor_binding':
+            ('servicegroupname', ('monitor_name',))}
+
+MEMBERS = 'servicegroup_servicegroupmember_binding'
+
+NO_SUCH_RESOURCE = (258, 'No such resource')
+EXISTS = (273, 'Resource already exists')
+SESSION_EXPIRED = (444, 'Session expired or killed. Please login again')
+BULK_FAILED = (1243, 'Bulk operation failed')
+
+
+class NitroError(Exception):
+    def __init__(self, error):
+        Exception.__init__(self, error[1])
+        self.errorcode, self.message = error
+
+
+def _args(text):
+    """'ip:1.2.3.4,port:80' -> {'ip': '1.2.3.4', 'port': '80'}"""
+    return dict(kv.split(':', 1) for kv in (text or '').split(',') if kv)
+
+
+def _same(a, b):
+    return str(a) == str(b)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeNitro(object):
+    """In-memory NetScaler. Start it, point NetscalerInterface at
+    `address`."""
+
+    def __init__(self, latency=0.0, item_latency=0.0):
+        """Constructor
+
+        :param float latency: seconds added to every response
+        :param float item_latency: seconds added per resource added,
+            updated or deleted, e.g., to model bulk requests that are
+            not free for the NetScaler
+        """
+        self.latency = latency
+        self.item_latency = item_latency
+        self.resources = dict((r, {}) for r in RESOURCES)
+        # a standalone node; seed a peer and change the states to model
+        # an HA pair
+        self.resources['hanode']['0'] = {'id': '0', 'state': 'Primary'}
+        self.bindings = dict((b, {}) for b in BINDINGS)  # -> {name: [obj]}
+        self.sessions = set()
+        self.requests = 0
+        self.logins = 0
+        self.calls = {}  # (operation, resource) -> requests
+        self.items = 0  # resources added, updated or deleted
+        self._tokens = itertools.count(1)
+        self._lock = threading.Lock()
+        self._server = None
+
+    # state, for seeding and checking a benchmark
+
+    def seed(self, resource, obj):
+        """Create a resource or binding without a request"""
+        with self._lock:
+            self._add(resource, dict(obj))
+
+    def members(self, grpname):
+        """:returns: set of (ip, port) bound to a service group"""
+        with self._lock:
+            return set((b['ip'], int(b['port'])) for b in
+                       self.bindings['servicegroup_servicegroupmember_binding']
+                       .get(grpname, []))
+
+    def weights(self, grpname):
+        """:returns: (ip, port) -> weight of a service group's members"""
+        with self._lock:
+            return dict(((b['ip'], int(b['port'])), b['weight']) for b in
+                        self.bindings[MEMBERS].get(grpname, []))
+
+    def expire_sessions(self):
+        """Forget every session, as a NetScaler reboot or timeout would"""
+        with self._lock:
+            self.sessions.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests,
+                    'logins': self.logins,
+                    'items': self.items,
+                    'calls': dict(('%s %s' % k, v)
+                                  for k, v in self.calls.items())}
+
+    # resource operations, called with the lock held
+
+    def _member(self, obj):
+        """:returns: the bound service group member obj names"""
+        for b in self.bindings[MEMBERS].get(obj.get('servicegroupname'), []):
+            if _same(b.get('ip'), obj.get('servername')) and \
+                    _same(b.get('port'), obj.get('port')):
+                return b
+        raise NitroError(NO_SUCH_RESOURCE)
+
+    def _disable(self, resource, obj):
+        if resource != 'servicegroup' or not obj.get('servername'):
+            raise NitroError((1093, 'Cannot disable %s' % resource))
+        b = self._member(obj)
+        delay = int(obj.get('delay') or 0) if obj.get('graceful') == 'YES' \
+            else 0
+        b['state'] = 'DISABLED'
+        b['svrstate'] = 'GOING OUT OF SERVICE' if delay else 'OUT OF SERVICE'
+        b['_out_at'] = time.time() + delay
+
+    def _enable(self, resource, obj):
+        if resource != 'servicegroup' or not obj.get('servername'):
+            raise NitroError((1093, 'Cannot enable %s' % resource))
+        b = self._member(obj)
+        b['state'] = 'ENABLED'
+        b['svrstate'] = 'UP'
+        b.pop('_out_at', None)
+
+    def _view(self, obj):
+        """obj as a response shows it, member drains brought up to date"""
+        if obj.get('_out_at') is not None and time.time() >= obj['_out_at']:
+            obj['svrstate'] = 'OUT OF SERVICE'
+        return dict((k, v) for k, v in obj.items() if not k.startswith('_'))
+
+    def _get(self, resource, name, query):
+        if resource in RESOURCES:
+            store = self.resources[resource]
+            if name is not None:
+                if name not in store:
+                    raise NitroError(NO_SUCH_RESOURCE)
+                found = [store[name]]
+            else:
+                found = list(store.values())
+        elif resource in BINDINGS:
+            store = self.bindings[resource]
+            if name is not None:
+                found = list(store.get(name, []))
+            elif query.get('bulkbindings') == ['yes']:
+                found = [b for bs in store.values() for b in bs]
+            else:
+                raise NitroError((1092, 'Argument missing: %s' %
+                                  BINDINGS[resource][0]))
+        else:
+            raise NitroError((2138, 'Unknown resource %s' % resource))
+        for k, v in _args(query.get('filter', [''])[0]).items():
+            found = [o for o in found if _same(o.get(k), v)]
+        if query.get('count') == ['yes']:
+            return [{'__count': len(found)}]
+        return [self._view(o) for o in found]
+
+    def _add(self, resource, obj):
+        if resource in RESOURCES:
+            name = obj.get(RESOURCES[resource])
+            if name in self.resources[resource]:
+                raise NitroError(EXISTS)
+            self.resources[resource][name] = obj
+            return
+        parent_key, ids = BINDINGS[resource]
+        parent = obj.get(parent_key)
+        # <owner>_<bound>_binding
+        if parent not in self.resources[resource.split('_')[0]]:
+            raise NitroError(NO_SUCH_RESOURCE)
+        bound = self.bindings[resource].setdefault(parent, [])
+        if any(all(_same(b.get(i), obj.get(i)) for i in ids) for b in bound):
+            raise NitroError(EXISTS)
+        if resource == MEMBERS:
+            obj['weight'] = int(obj.get('weight') or 1)
+            obj.setdefault('state', 'ENABLED')
+            obj.setdefault('svrstate', 'UP')
+        bound.append(obj)
+
+    def _update(self, resource, obj):
+        if resource == 'servicegroup' and obj.get('servername'):
+            # a member of the group
+            self._member(obj)['weight'] = int(obj.get('weight') or 1)
+            return
+        if resource not in RESOURCES:
+            raise NitroError((2138, 'Cannot update %s' % resource))
+        name = obj.get(RESOURCES[resource])
+        if name not in self.resources[resource]:
+            raise NitroError(NO_SUCH_RESOURCE)
+        self.resources[resource][name].update(obj)
+
+    def _delete(self, resource, obj):
+        if resource in RESOURCES:
+            name = obj.get(RESOURCES[resource])
+            if self.resources[resource].pop(name, None) is None:
+                raise NitroError(NO_SUCH_RESOURCE)
+            return
+        parent_key, ids = BINDINGS[resource]
+        bound = self.bindings[resource].get(obj.get(parent_key), [])
+        kept = [b for b in bound
+                if not all(_same(b.get(i), obj.get(i)) for i in ids
+                           if obj.get(i) is not None)]
+        if len(kept) == len(bound):
+            raise NitroError(NO_SUCH_RESOURCE)
+        bound[:] = kept
+
+    def _each(self, op, resource, objs):
+        """Apply op to every object, continuing on error.
+
+        :returns: per-object (errorcode, message)
+        """
+        results = []
+        for obj in objs:
+            try:
+                op(resource, obj)
+                results.append((0, 'Done'))
+            except NitroError as e:
+                results.append((e.errorcode, e.message))
+        self.items += len(objs)
+        return results
+
+    def handle(self, method, path, query, body, token):
+        """:returns: (HTTP status, response body, session token to set)"""
+        parts = [unquote(p) for p in path.strip('/').split('/')]
+        if parts[:3] != ['nitro', 'v1', 'config'] or len(parts) < 4:
+            return 404, {'errorcode': 2138, 'message': 'Not found'}, None
+        resource = parts[3]
+        name = parts[4] if len(parts) > 4 else None
+        with self._lock:
+            self.requests += 1
+            op = query.get('action', [{'GET': 'get', 'POST': 'add',
+                                       'PUT': 'update',
+                                       'DELETE': 'delete'}[method]])[0]
+            key = (op, resource)
+            self.calls[key] = self.calls.get(key, 0) + 1
+            if resource == 'login':
+                token = '##%08d' % next(self._tokens)
+                self.sessions.add(token)
+                self.logins += 1
+                return 201, {'errorcode': 0, 'message': 'Done',
+                             'severity': 'NONE', 'sessionid': token}, token
+            if token not in self.sessions:
+                return 401, self._error(SESSION_EXPIRED), None
+            if resource == 'logout':
+                self.sessions.discard(token)
+                return 201, self._done(), None
+            try:
+                if method == 'GET':
+                    found = self._get(resource, name, query)
+                    result = self._done()
+                    if found:
+                        result[resource] = found
+                    return 200, result, None
+                if method == 'DELETE':
+                    obj = _args(query.get('args', [''])[0])
+                    if resource in BINDINGS:
+                        obj[BINDINGS[resource][0]] = name
+                    else:
+                        obj[RESOURCES.get(resource, 'name')] = name
+                    code, message = self._each(self._delete, resource,
+                                               [obj])[0]
+                    if code:
+                        return 599, self._error((code, message)), None
+                    return 200, self._done(), None
+            except NitroError as e:
+                return 599, self._error((e.errorcode, e.message)), None
+            objs = body.get(resource)
+            if objs is None:
+                return 400, self._error((1095, 'No %s in request' %
+                                         resource)), None
+            bulk = isinstance(objs, list)
+            objs = objs if bulk else [objs]
+            operation = {'add': self._add, 'update': self._update,
+                         'rm': self._delete,
+                         'delete': self._delete,
+                         'disable': self._disable,
+                         'enable': self._enable}.get(op)
+            if operation is None:
+                return 400, self._error((1093, 'Unsupported action %s' %
+                                         op)), None
+            results = self._each(operation, resource, objs)
+        if self.item_latency:
+            threading.Event().wait(self.item_latency * len(objs))
+        if not bulk:
+            if results[0][0]:
+                return 599, self._error(results[0]), None
+            return 201, self._done(), None
+        if not any(code for code, _ in results):
+            return 201, self._done(), None
+        result = self._error(BULK_FAILED)
+        result['response'] = [{'errorcode': errorcode, 'message': text,
+                               'severity': 'ERROR' if errorcode else 'NONE'}
+                              for errorcode, text in results]
+        return 207, result, None
+
+    def _done(self):
+        return {'errorcode': 0, 'message': 'Done', 'severity': 'NONE'}
+
+    def _error(self, error):
+        return {'errorcode': error[0], 'message': error[1],
+                'severity': 'ERROR'}
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def _token(self, body, query):
+                cookies = dict(c.strip().split('=', 1) for c in
+                               (self.headers.get('Cookie') or '').split(';')
+                               if '=' in c)
+                return (cookies.get('NITRO_AUTH_TOKEN') or
+                        cookies.get('sessionid') or
+                        body.get('sessionid') or
+                        query.get('sessionid', [None])[0])
+
+            def _respond(self, method):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                length = int(self.headers.get('Content-Length') or 0)
+                raw = self.rfile.read(length) if length else b''
+                body = {}
+                if raw:
+                    text = raw.decode('utf-8')
+                    try:
+                        body = json.loads(text)
+                    except ValueError:
+                        # object=<json>, as some SDK versions send it
+                        body = json.loads(unquote(text.split('=', 1)[-1]))
+                if fake.latency:
+                    threading.Event().wait(fake.latency)
+                status, result, token = fake.handle(
+                    method, url.path, query, body, self._token(body, query))
+                data = json.dumps(result).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                if token:
+                    self.send_header('Set-Cookie',
+                                     'NITRO_AUTH_TOKEN=%s; path=/nitro/v1'
+                                     % token)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._respond('GET')
+
+            def do_POST(self):
+                self._respond('POST')
+
+            def do_PUT(self):
+                self._respond('PUT')
+
+            def do_DELETE(self):
+                self._respond('DELETE')
+
+            def log_message(self, *args):
+                pass
+
+        self._server = _Server(('127.0.0.1', 0), Handler)
+        t = threading.Thread(target=self._server.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    @property
+    def address(self):
+        """host:port to give NetscalerInterface as the NetScaler IP"""
+        return '127.0.0.1:%d' % self._server.server_address[1]
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+"""
+Benchmark KubernetesInterface.get_backends_for_app against a fake apiserver.
+
+    python bench/k8s_backends.py [--pods 10,100,500] [--latency 0.001]
+
+Reports apiserver requests and wall time per call, for endpoints that
+carry nodeName and for endpoints that do not (older apiservers).
+"""
+import argparse
+import os
+import sys
+import time
+sys.path.append(os.getcwd())
+from kubernetes.kubernetes import KubernetesInterface
+from bench.fake_k8s import FakeKubernetes
+
+
+def run(pods, latency, with_node_name, repeat=5):
+    fake = FakeKubernetes(latency=latency)
+    fake.add_service('frontend', pods=pods, nodes=max(1, pods // 10),
+                     with_node_name=with_node_name)
+    fake.start()
+    try:
+        kube = KubernetesInterface(app_info={'apps': []}, server=fake.url)
+        start = time.time()
+        for i in range(repeat):
+            backends = kube.get_backends_for_app('frontend')
+        elapsed = (time.time() - start) / repeat
+        return fake.requests / float(repeat), elapsed, len(backends)
+    finally:
+        fake.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pods", default="10,100,500")
+    parser.add_argument("--latency", type=float, default=0.001,
+                        help="seconds of apiserver latency per request")
+    result = parser.parse_args()
+    print("%8s %10s %12s %10s %10s" % ("pods", "nodeName", "requests/call",
+                                       "ms/call", "backends"))
+    for pods in [int(p) for p in result.pods.split(',')]:
+        for with_node_name in (True, False):
+            requests, elapsed, backends = run(pods, result.latency,
+                                              with_node_name)
+            print("%8d %10s %12.1f %10.1f %10d" % (pods, with_node_name,
+                                                   requests, elapsed * 1000,
+                                                   backends))
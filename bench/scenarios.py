@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+"""
+Benchmark nitrox end to end: a platform driver and the Reconciler
+configuring NetscalerInterface against a fake NetScaler (NITRO REST) and
+a fake platform API, both served locally over HTTP.
+
+    python bench/scenarios.py [--platforms kubernetes,marathon,docker,consul]
+        [--scenarios cold,scale,storm] [--apps 100] [--backends 10]
+        [--scale-to 1000] [--events-per-second 200] [--duration 5]
+        [--nitro-latency 0.002] [--json results.json]
+
+Scenarios:
+  cold     N apps with B backends each on an empty NetScaler, then a
+           restart against the configured NetScaler (`restart`)
+  scale    one app scaled from 0 to --scale-to backends in steps
+  storm    M backend changes per second across N apps for --duration
+           seconds, until the NetScaler has converged
+
+Reports NITRO requests and resources changed, platform API requests, wall
+time and peak memory (traced Python allocations where tracemalloc is
+available, else the process's max RSS; the fakes run in-process and
+are included).
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+sys.path.append(os.getcwd())
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+from netscaler import NetscalerInterface
+from reconcile import Reconciler
+from workers import ReconcilePool
+from coalesce import EventCoalescer
+from bench.fake_nitro import FakeNitro
+
+
+APP_KEY = 'com.citrix.lb.appname'
+
+
+class Platform(object):
+    """A fake platform API and the driver that reads it"""
+    name = None
+
+    def __init__(self, latency, max_backends):
+        self.latency = latency
+        self.max_backends = max_backends
+        self.counts = {}  # app -> backends it should have
+
+    def add_app(self, app, backends):
+        """Create an app before the driver starts, without events"""
+        raise NotImplementedError()
+
+    def set_backends(self, app, count):
+        """Scale a running app, emitting the platform's events"""
+        raise NotImplementedError()
+
+    def driver(self, app_info):
+        raise NotImplementedError()
+
+    def requests(self):
+        return self.fake.requests
+
+    def stop(self):
+        self.fake.stop()
+
+
+class Kubernetes(Platform):
+    name = 'kubernetes'
+
+    def __init__(self, latency, max_backends):
+        from bench.fake_k8s import FakeKubernetes
+        Platform.__init__(self, latency, max_backends)
+        self.fake = FakeKubernetes(latency=latency).start()
+
+    def add_app(self, app, backends):
+        # NodePort services have one backend per node with a ready pod
+        self.fake.add_service(app, backends, self.max_backends,
+                              node_port=30000 + len(self.counts))
+        self.counts[app] = backends
+
+    def set_backends(self, app, count):
+        self.fake.set_ready_pods(app, count)
+        self.counts[app] = count
+
+    def driver(self, app_info):
+        from kubernetes.kubernetes import KubernetesInterface
+        return KubernetesInterface(app_info=app_info, server=self.fake.url)
+
+
+class Marathon(Platform):
+    name = 'marathon'
+
+    def __init__(self, latency, max_backends):
+        from bench.fake_marathon import FakeMarathon
+        Platform.__init__(self, latency, max_backends)
+        self.fake = FakeMarathon(latency=latency).start()
+        self.tasks = {}  # app -> ids of its running tasks
+        self.next_task = 0
+
+    def _start(self, app, notify):
+        self.next_task += 1
+        task_id = '%s.%d' % (app, self.next_task)
+        self.fake.task_update(app, task_id, 'TASK_RUNNING',
+                              'host-%d' % (self.next_task % 100),
+                              31000 + self.next_task, notify=notify)
+        self.tasks[app].append(task_id)
+
+    def add_app(self, app, backends):
+        self.tasks[app] = []
+        self.fake.apps.setdefault('/' + app, {})
+        for i in range(backends):
+            self._start(app, False)
+        self.counts[app] = backends
+
+    def set_backends(self, app, count):
+        while len(self.tasks[app]) < count:
+            self._start(app, True)
+        while len(self.tasks[app]) > count:
+            task_id = self.tasks[app].pop()
+            self.fake.task_update(app, task_id, 'TASK_KILLED', 'host', 0)
+        self.counts[app] = count
+
+    def driver(self, app_info):
+        from marathon.mesos_marathon import MarathonInterface
+        return MarathonInterface(self.fake.url, app_info)
+
+
+class Docker(Platform):
+    name = 'docker'
+
+    def __init__(self, latency, max_backends):
+        from bench.fake_docker import FakeDocker
+        Platform.__init__(self, latency, max_backends)
+        self.fake = FakeDocker(app_key=APP_KEY, latency=latency).start()
+
+    def add_app(self, app, backends):
+        self.fake.add_app(app, backends)
+        self.counts[app] = backends
+
+    def set_backends(self, app, count):
+        running = self.fake.running(app)
+        for i in range(len(running), count):
+            self.fake.start_container(app)
+        for c_id in running[count:]:
+            self.fake.stop_container(c_id)
+        self.counts[app] = count
+
+    def driver(self, app_info):
+        from swarm.docker_swarm import DockerSwarmInterface
+        return DockerSwarmInterface(self.fake.url, None, None, None, True,
+                                    app_info)
+
+
+class Consul(Platform):
+    name = 'consul'
+
+    def __init__(self, latency, max_backends):
+        from bench.fake_consul import FakeConsul
+        Platform.__init__(self, latency, max_backends)
+        self.fake = FakeConsul(latency=latency).start()
+
+    def _instance(self, app, i, notify=True):
+        self.fake.set_instance(app, '%s-%d' % (app, i),
+                               '10.2.%d.%d' % (i // 250, i % 250),
+                               20000 + i, notify=notify)
+
+    def add_app(self, app, backends):
+        for i in range(backends):
+            self._instance(app, i, notify=False)
+        if not backends:
+            self.fake.touch(app)
+        self.counts[app] = backends
+
+    def set_backends(self, app, count):
+        current = self.counts.get(app, 0)
+        for i in range(current, count):
+            self._instance(app, i)
+        for i in range(count, current):
+            self.fake.remove_instance(app, '%s-%d' % (app, i))
+        self.counts[app] = count
+
+    def driver(self, app_info):
+        from consul.consul_health import ConsulInterface
+        return ConsulInterface(self.fake.url, app_info, wait=30)
+
+
+PLATFORMS = dict((p.name, p) for p in (Kubernetes, Marathon, Docker, Consul))
+
+
+class Measurement(object):
+    """NITRO and platform requests, wall time and peak memory of a block"""
+
+    def __init__(self, nitro, platform):
+        self.nitro = nitro
+        self.platform = platform
+
+    def __enter__(self):
+        if tracemalloc is not None:
+            tracemalloc.start()
+        self.nitro_before = self.nitro.stats()
+        self.platform_before = self.platform.requests()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.time() - self.start
+        after = self.nitro.stats()
+        self.nitro_requests = after['requests'] - \
+            self.nitro_before['requests']
+        self.nitro_items = after['items'] - self.nitro_before['items']
+        self.logins = after['logins'] - self.nitro_before['logins']
+        self.platform_requests = self.platform.requests() - \
+            self.platform_before
+        if tracemalloc is not None:
+            self.peak_mb = tracemalloc.get_traced_memory()[1] / 1048576.0
+            tracemalloc.stop()
+        else:
+            # kilobytes on Linux
+            self.peak_mb = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    def result(self, **extra):
+        r = {'nitro_requests': self.nitro_requests,
+             'nitro_items': self.nitro_items,
+             'nitro_logins': self.logins,
+             'platform_requests': self.platform_requests,
+             'wall_s': round(self.wall, 3),
+             'peak_mb': round(self.peak_mb, 1)}
+        r.update(extra)
+        return r
+
+
+def wait_for(condition, timeout, interval=0.05):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if condition():
+            return True
+        time.sleep(interval)
+    return condition()
+
+
+def converged(nitro, platform):
+    return all(len(nitro.members(app)) == count
+               for app, count in platform.counts.items())
+
+
+def app_info(apps):
+    return {'appkey': APP_KEY, 'apps': [{'name': a} for a in apps]}
+
+
+def reconciler(nitro, apps, args):
+    netskaler = NetscalerInterface(nitro.address, 'nsroot', 'nsroot',
+                                   app_info(apps),
+                                   session_pool_size=args.workers)
+    pool = ReconcilePool(size=args.workers)
+    coalescer = None
+    if args.quiet_period > 0:
+        coalescer = EventCoalescer(quiet_period=args.quiet_period,
+                                   max_delay=args.max_delay, pool=pool)
+        coalescer.start()
+    return Reconciler(netskaler, pool=pool, coalescer=coalescer)
+
+
+def setup(platform_cls, apps, backends, args):
+    nitro = FakeNitro(latency=args.nitro_latency).start()
+    platform = platform_cls(args.platform_latency,
+                            max(args.scale_to, args.backends + 1))
+    for app in apps:
+        # frontends are configured separately; nitrox only binds to them
+        nitro.seed('lbvserver', {'name': app, 'servicetype': 'HTTP'})
+        platform.add_app(app, backends)
+    return nitro, platform
+
+
+def cold(platform_cls, args):
+    apps = ['app%d' % i for i in range(args.apps)]
+    nitro, platform = setup(platform_cls, apps, args.backends, args)
+    results = []
+    try:
+        for scenario in ('cold', 'restart'):
+            with Measurement(nitro, platform) as m:
+                r = reconciler(nitro, apps, args)
+                r.sync(platform.driver(app_info(apps)))
+            results.append(dict(scenario=scenario,
+                                converged=converged(nitro, platform),
+                                **m.result()))
+            r.netskaler.shutdown()
+    finally:
+        platform.stop()
+        nitro.stop()
+    return results
+
+
+def run_in_background(r, driver):
+    t = threading.Thread(target=r.run, args=(driver,), name='Bench-run')
+    t.daemon = True
+    t.start()
+
+
+def scale(platform_cls, args):
+    nitro, platform = setup(platform_cls, ['scale'], 0, args)
+    try:
+        r = reconciler(nitro, ['scale'], args)
+        run_in_background(r, platform.driver(app_info(['scale'])))
+        wait_for(lambda: nitro.stats()['requests'] > 0 and
+                 r.pool.queue_depth() == 0, 30)
+        with Measurement(nitro, platform) as m:
+            count = 0
+            while count < args.scale_to:
+                count = min(args.scale_to, count + args.scale_step)
+                platform.set_backends('scale', count)
+                time.sleep(args.scale_interval)
+            scaled = time.time()
+            done = wait_for(lambda: converged(nitro, platform),
+                            args.timeout)
+            lag = time.time() - scaled
+        return [dict(scenario='scale', converged=done,
+                     backends=args.scale_to, lag_s=round(lag, 3),
+                     **m.result())]
+    finally:
+        platform.stop()
+        nitro.stop()
+
+
+def storm(platform_cls, args):
+    apps = ['app%d' % i for i in range(args.apps)]
+    nitro, platform = setup(platform_cls, apps, args.backends, args)
+    rand = random.Random(1)
+    try:
+        r = reconciler(nitro, apps, args)
+        run_in_background(r, platform.driver(app_info(apps)))
+        wait_for(lambda: converged(nitro, platform), args.timeout)
+        with Measurement(nitro, platform) as m:
+            events = 0
+            interval = 1.0 / args.events_per_second
+            end = time.time() + args.duration
+            while time.time() < end:
+                app = rand.choice(apps)
+                current = platform.counts[app]
+                platform.set_backends(app, current + 1
+                                      if current <= args.backends
+                                      else current - 1)
+                events += 1
+                time.sleep(interval)
+            stormed = time.time()
+            done = wait_for(lambda: converged(nitro, platform),
+                            args.timeout)
+            lag = time.time() - stormed
+        return [dict(scenario='storm', converged=done, events=events,
+                     lag_s=round(lag, 3), **m.result())]
+    finally:
+        platform.stop()
+        nitro.stop()
+
+
+SCENARIOS = {'cold': cold, 'scale': scale, 'storm': storm}
+
+COLUMNS = [('platform', '%-10s'), ('scenario', '%-8s'),
+           ('nitro_requests', '%14s'), ('nitro_items', '%11s'),
+           ('nitro_logins', '%12s'), ('platform_requests', '%17s'),
+           ('wall_s', '%8s'), ('peak_mb', '%8s'), ('lag_s', '%7s'),
+           ('converged', '%9s')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--platforms",
+                        default="kubernetes,marathon,docker,consul")
+    parser.add_argument("--scenarios", default="cold,scale,storm")
+    parser.add_argument("--apps", type=int, default=100)
+    parser.add_argument("--backends", type=int, default=10,
+                        help="backends per app (cold, storm)")
+    parser.add_argument("--scale-to", type=int, default=1000)
+    parser.add_argument("--scale-step", type=int, default=100)
+    parser.add_argument("--scale-interval", type=float, default=0.1)
+    parser.add_argument("--events-per-second", type=float, default=200)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--nitro-latency", type=float, default=0.002,
+                        help="seconds of NetScaler latency per request")
+    parser.add_argument("--platform-latency", type=float, default=0.001)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--quiet-period", type=float, default=0.5)
+    parser.add_argument("--max-delay", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=60,
+                        help="seconds to wait for the NetScaler to converge")
+    parser.add_argument("--json", help="also write the results to a file")
+    parser.add_argument("--verbose", action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.CRITICAL)
+
+    results = []
+    print(' '.join(fmt % name for name, fmt in COLUMNS))
+    for platform in args.platforms.split(','):
+        for scenario in args.scenarios.split(','):
+            try:
+                rows = SCENARIOS[scenario](PLATFORMS[platform], args)
+            except ImportError as e:
+                print("%-10s %-8s skipped: %s" % (platform, scenario, e))
+                continue
+            for row in rows:
+                row['platform'] = platform
+                results.append(row)
+                print(' '.join(fmt % row.get(name, '')
+                               for name, fmt in COLUMNS))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'results': results}, f,
+                      indent=2, sort_keys=True)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+import metrics
+
+
+logger = logging.getLogger('docker_netscaler')
+
+
+class EventCoalescer(object):
+    """Collapses bursts of platform events into one reconciliation per app.
+
+    Every event for an app replaces the pending reconciliation for that
+    app. The reconciliation runs once no event has arrived for
+    `quiet_period` seconds, or `max_delay` seconds after the first event
+    of the burst, whichever comes first. Reconciliations run on a
+    background thread, or on a ReconcilePool if one is given, so they
+    always see the latest platform state.
+    """
+
+    def __init__(self, quiet_period=0.5, max_delay=5.0, pool=None):
+        """Constructor
+
+        :param float quiet_period: seconds without events before an app is
+            reconciled
+        :param float max_delay: upper bound in seconds between the first
+            event of a burst and its reconciliation
+        :param ReconcilePool pool: runs reconciliations of different apps
+            concurrently (optional)
+        """
+        self.quiet_period = quiet_period
+        self.max_delay = max(max_delay, quiet_period)
+        self.pool = pool
+        self.events_received = 0
+        self.reconciliations = 0
+        self.errors = 0
+        self._pending = {}  # key -> [first_seen, last_seen, func, args]
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='EventCoalescer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, key, func, *args):
+        """Schedule func(*args) to reconcile `key` (usually the app name)"""
+        now = time.time()
+        with self._cond:
+            self.events_received += 1
+            pending = self._pending.get(key)
+            if pending is None:
+                self._pending[key] = [now, now, func, args]
+            else:
+                pending[1:] = [now, func, args]
+                metrics.EVENTS_COALESCED.inc()
+            self._cond.notify()
+
+    def _due(self, pending):
+        first, last = pending[0], pending[1]
+        return min(last + self.quiet_period, first + self.max_delay)
+
+    def _next_batch(self):
+        """Wait for and remove the pending reconciliations that are due"""
+        with self._cond:
+            while not self._stopped:
+                now = time.time()
+                due = [k for k, p in self._pending.items()
+                       if self._due(p) <= now]
+                if due:
+                    return [(k, self._pending.pop(k)) for k in due]
+                if self._pending:
+                    wait = min(self._due(p) for p in
+                               self._pending.values()) - now
+                    self._cond.wait(max(wait, 0.01))
+                else:
+                    self._cond.wait()
+            return None
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            for key, (first, last, func, args) in batch:
+                if self.pool is not None:
+                    self.pool.submit(key, self._reconcile, key, first,
+                                     func, args)
+                else:
+                    self._reconcile(key, first, func, args)
+            logger.debug("Coalescer stats: %s" % self.stats())
+
+    def _reconcile(self, key, first, func, args):
+        logger.debug("Reconciling %s, %.3fs after first event" %
+                     (key, time.time() - first))
+        try:
+            func(*args)
+        except Exception as e:
+            with self._cond:
+                self.errors += 1
+            logger.error("Reconciliation of %s failed: %s" % (key, e))
+        with self._cond:
+            self.reconciliations += 1
+
+    def stats(self):
+        with self._cond:
+            return {'events_received': self.events_received,
+                    'reconciliations': self.reconciliations,
+                    'pending': len(self._pending),
+                    'errors': self.errors}
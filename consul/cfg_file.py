@@ -2,22 +2,88 @@ import argparse
 import os
 import json
 import logging
+import time
+
+from driver import PlatformDriver, backend_weight
 
 
 logger = logging.getLogger('docker_netscaler')
 
 
-class ConfigFileDriver(object):
+class ConfigFileDriver(PlatformDriver):
     """Uses a config file to drive Nitro APIs"""
 
-    def __init__(self, netskaler, filename):
+    platform = 'consul-template'
+
+    def __init__(self, app_info, filename, watch_file=False,
+                 poll_interval=1.0):
         """Constructor
 
         :param str filename: config filename
+        :param bool watch_file: keep watching the file for new renders
+        :param float poll_interval: seconds between checks of the file for
+            a new render, when watching
         """
-        self.netskaler = netskaler
+        PlatformDriver.__init__(self, app_info)
         self.filename = filename
-        self.cfg_json = json.load(open(self.filename))
+        self.watch_file = watch_file
+        self.poll_interval = poll_interval
+        # servicename -> list of (host, port, weight), from the last good
+        # render
+        self.services = {}
+        self.signature = None
+        self.load()
+
+    def _signature(self):
+        """(inode, size, mtime) of the file; consul-template renames a new
+        render into place, so at least the inode changes"""
+        st = os.stat(self.filename)
+        return st.st_ino, st.st_size, st.st_mtime
+
+    def load(self):
+        """Read the file and index it by service name
+
+        :returns: names of the services whose backends changed since the
+            last render, or None if the file could not be read (the last
+            good render is kept)
+        :rtype: set
+        """
+        try:
+            signature = self._signature()
+            with open(self.filename) as f:
+                cfg_json = json.load(f)
+        except (IOError, OSError) as e:
+            logger.warn("Cannot load %s: %s" % (self.filename, e))
+            return None
+        except ValueError as e:
+            # partially written; not looked at again until it changes
+            self.signature = signature
+            logger.warn("Cannot load %s: %s" % (self.filename, e))
+            return None
+        services = dict((svc['servicename'],
+                         [(b['host'], b['port'],
+                           backend_weight(b.get('weight')))
+                          for b in svc['backends']])
+                        for svc in cfg_json)
+        changed = set(name for name in set(services) | set(self.services)
+                      if set(services.get(name, [])) !=
+                      set(self.services.get(name, [])))
+        self.services = services
+        self.signature = signature
+        return changed
+
+    def reload_if_changed(self):
+        """Load the file if it has been rendered again
+
+        :returns: names of the services whose backends changed
+        :rtype: set
+        """
+        try:
+            if self._signature() == self.signature:
+                return set()
+        except OSError:
+            return set()  # being replaced, look again at the next poll
+        return self.load() or set()
 
     def get_backends_for_app(self, appid):
         """Get host endpoints for apps
@@ -25,16 +91,27 @@ class ConfigFileDriver(object):
         :returns: endpoints list of tuples
         :rtype: list
         """
-        for svc in self.cfg_json:
-            if svc["servicename"] == appid:
-                return [(b['host'], b['port'])
-                        for b in svc['backends']]
-        return []
+        return self.services.get(appid, [])
+
+    def backends(self, appname):
+        return self.get_backends_for_app(appname)
+
+    def stream_changes(self):
+        if not self.watch_file:
+            return iter(())
+        return PlatformDriver.stream_changes(self)
 
-    def configure_ns_for_app(self, appname):
-        backends = self.get_backends_for_app(appname)
-        logger.debug("Backends for %s are %s" % (appname, str(backends)))
-        self.netskaler.configure_app(appname, backends)
+    def watch(self):
+        """Poll the file for new renders and report only the apps whose
+        backends changed. Blocks forever."""
+        appnames = set(self.appnames)
+        while True:
+            time.sleep(self.poll_interval)
+            changed = self.reload_if_changed() & appnames
+            if changed:
+                logger.info("Backends changed for %s" % sorted(changed))
+                for appname in sorted(changed):
+                    self.changed(appname)
 
 
 if __name__ == "__main__":
@@ -48,7 +125,7 @@ if __name__ == "__main__":
     app_info = json.loads(os.environ['APP_INFO'])
     appnames = map(lambda x: x['name'], app_info['apps'])
 
-    cfg_file_driver = ConfigFileDriver(None, result.cfg_file)
+    cfg_file_driver = ConfigFileDriver(app_info, result.cfg_file)
     for app in appnames:
         endpoints = cfg_file_driver.get_backends_for_app(app)
         logger.info("Endpoints for app " + app + ": " + str(endpoints))
@@ -0,0 +1,190 @@
+import argparse
+import os
+import json
+import logging
+import threading
+import time
+import requests
+import requests.adapters
+import requests.exceptions
+
+import metrics
+from driver import PlatformDriver, backend_weight
+
+
+logger = logging.getLogger('docker_netscaler')
+
+
+class ConsulInterface(PlatformDriver):
+    """Interface for the Consul health API.
+
+    Each app is a Consul service whose passing instances are its backends,
+    weighted by their Consul `Weights.Passing`.
+    One blocking query per service waits for its X-Consul-Index to move past
+    the last one seen, so nothing is polled and a service is only
+    reconfigured when its index advanced and its instances changed.
+    """
+
+    platform = 'consul'
+
+    def __init__(self, server, app_info, token=None, datacenter=None,
+                 wait=300):
+        """Constructor
+
+        :param server: Consul URL (e.g., 'http://consul:8500/' )
+        :param str token: ACL token (optional)
+        :param str datacenter: datacenter to query, the agent's if None
+        :param int wait: seconds a blocking query waits for a change
+        """
+        PlatformDriver.__init__(self, app_info)
+        self.server = server.rstrip('/') + '/'
+        self.datacenter = datacenter
+        self.wait = wait
+        # every watched service keeps a connection busy with its blocking
+        # query, so the pool needs one connection per app
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=max(10, len(app_info['apps'])))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if token:
+            self.session.headers.update({'X-Consul-Token': token})
+        # app name -> X-Consul-Index and backends of the last response
+        self.indexes = {}
+        self.app_backends = {}
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.changes = 0
+
+    def query(self, appname, index=0):
+        """Get the passing instances of a service. With an index this is a
+        blocking query that returns once the service changes past it, or
+        after `wait` seconds.
+
+        :returns: (X-Consul-Index, sorted list of (address, port, weight))
+        :rtype: tuple
+        """
+        params = {'passing': 'true'}
+        if index:
+            params['index'] = index
+            params['wait'] = '%ds' % self.wait
+        if self.datacenter:
+            params['dc'] = self.datacenter
+        with self.lock:
+            self.queries += 1
+        # Consul adds up to wait/16 of jitter to the wait
+        response = self.session.get(self.server + 'v1/health/service/' +
+                                    appname,
+                                    params=params,
+                                    timeout=(10, self.wait * 17 / 16 + 10))
+        response.raise_for_status()
+        backends = set()
+        for entry in response.json():
+            address = entry['Service'].get('Address') or \
+                entry['Node']['Address']
+            weights = entry['Service'].get('Weights') or {}
+            backends.add((address, entry['Service']['Port'],
+                          backend_weight(weights.get('Passing'))))
+        return (int(response.headers.get('X-Consul-Index', 0)),
+                sorted(backends))
+
+    def update(self, appname, index, backends):
+        """Record the result of a query
+
+        :returns: True if the backends of the app changed
+        """
+        with self.lock:
+            last = self.indexes.get(appname, 0)
+            if index < last:
+                # the index went backwards (e.g., the Consul servers were
+                # restored); start over with a non-blocking query
+                logger.info("Consul index of %s went back from %d to %d" %
+                            (appname, last, index))
+                self.indexes[appname] = 0
+            else:
+                self.indexes[appname] = max(index, 1)
+            if appname in self.app_backends and \
+                    (index == last or self.app_backends[appname] == backends):
+                return False
+            self.app_backends[appname] = backends
+            self.changes += 1
+            return True
+
+    def refresh(self, appname):
+        """Query a service without blocking and record the result
+
+        :returns: True on success
+        """
+        try:
+            index, backends = self.query(appname)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.error('Error while querying Consul for %s: %s' %
+                         (appname, e))
+            return False
+        self.update(appname, index, backends)
+        return True
+
+    def get_backends_for_app(self, appname):
+        """Get host endpoints for apps
+
+        :returns: list of (address, port, weight)
+        :rtype: list
+        """
+        with self.lock:
+            backends = self.app_backends.get(appname)
+        if backends is None and self.refresh(appname):
+            with self.lock:
+                backends = self.app_backends.get(appname)
+        return list(backends or [])
+
+    def backends(self, appname):
+        return self.get_backends_for_app(appname)
+
+    def watch_app(self, appname):
+        """Blocking query loop for one service. Blocks forever."""
+        failures = 0
+        while True:
+            with self.lock:
+                index = self.indexes.get(appname, 0)
+            try:
+                index, backends = self.query(appname, index)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                failures += 1
+                metrics.WATCH_RECONNECTS.inc(platform=self.platform)
+                logger.warn("Consul query for %s failed: %s" % (appname, e))
+                time.sleep(min(30, 2 ** failures))
+                continue
+            failures = 0
+            if self.update(appname, index, backends):
+                logger.info("Backends of app %s changed, index=%d" %
+                            (appname, index))
+                self.changed(appname)
+
+    def watch(self):
+        """One blocking query loop per app. Blocks forever."""
+        threads = []
+        for appname in self.appnames:
+            t = threading.Thread(target=self.watch_app, args=(appname,),
+                                 name='Consul-%s' % appname)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Process Consul args')
+    parser.add_argument("--consul-url", required=True, dest='consul_url')
+
+    result = parser.parse_args()
+
+    # '{"apps": [{"name": "foo"}, {"name": "bar"}]}'
+    app_info = json.loads(os.environ['APP_INFO'])
+    appnames = [x['name'] for x in app_info['apps']]
+
+    consul = ConsulInterface(result.consul_url, app_info)
+    for app in appnames:
+        endpoints = consul.get_backends_for_app(app)
+        logger.info("Endpoints for app " + app + ": " + str(endpoints))
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+
+class DrainTracker(object):
+    """Service group members being drained.
+
+    A drained member is disabled on the NetScaler with a graceful delay
+    instead of being unbound, and unbound by a later sweep once the
+    NetScaler reports it out of service or `timeout` seconds have passed.
+    Only the members tracked here are Nitrox's drains; other disabled
+    members were disabled by an operator. The NetScaler keeps the members
+    disabled, so drains that were pending when Nitrox stopped are found
+    again as the disabled members that are no longer wanted when their
+    service groups are read; their timeout starts again from then.
+    """
+
+    def __init__(self, timeout=0):
+        """Constructor
+
+        :param int timeout: seconds a member drains before it is unbound
+            anyway; 0 disables draining
+        """
+        self.timeout = timeout
+        self.drained = 0
+        self._groups = {}  # service group -> {(ip, port): started}
+        self._weights = {}  # service group -> {(ip, port): weight}
+        self._apps = {}  # service group -> app
+        self._lock = threading.Lock()
+
+    def add(self, grpname, app, member, started=None, weight=None):
+        """Track a member being drained, unless it already is
+
+        :param weight: the member's weight, if known
+        """
+        with self._lock:
+            self._apps[grpname] = app
+            self._groups.setdefault(grpname, {}).setdefault(
+                member, started or time.time())
+            if weight is not None:
+                self._weights.setdefault(grpname, {})[member] = weight
+
+    def discard(self, grpname, member, drained=False):
+        """Stop tracking a member, unbound (drained) or back in service"""
+        with self._lock:
+            members = self._groups.get(grpname, {})
+            if members.pop(member, None) is not None and drained:
+                self.drained += 1
+            self._weights.get(grpname, {}).pop(member, None)
+            if not members:
+                self._groups.pop(grpname, None)
+                self._weights.pop(grpname, None)
+                self._apps.pop(grpname, None)
+
+    def draining(self, grpname):
+        """:returns: set of (ip, port) being drained from a service group"""
+        with self._lock:
+            return set(self._groups.get(grpname, {}))
+
+    def members(self, grpname):
+        """:returns: set of (ip, port, weight), or (ip, port) if the
+            weight is not known, being drained from a service group"""
+        with self._lock:
+            weights = self._weights.get(grpname, {})
+            return set(m + (weights[m],) if m in weights else m
+                       for m in self._groups.get(grpname, {}))
+
+    def expired(self, grpname, member):
+        """True if a member has drained for longer than the timeout"""
+        with self._lock:
+            started = self._groups.get(grpname, {}).get(member)
+            return started is not None and \
+                time.time() - started >= self.timeout
+
+    def expired_members(self, grpname):
+        return set(m for m in self.draining(grpname)
+                   if self.expired(grpname, m))
+
+    def by_app(self):
+        """:returns: app -> service groups with members being drained"""
+        with self._lock:
+            apps = {}
+            for grpname in self._groups:
+                apps.setdefault(self._apps[grpname], []).append(grpname)
+            return apps
+
+    def stats(self):
+        with self._lock:
+            return {'groups': len(self._groups),
+                    'draining': sum(len(m) for m in self._groups.values()),
+                    'drained': self.drained}
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+import metrics
+
+
+logger = logging.getLogger('docker_netscaler')
+
+# weights a NetScaler accepts for a service group member
+MIN_WEIGHT = 1
+MAX_WEIGHT = 100
+
+
+def backend_weight(value, default=MIN_WEIGHT):
+    """Weight of a backend from platform metadata (a label, a count of
+    pods, ...), clamped to what the NetScaler accepts
+
+    :returns: default if value is not a number
+    """
+    try:
+        weight = int(float(value))
+    except (TypeError, ValueError):
+        return default
+    return max(MIN_WEIGHT, min(MAX_WEIGHT, weight))
+
+
+class PlatformDriver(object):
+    """Base class of the container platform drivers.
+
+    A driver only reads its platform; the Reconciler pushes what it reads
+    to the NetScaler. Drivers implement:
+
+    - `backends(appname)`: the current backends of an app, a list of
+      (ip, port) or (ip, port, weight), or for an app that declares
+      `ports`, a dict of port name -> list of them. The weight is the
+      member's share of the traffic, 1 if not given
+    - `snapshot()`: the backends of every app, read as cheaply as the
+      platform allows (the default asks `backends` for each app)
+    - `stream_changes()`: yields the names of apps whose backends may have
+      changed, forever. The default runs `watch` on a thread and yields
+      the names it passes to `changed`, which suits drivers driven by
+      callbacks or several threads.
+    """
+    platform = None  # label of the driver's metrics
+
+    def __init__(self, app_info):
+        """Constructor
+
+        :param app_info: '{"apps": [{"name": "foo"}, {"name": "bar"}]}'
+        """
+        self.app_info = app_info
+        self.appnames = [x['name'] for x in app_info['apps']]
+        self.apps = dict((x['name'], x) for x in app_info['apps'])
+        self._changes = queue.Queue()
+        # app name -> time of the oldest change not yet reconciled
+        self._first_change = {}
+        self._lock = threading.Lock()
+
+    def ports(self, appname):
+        """Ports declared for an app, None if it has one (unnamed) port"""
+        return self.apps.get(appname, {}).get('ports') or None
+
+    def backends(self, appname):
+        raise NotImplementedError()
+
+    def snapshot(self):
+        """:returns: app name -> backends, for every app
+        :rtype: dict
+        """
+        return dict((appname, self.backends(appname))
+                    for appname in self.appnames)
+
+    def changed(self, appname):
+        """Report that the backends of an app may have changed"""
+        if appname not in self.apps:
+            metrics.EVENTS_DROPPED.inc(platform=self.platform)
+            return
+        metrics.EVENTS_RECEIVED.inc(platform=self.platform)
+        with self._lock:
+            self._first_change.setdefault(appname, time.time())
+        self._changes.put(appname)
+
+    def take_change_time(self, appname):
+        """Time of the oldest change reported for an app since the last
+        call, None if there was none. Called before reading the backends,
+        so later changes count towards the next reconciliation."""
+        with self._lock:
+            return self._first_change.pop(appname, None)
+
+    def restore_change_time(self, appname, since):
+        """Put back the change time taken for a reconciliation that
+        failed, so that the one that succeeds is measured from it"""
+        if since is None:
+            return
+        with self._lock:
+            if since < self._first_change.get(appname, since + 1):
+                self._first_change[appname] = since
+
+    def queue_depth(self):
+        """Changes reported but not yet taken by stream_changes"""
+        return self._changes.qsize()
+
+    def changed_all(self):
+        """Report every app, e.g., after events may have been missed"""
+        for appname in self.appnames:
+            self.changed(appname)
+
+    def watch(self):
+        """Call `changed` for every change, forever"""
+        raise NotImplementedError()
+
+    def stream_changes(self):
+        t = threading.Thread(target=self._watch,
+                             name='%sWatch' % self.__class__.__name__)
+        t.daemon = True
+        t.start()
+        while True:
+            # a timeout keeps the main thread interruptible on Python 2
+            try:
+                appname = self._changes.get(timeout=60)
+            except queue.Empty:
+                if not t.is_alive():
+                    return
+                continue
+            if appname is None:
+                return
+            yield appname
+
+    def _watch(self):
+        try:
+            self.watch()
+        except Exception as e:
+            logger.error("%s stopped watching: %s" %
+                         (self.__class__.__name__, e))
+        finally:
+            self._changes.put(None)
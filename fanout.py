@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+import metrics
+from workers import KeyedLock
+
+
+logger = logging.getLogger('docker_netscaler')
+
+
+class CircuitBreaker(object):
+    """Holds back changes to a NetScaler that keeps failing.
+
+    The circuit opens after `threshold` consecutive failures. Once it has
+    been open for `reset_timeout` seconds a single trial call is let
+    through (half-open), which closes the circuit if it succeeds and opens
+    it again if it fails.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=3, reset_timeout=30):
+        self.threshold = max(1, int(threshold))
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go through"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and \
+                    time.time() - self.opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        """:returns: True if this closed the circuit"""
+        with self._lock:
+            closed = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.failures = 0
+            return closed
+
+    def failure(self):
+        """:returns: True if this opened the circuit"""
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+                    (self.state == self.CLOSED and
+                     self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened = time.time()
+                return True
+            return False
+
+
+class NetscalerTarget(object):
+    """One NetScaler (or HA pair) of a fan-out"""
+
+    def __init__(self, netskaler, breaker):
+        # the address the target was configured with; the sessions may
+        # have moved to another node of the pair since
+        self.name = netskaler.nsip
+        self.netskaler = netskaler
+        self.breaker = breaker
+        self.pending = set()  # apps whose last change was not applied
+        self.latency = None  # seconds the last change took
+        self.failovers = 0
+        self.lock = threading.Lock()
+
+
+class NetscalerFanout(object):
+    """Applies the same changes to several NetScalers in parallel, e.g.,
+    one HA pair per availability zone.
+
+    Each target is a NetscalerInterface with its own session pool, state
+    cache and drains, so every target is diffed against its own state.
+    A change that fails on a target is retried up to `retries` times,
+    following the HA primary in between. After `breaker_threshold`
+    failed changes in a row the circuit to the target opens and its
+    changes are held back; a health check every `check_interval` seconds
+    follows the HA primary and, once the target answers again, applies
+    the latest change of every app it missed.
+    """
+
+    def __init__(self, netskalers, retries=2, retry_delay=1,
+                 breaker_threshold=3, breaker_reset=30, check_interval=30,
+                 configure_frontends=False):
+        """Constructor
+
+        :param netskalers: NetscalerInterface per target, created with
+            raise_errors=True so that failures can be retried
+        :param int retries: times a failed change is retried per target
+        :param float retry_delay: seconds before the first retry, doubled
+            for each one after
+        :param int breaker_threshold: failed changes in a row after which
+            a target is skipped
+        :param float breaker_reset: seconds a target is skipped before it
+            is tried again
+        :param float check_interval: seconds between health checks
+        :param bool configure_frontends: create the apps' lbvservers on
+            every target
+        """
+        self.targets = [NetscalerTarget(n, CircuitBreaker(breaker_threshold,
+                                                          breaker_reset))
+                        for n in netskalers]
+        self.retries = max(0, int(retries))
+        self.retry_delay = retry_delay
+        self.check_interval = check_interval
+        self.drain_timeout = max(n.drain_timeout for n in netskalers)
+        self._changes = {}  # app -> (method, args) of its last change
+        self._lock = threading.Lock()
+        self._app_locks = KeyedLock()  # (target, app)
+        self._stopped = threading.Event()
+        for target in self.targets:
+            metrics.TARGET_CIRCUIT_OPEN.set_function(
+                lambda b=target.breaker: int(b.state != CircuitBreaker.CLOSED),
+                target=target.name)
+        self._each(self._check)
+        if configure_frontends:
+            self._fan_out(None, 'configure_frontends')
+        t = threading.Thread(target=self._health_checks,
+                             name='NetscalerHealth')
+        t.daemon = True
+        t.start()
+
+    def _each(self, func):
+        """Call func(target) for every target in parallel, the first on
+        the calling thread"""
+        threads = []
+        for target in self.targets[1:]:
+            t = threading.Thread(target=func, args=(target,),
+                                 name='Fanout-%s' % target.name)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        func(self.targets[0])
+        for t in threads:
+            t.join()
+
+    def _fan_out(self, app, method, *args):
+        """Call a method of every target's NetscalerInterface. The call
+        is remembered as the app's last change, if it is for an app, so
+        that targets that miss it get it later.
+
+        :returns: names of the targets the change was not applied to
+        """
+        if app is not None:
+            with self._lock:
+                self._changes[app] = (method, args)
+        failed = []
+        self._each(lambda target: self._apply(target, app, method, args) or
+                   failed.append(target.name))
+        return failed
+
+    def _follow(self, target):
+        """Follow the HA primary of a target.
+
+        :returns: True if the sessions moved to another node
+        """
+        with target.lock:
+            moved = target.netskaler.follow_primary()
+        if moved:
+            target.failovers += 1
+            metrics.TARGET_FAILOVERS.inc(target=target.name)
+            logger.info("NetScaler %s: primary is now %s" %
+                        (target.name, target.netskaler.nsip))
+        return moved
+
+    def _call(self, target, method, args):
+        """Call a method of a target, retrying failures"""
+        for attempt in range(self.retries + 1):
+            try:
+                return getattr(target.netskaler, method)(*args)
+            except Exception as e:
+                if attempt == self.retries:
+                    raise
+                logger.warn("%s on NetScaler %s failed (attempt %d of %d): "
+                            "%s" % (method, target.name, attempt + 1,
+                                    self.retries + 1, e))
+            time.sleep(self.retry_delay * 2 ** attempt)
+            try:
+                self._follow(target)
+            except Exception as e:
+                logger.debug("Cannot follow the HA primary of %s: %s" %
+                             (target.name, e))
+
+    def _pending(self, target, app, missed):
+        """Record whether a target missed the last change of an app"""
+        if app is None:
+            return
+        with self._lock:
+            if missed:
+                target.pending.add(app)
+            else:
+                target.pending.discard(app)
+
+    def _apply(self, target, app, method, args):
+        """Apply a change to one target, unless its circuit is open.
+
+        :returns: True if the change was applied
+        """
+        if not target.breaker.allow():
+            self._pending(target, app, True)
+            metrics.TARGET_SKIPPED.inc(target=target.name)
+            logger.debug("Circuit to NetScaler %s is open, holding back %s"
+                         " of %s" % (target.name, method, app))
+            return False
+        lock = self._app_locks((target.name, app)) if app is not None \
+            else None
+        start = time.time()
+        try:
+            if lock is not None:
+                lock.acquire()
+                # the app's latest change, which may be newer when this
+                # applies a change the target missed
+                with self._lock:
+                    method, args = self._changes[app]
+            self._call(target, method, args)
+        except Exception as e:
+            metrics.TARGET_APPLY_FAILURES.inc(target=target.name)
+            self._pending(target, app, True)
+            logger.error("%s of %s failed on NetScaler %s: %s" %
+                         (method, app, target.name, e))
+            if target.breaker.failure():
+                logger.error("Circuit to NetScaler %s is open, holding back"
+                             " its changes for %ss" %
+                             (target.name, target.breaker.reset_timeout))
+            return False
+        finally:
+            if lock is not None:
+                lock.release()
+            target.latency = time.time() - start
+            metrics.TARGET_APPLY_SECONDS.observe(target.latency,
+                                                 target=target.name)
+        self._pending(target, app, False)
+        if target.breaker.success():
+            logger.info("Circuit to NetScaler %s is closed" % target.name)
+        return True
+
+    def _check(self, target):
+        """Follow the HA primary of a target, which doubles as the trial
+        call of an open circuit, then apply the changes it missed"""
+        trial = target.breaker.state != CircuitBreaker.CLOSED
+        if trial and not target.breaker.allow():
+            return
+        try:
+            self._follow(target)
+        except Exception as e:
+            logger.warn("Health check of NetScaler %s failed: %s" %
+                        (target.name, e))
+            if trial:
+                target.breaker.failure()
+            return
+        if trial and target.breaker.success():
+            logger.info("Circuit to NetScaler %s is closed" % target.name)
+        with self._lock:
+            pending = sorted(target.pending)
+        for app in pending:
+            logger.info("Applying the last change of %s to NetScaler %s" %
+                        (app, target.name))
+            if not self._apply(target, app, None, None):
+                break
+
+    def _health_checks(self):
+        while not self._stopped.wait(self.check_interval):
+            self._each(self._check)
+
+    def configure_app(self, lbname, srvrs):
+        """:returns: True if the backends are configured on every target"""
+        return not self._fan_out(lbname, 'configure_app', lbname, srvrs)
+
+    def configure_app_ports(self, appname, port_backends):
+        return not self._fan_out(appname, 'configure_app_ports', appname,
+                                 port_backends)
+
+    def load_baseline(self, desired):
+        self._fan_out(None, 'load_baseline', desired)
+
+    def clear_baseline(self):
+        for target in self.targets:
+            target.netskaler.clear_baseline()
+
+    def draining_apps(self):
+        """:returns: app -> service groups with members being drained on
+            any target"""
+        apps = {}
+        for target in self.targets:
+            for app, grpnames in target.netskaler.draining_apps().items():
+                apps.setdefault(app, set()).update(grpnames)
+        return dict((app, sorted(g)) for app, g in apps.items())
+
+    def sweep_drains(self, grpnames):
+        self._fan_out(None, 'sweep_drains', grpnames)
+
+    def plan(self, desired):
+        """Compute a plan against the first target that can be read. The
+        same plan is applied to every target by `apply_plan`; changes
+        that do not apply to a target's state are reported as failed
+        operations there.
+
+        :rtype: ChangePlan
+        """
+        for target in self.targets:
+            if not target.breaker.allow():
+                continue
+            try:
+                plan = self._call(target, 'plan', (desired,))
+            except Exception as e:
+                logger.error("Cannot plan against NetScaler %s: %s" %
+                             (target.name, e))
+                target.breaker.failure()
+                continue
+            target.breaker.success()
+            return plan
+        raise RuntimeError("No NetScaler could be read to plan against")
+
+    def apply_plan(self, plan):
+        """Apply a plan to every target. A plan is applied once, so the
+        targets it was not applied to are not caught up later.
+
+        :raises RuntimeError: if the plan was not applied to a target
+        """
+        failed = self._fan_out(None, 'apply_plan', plan)
+        if failed:
+            raise RuntimeError("Plan not applied to NetScaler %s" %
+                               ', '.join(sorted(failed)))
+
+    def session_stats(self):
+        return dict((t.name, t.netskaler.session_stats())
+                    for t in self.targets)
+
+    def stats(self):
+        return dict((t.name, {'address': t.netskaler.nsip,
+                              'circuit': t.breaker.state,
+                              'pending': len(t.pending),
+                              'failovers': t.failovers,
+                              'latency': t.latency})
+                    for t in self.targets)
+
+    def shutdown(self):
+        self._stopped.set()
+        for target in self.targets:
+            target.netskaler.shutdown()
@@ -0,0 +1,192 @@
+"""
+List/watch cache of Kubernetes objects
+"""
+import json
+import logging
+import threading
+import time
+import requests
+import requests.exceptions
+
+import metrics
+
+
+logger = logging.getLogger('docker_netscaler')
+
+# seconds the apiserver keeps a watch open before we re-establish it
+WATCH_TIMEOUT = 300
+
+
+class Expired(Exception):
+    """The resourceVersion we are watching from is too old (HTTP 410)"""
+
+
+class Informer(object):
+    """
+    Keeps an in-memory copy of one kind of object (e.g., endpoints).
+
+    The store is filled with a list call and kept up to date with a watch
+    from the list's resourceVersion. A dropped watch is resumed from the
+    last resourceVersion seen (including bookmarks); if that version has
+    expired the objects are listed again and the differences are reported
+    as events, so no change is missed.
+    """
+
+    def __init__(self, client, resource, namespace='default',
+                 label_selector=None, field_selector=None, names=None,
+                 on_change=None):
+        """Constructor
+
+        :Parameters:
+           - `client`: K8sClient
+           - `resource`: plural resource name, e.g. 'endpoints'
+           - `namespace`: namespace to watch, None for cluster-scoped
+             resources such as nodes
+           - `label_selector`: only list/watch objects with these labels
+           - `field_selector`: e.g. 'metadata.name=frontend'
+           - `names`: only keep and report the objects with these names,
+             e.g. the services of the apps in a namespace watch
+           - `on_change`: called as on_change(event_type, obj) for every
+             ADDED, MODIFIED or DELETED object
+        """
+        self.client = client
+        self.resource = resource
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self.names = set(names) if names is not None else None
+        self.on_change = on_change
+        self.resource_version = None
+        self.synced = threading.Event()
+        self.relists = 0
+        self.reconnects = 0
+        self._store = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def get(self, name):
+        with self._lock:
+            return self._store.get(name)
+
+    def items(self):
+        with self._lock:
+            return list(self._store.values())
+
+    def _request(self, **params):
+        if self.label_selector:
+            params['labelSelector'] = self.label_selector
+        if self.field_selector:
+            params['fieldSelector'] = self.field_selector
+        kwargs = {'url': '/' + self.resource, 'params': params}
+        if self.namespace is not None:
+            kwargs['namespace'] = self.namespace
+        if params.get('watch'):
+            kwargs['stream'] = True
+            kwargs['timeout'] = (10, WATCH_TIMEOUT + 30)
+        response = self.client.get(**kwargs)
+        if response.status_code == 410:
+            raise Expired()
+        response.raise_for_status()
+        return response
+
+    def _wanted(self, name):
+        return self.names is None or name in self.names
+
+    def _notify(self, event_type, obj):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(event_type, obj)
+        except Exception as e:
+            logger.error("Error handling %s %s event: %s" %
+                         (self.resource, event_type, e))
+
+    def list(self):
+        """Replace the store with a fresh list, reporting the differences"""
+        response = self._request()
+        body = response.json()
+        fresh = dict((o['metadata']['name'], o) for o in body['items']
+                     if self._wanted(o['metadata']['name']))
+        with self._lock:
+            old = self._store
+            self._store = fresh
+            self.resource_version = body['metadata']['resourceVersion']
+        for name, obj in fresh.items():
+            previous = old.get(name)
+            if previous is None:
+                self._notify('ADDED', obj)
+            elif previous['metadata'].get('resourceVersion') != \
+                    obj['metadata'].get('resourceVersion'):
+                self._notify('MODIFIED', obj)
+        for name, obj in old.items():
+            if name not in fresh:
+                self._notify('DELETED', obj)
+        self.synced.set()
+        logger.debug("Listed %d %s at resourceVersion %s" %
+                     (len(fresh), self.resource, self.resource_version))
+
+    def watch(self):
+        """Apply watch events until the apiserver closes the stream"""
+        response = self._request(watch='true',
+                                 resourceVersion=self.resource_version,
+                                 allowWatchBookmarks='true',
+                                 timeoutSeconds=WATCH_TIMEOUT)
+        # lines as each chunk arrives, not once 512 bytes have been read
+        for line in response.iter_lines(chunk_size=None):
+            if not line:
+                continue
+            event = json.loads(line)
+            event_type = event['type']
+            obj = event['object']
+            if event_type == 'ERROR':
+                if obj.get('code') == 410:
+                    raise Expired()
+                raise requests.exceptions.RequestException(
+                    obj.get('message'))
+            name = obj['metadata'].get('name')  # bookmarks have no name
+            with self._lock:
+                self.resource_version = obj['metadata']['resourceVersion']
+                if name is not None and not self._wanted(name):
+                    metrics.EVENTS_DROPPED.inc(platform='kubernetes')
+                    continue
+                if event_type == 'DELETED':
+                    self._store.pop(name, None)
+                elif event_type in ('ADDED', 'MODIFIED'):
+                    self._store[name] = obj
+            if event_type != 'BOOKMARK':
+                self._notify(event_type, obj)
+
+    def run(self):
+        failures = 0
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.list()
+                self.watch()
+                failures = 0
+                continue  # server side timeout, resume the watch
+            except Expired:
+                logger.info("Watch of %s expired at resourceVersion %s, "
+                            "listing again" %
+                            (self.resource, self.resource_version))
+                self.resource_version = None
+                self.relists += 1
+                continue
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warn("Watch of %s interrupted: %s" %
+                            (self.resource, e))
+            failures += 1
+            self.reconnects += 1
+            metrics.WATCH_RECONNECTS.inc(platform='kubernetes')
+            time.sleep(min(30, 2 ** failures))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run,
+                                        name='Informer-%s-%s' %
+                                        (self.resource, self.namespace))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def join(self):
+        self._thread.join()
@@ -4,7 +4,11 @@ import json
 import logging
 import requests
 import requests.exceptions
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
 from client import K8sClient
+from informer import Informer
+import metrics
+from driver import PlatformDriver, backend_weight
 # from pykube.config import KubeConfig
 # from pykube.http import HTTPClient
 
@@ -12,25 +16,48 @@ from client import K8sClient
 logger = logging.getLogger('docker_netscaler')
 
 
-class KubernetesInterface(object):
+class KubernetesInterface(PlatformDriver):
     """Interface for the Kubernetes REST API."""
 
-    def __init__(self, netskaler, app_info,
+    platform = 'kubernetes'
+
+    def __init__(self, app_info,
                  cfg_file=None, token=None, ca=None,
                  server=None, insecure=False):
         """Constructor
 
         :param str cfg_file: location of kubectl config (e.g., ~/.kube/config)
-        :param NetscalerInterface netskaler: Netscaler object
         :param app_info : dictionary of app names
         :param token: Auth (bearer) token
         :param server: Kubernetes URL (e.g., 'http://api-server:8080' )
         :param ca: certificate authority of kube api server
         :param insecure: whether to ignore certificate host mismatch
         """
+        PlatformDriver.__init__(self, app_info)
         self.cfg_file = cfg_file
-        self.netskaler = netskaler
-        self.app_info = app_info
+        # node name -> node IP, refreshed when an unknown node shows up
+        self.node_ips = {}
+        # (resource, namespace, labelSelector, fieldSelector) -> Informer,
+        # once start_informers has started them
+        self.informers = {}
+        # app name -> {'services': Informer, 'endpoints': Informer}
+        self.app_informers = {}
+        self.watching = False
+        # service annotation that weights the nodes by their ready pods
+        self.weight_key = app_info.get('weightkey', 'com.citrix.lb.weight')
+        """
+        apps may name the namespace of their service (default: 'default')
+        and a label selector shared by the services of several apps, which
+        then share one watch:
+        '{"apps": [{"name": "frontend", "namespace": "web",
+                    "selector": "nitrox=managed"}]}'
+        apps without a selector are watched by name, or by one watch of
+        their namespace once it has more than `namespacewatch` of them:
+        '{"namespacewatch": 50, "apps": [...]}'
+        apps with several service ports declare them by name (or port):
+        '{"apps": [{"name": "frontend",
+                    "ports": [{"name": "http"}, {"name": "grpc"}]}]}'
+        """
         self.insecure_tls_skip_verify = insecure
         self.client = K8sClient(cfg_file=cfg_file,
                                 url=server,
@@ -38,13 +65,13 @@ class KubernetesInterface(object):
                                 ca=ca,
                                 insecure_skip_tls_verify=insecure)
 
-    def _get(self, api, namespace='default'):
+    def _get(self, api, namespace='default', **kwargs):
         response = None
         success = True
+        if namespace is not None:
+            kwargs['namespace'] = namespace
         try:
-            # TODO:support other namespace
-            response = self.client.get(url=api,
-                                       namespace=namespace)
+            response = self.client.get(url=api, **kwargs)
         except requests.exceptions.RequestException as e:
             logger.error('Error while calling  %s:%s', api, e.message)
             success = False  # TODO: throw exception
@@ -66,89 +93,296 @@ class KubernetesInterface(object):
         # nodePorts.keys() has names of services that have NodePort
         return nodePorts
 
-    def get_backends_for_app(self, appid):
-        """Get host endpoints for apps (services)
+    def refresh_node_ips(self):
+        """Rebuild the node name -> node IP cache with a single list call"""
+        success, response = self._get('/nodes', namespace=None)
+        if not success:
+            return
+        node_ips = {}
+        for node in response.json()['items']:
+            addresses = dict((a['type'], a['address'])
+                             for a in node['status'].get('addresses', []))
+            ip = addresses.get('InternalIP') or \
+                addresses.get('LegacyHostIP') or addresses.get('ExternalIP')
+            if ip:
+                node_ips[node['metadata']['name']] = ip
+        self.node_ips = node_ips
 
-        :returns: list of endpoint (hostIp, port) tuples
-        :rtype: list
+    def _pod_host_ips(self, svc):
+        """Map pod name to host IP for the running pods selected by the
+        service, using one label-selected list call"""
+        selector = svc['spec'].get('selector')
+        if not selector:
+            return {}
+        label_selector = ','.join('%s=%s' % (k, v)
+                                  for k, v in sorted(selector.items()))
+        success, response = self._get('/pods',
+                                      namespace=svc['metadata'].get(
+                                          'namespace', 'default'),
+                                      params={'labelSelector':
+                                              label_selector})
+        if not success:
+            return {}
+        return dict((pod['metadata']['name'], pod['status'].get('hostIP'))
+                    for pod in response.json()['items']
+                    if pod['status'].get('phase') == 'Running')
+
+    def _node_port(self, appid, svc, port=None):
+        """nodePort of the service port declared for an app
+
+        :param dict port: declared port of the app, matched against the
+            service ports by name, then by port number; the first service
+            port if None
+        """
+        ports = svc['spec']['ports']
+        if port is not None:
+            ports = [p for p in ports if p.get('name') == port['name']] or \
+                [p for p in ports if p.get('port') == port.get('port')]
+            if not ports:
+                logger.warn("Service %s has no port %s" %
+                            (appid, port['name']))
+                return 0
+        nodePort = ports[0].get('nodePort', 0)
+        if nodePort == 0:
+            logger.warn("Service %s does not have a node port" % appid)
+        return nodePort
+
+    def _weighted(self, appid, svc):
+        """True if the nodes of a service are weighted by their ready
+        pods: the service's weight_key annotation is "pods" and its
+        externalTrafficPolicy is Local, so a node port only reaches the
+        pods of its node. Under the default policy kube-proxy spreads the
+        traffic over all pods anyway."""
+        annotations = svc['metadata'].get('annotations') or {}
+        if annotations.get(self.weight_key) != 'pods':
+            return False
+        if svc['spec'].get('externalTrafficPolicy') != 'Local':
+            logger.debug("Service %s is not weighted, its "
+                         "externalTrafficPolicy is not Local" % appid)
+            return False
+        return True
+
+    def _backends(self, hosts, nodePort, weighted):
+        """:returns: list of (hostIp, port) or, if weighted, (hostIp, port,
+            ready pods) tuples"""
+        if not weighted:
+            return [(host, nodePort) for host in hosts]
+        return [(host, nodePort, backend_weight(pods))
+                for host, pods in hosts.items()]
+
+    def _hosts(self, endpoints, pod_host_ips):
+        """Host IPs of the ready addresses of a service, and the number of
+        ready pods on each.
+
+        :param pod_host_ips: callable returning a pod name -> host IP dict,
+            used for addresses that have no nodeName
+        :returns: host IP -> ready pods
+        :rtype: dict
         """
-        backends = []
+        hosts = {}
+        addresses = [addr
+                     for subset in endpoints.get('subsets') or []
+                     for addr in subset.get('addresses') or []]
+        nodenames = set(addr.get('nodeName') for addr in addresses
+                        if addr.get('nodeName'))
+        if not self.informers and nodenames - set(self.node_ips):
+            self.refresh_node_ips()
+        host_ips = None
+        for addr in addresses:
+            host = self.node_ips.get(addr.get('nodeName'))
+            if host is None:
+                if host_ips is None:
+                    host_ips = pod_host_ips()
+                podname = (addr.get('targetRef') or {}).get('name')
+                host = host_ips.get(podname)
+            if host:
+                hosts[host] = hosts.get(host, 0) + 1
+        return hosts
+
+    def _service_objects(self, appid):
+        """(service, endpoints) of an app, None if either is missing
+
+        The hosts come from the nodeName of the ready addresses in the
+        service's Endpoints object and a cache of node IPs, so the cost does
+        not grow with the number of pods. Addresses without a nodeName
+        (older apiservers) are resolved with one label-selected pod list.
+        Once the informers are running this is a local lookup.
+        """
+        informers = self.app_informers.get(appid)
+        if self.watching and informers:
+            svc = informers['services'].get(appid)
+            endpoints = informers['endpoints'].get(appid)
+            if svc is None or endpoints is None:
+                logger.info("Service %s not found" % appid)
+                return None
+            return svc, endpoints
+        namespace = self._namespace(appid)
         api = '/services/' + appid
-        success, response = self._get(api)
+        success, response = self._get(api, namespace=namespace)
         if not success and response and response.status_code >= 300:
             status = response.json()
             if status['reason'] == 'NotFound':
                 logger.info("Service %s not found" % appid)
         if not success:
-            return backends
+            return None
         svc = response.json()
-        # node port is the backend port we need. Handle only 1 port for now
-        nodePort = svc['spec']['ports'][0]['nodePort']  # TODO
-        if nodePort == 0:
-            logger.warn("Service %s does not have a node port" % appid)
-            return backends
-        # find the endpoint for the service so that we can find its pods
-        api = '/endpoints'
-        success, endpoints = self._get(api)
+        # the endpoints of the service are the ready pods
+        api = '/endpoints/' + appid
+        success, response = self._get(api, namespace=namespace)
         if not success:
-            return backends
-        podnames = []
-        if endpoints.status_code == 200:
-            endpoints = endpoints.json()
-            for ep in endpoints['items']:
-                if ep['metadata']['name'] == appid:
-                    if ep['subsets']:
-                        podnames = [addr['targetRef']['name']
-                                    for addr in ep['subsets'][0]['addresses']]
-                    break
-        for p in podnames:
-            api = '/pods/' + p
-            success, response = self._get(api)
-            if not success:
-                continue
-            pod = response.json()
-            status = pod['status']['phase']
-            host = pod['status']['hostIP']
-            if status == 'Running':
-                backends.append((host, nodePort))
-        return list(set(backends))
-
-    def events(self, resource_version):
-        """Get event stream for k8s endpoints
+            return None
+        return svc, response.json()
+
+    def get_backends_for_app(self, appid):
+        """Get host endpoints for apps (services), on the first port of the
+        service
+
+        :returns: list of endpoint (hostIp, port) tuples, or (hostIp, port,
+            weight) for weighted services
+        :rtype: list
         """
-        url = self.client.url +\
-            "/v1/watch/namespaces/default/endpoints?" +\
-            "resourceVersion=%s&watch=true" % resource_version
-        evts = self.client.session.request('GET', url,
-                                           stream=True)
-        # TODO re-start the loop when disconnected from api server
-        for e in evts.iter_lines():
-            event_json = json.loads(e)
-            yield event_json
-
-    def watch_all_apps(self):
-        appnames = map(lambda x:  x['name'], self.app_info['apps'])
-        api = '/endpoints'
-        success, response = self._get(api)
-        if not success:
-            logger.error("Failed to watch for endpoint changes, exiting")
-            return
-        endpoints = response.json()
-        resource_version = endpoints['metadata']['resourceVersion']
-        for e in self.events(resource_version):
-            service_name = e['object']['metadata']['name']
-            if service_name in appnames:
-                self.configure_ns_for_app(service_name)
+        objects = self._service_objects(appid)
+        if objects is None:
+            return []
+        svc, endpoints = objects
+        nodePort = self._node_port(appid, svc)
+        if nodePort == 0:
+            return []
+        hosts = self._hosts(endpoints, lambda: self._pod_host_ips(svc))
+        return self._backends(hosts, nodePort, self._weighted(appid, svc))
+
+    def get_port_backends_for_app(self, appid):
+        """Get host endpoints for every port declared for an app
+
+        :returns: port name -> list of endpoint (hostIp, port) tuples, or
+            (hostIp, port, weight) for weighted services
+        :rtype: dict
+        """
+        ports = self.apps[appid]['ports']
+        objects = self._service_objects(appid)
+        if objects is None:
+            return dict((port['name'], []) for port in ports)
+        svc, endpoints = objects
+        hosts = self._hosts(endpoints, lambda: self._pod_host_ips(svc))
+        weighted = self._weighted(appid, svc)
+        result = {}
+        for port in ports:
+            nodePort = self._node_port(appid, svc, port)
+            result[port['name']] = \
+                self._backends(hosts, nodePort, weighted) if nodePort else []
+        return result
+
+    def _namespace(self, appname):
+        return self.apps.get(appname, {}).get('namespace', 'default')
+
+    def _on_app_object(self, event_type, obj):
+        """Service or endpoints of an app changed"""
+        if not self.watching:
+            return  # still starting, apps are configured once it is listed
+        name = obj['metadata']['name']
+        namespace = obj['metadata'].get('namespace', 'default')
+        if name in self.apps and self._namespace(name) == namespace:
+            self.changed(name)
+        else:
+            metrics.EVENTS_DROPPED.inc(platform=self.platform)
+
+    def _on_node(self, event_type, obj):
+        name = obj['metadata']['name']
+        addresses = dict((a['type'], a['address'])
+                         for a in obj['status'].get('addresses', []))
+        ip = addresses.get('InternalIP') or \
+            addresses.get('LegacyHostIP') or addresses.get('ExternalIP')
+        if event_type == 'DELETED':
+            ip = None
+        previous = self.node_ips.get(name)
+        if ip == previous:
+            return  # status heartbeat, nothing the NetScaler cares about
+        if ip is None:
+            self.node_ips.pop(name, None)
+        else:
+            self.node_ips[name] = ip
+        if previous is not None and self.watching:
+            self.changed_all()
+
+    def watch_scopes(self):
+        """Group apps into server side filtered watches: apps sharing a
+        namespace and label selector share a watch, an app without a
+        selector gets a watch on its own name. Once a namespace has more
+        than `namespacewatch` apps without a selector they share one watch
+        of the namespace instead, which the informer filters by name.
+
+        :returns: (namespace, labelSelector, fieldSelector) -> app names
+        :rtype: dict
+        """
+        threshold = self.app_info.get('namespacewatch')
+        unselected = {}
+        for app in self.app_info['apps']:
+            if not app.get('selector'):
+                namespace = app.get('namespace', 'default')
+                unselected[namespace] = unselected.get(namespace, 0) + 1
+        scopes = {}
+        for app in self.app_info['apps']:
+            namespace = app.get('namespace', 'default')
+            if app.get('selector'):
+                scope = (namespace, app['selector'], None)
+            elif threshold and unselected[namespace] > threshold:
+                scope = (namespace, None, None)
+            else:
+                scope = (namespace, None, 'metadata.name=' + app['name'])
+            scopes.setdefault(scope, []).append(app['name'])
+        return scopes
+
+    def start_informers(self):
+        """List and watch nodes, then the services and endpoints of the
+        apps. Changes are only reported once everything has been listed;
+        until then the apps are read from the caches by `snapshot`."""
+        nodes = Informer(self.client, 'nodes', namespace=None,
+                         on_change=self._on_node)
+        self.informers = {('nodes', None, None, None): nodes}
+        nodes.start().synced.wait()
+        scopes = self.watch_scopes()
+        # one long-lived connection per watch, plus the list calls
+        self.client.session.mount(self.client.url, HTTPAdapter(
+            pool_maxsize=2 * len(scopes) + 1 + DEFAULT_POOLSIZE))
+        for resource in ('services', 'endpoints'):
+            informers = {}
+            for scope, appnames in scopes.items():
+                namespace, label_selector, field_selector = scope
+                informer = Informer(self.client, resource,
+                                    namespace=namespace,
+                                    label_selector=label_selector,
+                                    field_selector=field_selector,
+                                    names=appnames,
+                                    on_change=self._on_app_object)
+                informers[(resource,) + scope] = informer
+                for name in appnames:
+                    self.app_informers.setdefault(name, {})[resource] = \
+                        informer
+            self.informers.update(informers)
+            for informer in informers.values():
+                informer.start()
+            for informer in informers.values():
+                informer.synced.wait()
+        self.watching = True
+
+    def backends(self, appname):
+        if self.ports(appname):
+            return self.get_port_backends_for_app(appname)
+        return self.get_backends_for_app(appname)
 
-    def configure_ns_for_app(self, appname):
-        backends = self.get_backends_for_app(appname)
-        logger.info("Backends for %s are %s" % (appname, str(backends)))
-        self.netskaler.configure_app(appname,  backends)
+    def snapshot(self):
+        """Backends of every app, read from the caches once the informers
+        have listed everything"""
+        if not self.watching:
+            self.start_informers()
+        return PlatformDriver.snapshot(self)
 
-    def configure_ns_for_all_apps(self):
-        appnames = map(lambda x:  x['name'], self.app_info['apps'])
-        for app in appnames:
-            self.configure_ns_for_app(app)
+    def watch(self):
+        """Report every change of the apps' objects. Blocks forever."""
+        if not self.watching:
+            self.start_informers()
+        for informer in self.informers.values():
+            informer.join()
 
 
 if __name__ == "__main__":
@@ -167,9 +401,11 @@ if __name__ == "__main__":
     app_info = json.loads(os.environ['APP_INFO'])
     appnames = map(lambda x: x['name'], app_info['apps'])
 
-    kube = KubernetesInterface(netskaler=None, app_info=app_info,
+    kube = KubernetesInterface(app_info=app_info,
                                cfg_file=result.cfg, insecure=True)
     for app in appnames:
         endpoints = kube.get_backends_for_app(app)
         logger.info("Endpoints for app " + app + ": " + str(endpoints))
-    kube.watch_all_apps()
+    for appname in kube.stream_changes():
+        endpoints = kube.backends(appname)
+        logger.info("Endpoints for app " + appname + ": " + str(endpoints))
@@ -10,7 +10,14 @@ from swarm.docker_swarm import DockerSwarmInterface
 from marathon.mesos_marathon import MarathonInterface
 from kubernetes.kubernetes import KubernetesInterface
 from netscaler import NetscalerInterface
+from fanout import NetscalerFanout
 from consul.cfg_file import ConfigFileDriver
+from consul.consul_health import ConsulInterface
+from coalesce import EventCoalescer
+from workers import ReconcilePool
+from reconcile import Reconciler
+from plan import ChangePlan
+import metrics
 
 logging.basicConfig(level=logging.CRITICAL,
         format='%(asctime)s  - %(levelname)s - [%(filename)s:%(funcName)-10s]  (%(threadName)s) %(message)s')
@@ -19,7 +26,19 @@ logger.addFilter(logging.Filter('docker_netscaler'))
 logger.setLevel(logging.DEBUG)
 
 
-def docker_swarm(app_info, netskaler):
+def event_coalescer(pool):
+    """Coalescer for platform events, or None if COALESCE_QUIET_PERIOD is 0"""
+    quiet_period = float(os.environ.get("COALESCE_QUIET_PERIOD", 0.5))
+    max_delay = float(os.environ.get("COALESCE_MAX_DELAY", 5))
+    if quiet_period <= 0:
+        return None
+    coalescer = EventCoalescer(quiet_period=quiet_period, max_delay=max_delay,
+                               pool=pool)
+    coalescer.start()
+    return coalescer
+
+
+def docker_swarm(app_info):
     parser = argparse.ArgumentParser(description='Process Docker client args')
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument("--swarm-allow-insecure")
@@ -30,32 +49,27 @@ def docker_swarm(app_info, netskaler):
     parser.add_argument("--swarm-tls-key", required=False,
                         dest='swarm_tls_key')
 
-    result = parser.parse_args()
+    result = parser.parse_known_args()[0]
 
-    dokker = DockerSwarmInterface(result.swarm_url, result.swarm_tls_ca_cert,
-                                  result.swarm_tls_cert, result.swarm_tls_key,
-                                  result.swarm_allow_insecure,
-                                  app_info, netskaler)
-    dokker.configure_all()
+    return DockerSwarmInterface(result.swarm_url, result.swarm_tls_ca_cert,
+                                result.swarm_tls_cert, result.swarm_tls_key,
+                                result.swarm_allow_insecure,
+                                app_info)
 
 
-def mesos_marathon(app_info, netskaler):
+def mesos_marathon(app_info):
     parser = argparse.ArgumentParser(description='Process Marathon args')
     parser.add_argument("--marathon-url", required=True, dest='marathon_url')
     parser.add_argument("--marathon-user", dest='marathon_user')
     parser.add_argument("--marathon-password", dest='marathon_password')
-    result = parser.parse_args()
-    marathon = MarathonInterface(server=result.marathon_url,
-                                 netskaler=netskaler,
-                                 app_info=app_info,
-                                 username=result.marathon_user,
-                                 password=result.marathon_password)
-
-    marathon.configure_ns_for_all_apps()
-    marathon.watch_all_apps()
+    result = parser.parse_known_args()[0]
+    return MarathonInterface(server=result.marathon_url,
+                             app_info=app_info,
+                             username=result.marathon_user,
+                             password=result.marathon_password)
 
 
-def kubernetes(appinfo, netskaler):
+def kubernetes(app_info):
     parser = argparse.ArgumentParser(description='Process Kubernetes args')
     parser.add_argument("--kube-config", required=False,
                         dest='cfg', default=None)
@@ -70,67 +84,172 @@ def kubernetes(appinfo, netskaler):
     parser.add_argument("--insecure-skip-tls-verify",
                         required=False, dest='insecure', default=None)
 
-    result = parser.parse_args()
-
-    # '{"appkey": "com.citrix.lb.appname", "apps": [{"name": "foo"},
-    #  {"name": "bar"}]}'
-    app_info = json.loads(os.environ['APP_INFO'])
-    appnames = map(lambda x: x['name'], app_info['apps'])
+    result = parser.parse_known_args()[0]
 
     if result.token_file:
         with open(result.token_file) as tf:
             result.token = tf.read().strip()
 
-    kube = KubernetesInterface(cfg_file=result.cfg,
+    return KubernetesInterface(cfg_file=result.cfg,
                                token=result.token,
                                server=result.server,
                                insecure=result.insecure,
                                ca=result.ca,
-                               netskaler=netskaler,
-                               app_info=appinfo)
-    for app in appnames:
-        endpoints = kube.get_backends_for_app(app)
-        logger.info("Endpoints for app " + app + ": " + str(endpoints))
-    kube.watch_all_apps()
-
-
-def cfg_file_driver(netskaler, cfg_file):
-
-    # '{"appkey": "com.citrix.lb.appname", "apps": [{"name": "foo"},
-    #  {"name": "bar"}]}'
-    app_info = json.loads(os.environ['APP_INFO'])
-    appnames = map(lambda x: x['name'], app_info['apps'])
+                               app_info=app_info)
+
+
+def consul(app_info):
+    parser = argparse.ArgumentParser(description='Process Consul args')
+    parser.add_argument("--consul-url", required=True, dest='consul_url')
+    parser.add_argument("--consul-token", dest='consul_token',
+                        default=os.environ.get("CONSUL_HTTP_TOKEN"))
+    parser.add_argument("--consul-datacenter", dest='consul_datacenter')
+    result = parser.parse_known_args()[0]
+    return ConsulInterface(server=result.consul_url,
+                           app_info=app_info,
+                           token=result.consul_token,
+                           datacenter=result.consul_datacenter,
+                           wait=int(os.environ.get("CONSUL_WAIT", 300)))
+
+
+def cfg_file_driver(app_info):
+    parser = argparse.ArgumentParser(description='Process Cfg File args')
+    parser.add_argument("--cfg-file", required=True, dest='cfg_file')
+    parser.add_argument("--watch", action='store_true', dest='watch')
+
+    result = parser.parse_known_args()[0]
+
+    return ConfigFileDriver(app_info=app_info,
+                            filename=result.cfg_file,
+                            watch_file=result.watch,
+                            poll_interval=float(os.environ.get(
+                                "CFG_FILE_POLL_INTERVAL", 1)))
+
+
+# Platform drivers: the option selecting a driver and the function that
+# parses the driver's own options and builds it. A new PlatformDriver only
+# needs an entry here.
+DRIVERS = [("--swarm-url", docker_swarm),
+           ("--marathon-url", mesos_marathon),
+           ("--kube-config", kubernetes),
+           ("--kube-apiserver", kubernetes),
+           ("--consul-url", consul),
+           ("--cfg-file", cfg_file_driver)]
+
+
+def platform_driver(app_info):
+    """Build the driver selected on the command line"""
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group(required=True)
+    for option, _ in DRIVERS:
+        group.add_argument(option, dest=option.lstrip('-').replace('-', '_'))
+    result = parser.parse_known_args()
+    for option, build in DRIVERS:
+        if getattr(result[0], option.lstrip('-').replace('-', '_')):
+            return build(app_info)
+
+
+def netscaler(app_info, configure_frontends, workers, raise_errors=False):
+    """NetscalerInterface for NS_IP, or a NetscalerFanout if NS_IP lists
+    several NetScalers (comma separated) or the nodes of an HA pair
+    (separated by /), e.g., "10.0.1.10/10.0.1.11,10.0.2.10/10.0.2.11"
+
+    :param bool raise_errors: raise when a change is not applied, rather
+        than log it, e.g., for a one-shot run
+    """
+    targets = [[n.strip() for n in t.split('/')]
+               for t in os.environ.get("NS_IP", "").split(',') if t.strip()]
+    targets = targets or [[os.environ.get("NS_IP")]]
+    fanout = len(targets) > 1 or len(targets[0]) > 1
+    netskalers = [NetscalerInterface(nodes[0],
+                                     os.environ.get("NS_USER"),
+                                     os.environ.get("NS_PASSWORD"),
+                                     app_info,
+                                     configure_frontends and not fanout,
+                                     session_pool_size=int(os.environ.get(
+                                         "NS_SESSION_POOL_SIZE", workers)),
+                                     session_timeout=int(os.environ.get(
+                                         "NS_SESSION_TIMEOUT", 600)),
+                                     bulk_batch_size=int(os.environ.get(
+                                         "NS_BULK_BATCH_SIZE", 100)),
+                                     state_ttl=int(os.environ.get(
+                                         "NS_STATE_TTL", 300)),
+                                     drain_timeout=int(os.environ.get(
+                                         "NS_DRAIN_TIMEOUT", 0)),
+                                     ha_nodes=nodes[1:],
+                                     raise_errors=fanout or raise_errors)
+                  for nodes in targets]
+    if not fanout:
+        return netskalers[0]
+    return NetscalerFanout(netskalers,
+                           retries=int(os.environ.get("NS_RETRIES", 2)),
+                           retry_delay=float(os.environ.get(
+                               "NS_RETRY_DELAY", 1)),
+                           breaker_threshold=int(os.environ.get(
+                               "NS_BREAKER_THRESHOLD", 3)),
+                           breaker_reset=float(os.environ.get(
+                               "NS_BREAKER_RESET", 30)),
+                           check_interval=float(os.environ.get(
+                               "NS_HEALTH_CHECK_INTERVAL", 30)),
+                           configure_frontends=bool(configure_frontends))
+
+
+def plan_mode():
+    """--plan [FILE]: print (or save) the changes to make, apply nothing.
+    --apply-plan FILE: apply a saved plan, without reading the platform
+    or configuring frontends the plan does not have. Members the plan
+    drains are disabled with the plan's drain delay. Exits non-zero if
+    the NetScaler rejected part of the plan."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--plan", nargs='?', const='-', dest='plan')
+    parser.add_argument("--apply-plan", dest='apply_plan')
+    return parser.parse_known_args()[0]
 
-    cfg_file_driver = ConfigFileDriver(netskaler=netskaler,
-                                       filename=cfg_file)
-    for app in appnames:
-        cfg_file_driver.configure_ns_for_app(app)
 
 if __name__ == "__main__":
 
     # '{"appkey": "com.citrix.lb.appname", "apps": [{"name": "foo"},
     #  {"name": "bar"}]}'
     app_info = json.loads(os.environ['APP_INFO'])
-    netskaler = NetscalerInterface(os.environ.get("NS_IP"),
-                                   os.environ.get("NS_USER"),
-                                   os.environ.get("NS_PASSWORD"),
-                                   app_info,
-                                   os.environ.get("NS_CONFIG_FRONT_END"))
-
-    parser = argparse.ArgumentParser()
-    group = parser.add_mutually_exclusive_group(required=True)
-    group.add_argument("--swarm-url", dest='swarm_url')
-    group.add_argument("--marathon-url", dest='marathon_url')
-    group.add_argument("--kube-config", dest='kube_config')
-    group.add_argument("--kube-apiserver", dest='kube_server')
-    group.add_argument("--cfg-file", dest='cfg_file')
-    result = parser.parse_known_args()
-
-    if result[0].swarm_url:
-        docker_swarm(app_info, netskaler)
-    elif result[0].marathon_url:
-        mesos_marathon(app_info, netskaler)
-    elif result[0].kube_config or result[0].kube_server:
-        kubernetes(app_info, netskaler)
-    elif result[0].cfg_file:
-        cfg_file_driver(netskaler, result[0].cfg_file)
+    mode = plan_mode()
+    # number of apps reconfigured concurrently
+    workers = int(os.environ.get("RECONCILE_WORKERS", 4))
+    pool = ReconcilePool(size=workers)
+    one_shot = bool(mode.plan or mode.apply_plan)
+    netskaler = netscaler(app_info,
+                          os.environ.get("NS_CONFIG_FRONT_END")
+                          if not one_shot else False,
+                          workers,
+                          raise_errors=bool(mode.apply_plan))
+
+    try:
+        if mode.apply_plan:
+            with open(mode.apply_plan) as f:
+                netskaler.apply_plan(ChangePlan.from_json(f.read()))
+        elif mode.plan:
+            plan = netskaler.plan(platform_driver(app_info).snapshot())
+            if mode.plan == '-':
+                print(plan.to_json())
+            else:
+                with open(mode.plan, 'w') as f:
+                    f.write(plan.to_json())
+        else:
+            driver = platform_driver(app_info)
+            reconciler = Reconciler(netskaler, pool=pool,
+                                    coalescer=event_coalescer(pool))
+            if os.environ.get("METRICS_PORT"):
+                metrics.QUEUE_DEPTH.set_function(driver.queue_depth,
+                                                 queue='changes')
+                metrics.QUEUE_DEPTH.set_function(pool.queue_depth,
+                                                 queue='reconcile')
+                if reconciler.coalescer is not None:
+                    metrics.QUEUE_DEPTH.set_function(
+                        lambda: reconciler.coalescer.stats()['pending'],
+                        queue='coalesce')
+                metrics.start_http_server(int(os.environ["METRICS_PORT"]))
+            reconciler.run(driver)
+            if reconciler.coalescer is not None:
+                reconciler.coalescer.stop()
+            pool.wait()
+    finally:
+        netskaler.shutdown()
@@ -3,17 +3,26 @@ import os
 import json
 import logging
 import requests
+import threading
 import requests.exceptions
+from sse import EventStream
+import metrics
+from driver import PlatformDriver
 
 
 logger = logging.getLogger('docker_netscaler')
 
+TERMINAL_STATES = ['TASK_FINISHED', 'TASK_FAILED', 'TASK_KILLED',
+                   'TASK_LOST', 'TASK_ERROR', 'TASK_GONE', 'TASK_DROPPED']
 
-class MarathonInterface(object):
+
+class MarathonInterface(PlatformDriver):
     """Interface for the Marathon REST API."""
 
-    def __init__(self, server, netskaler, app_info, 
-                username=None, password=None, timeout=10000):
+    platform = 'marathon'
+
+    def __init__(self, server, app_info,
+                 username=None, password=None, timeout=10000):
         """Constructor
 
         :param server: Marathon URL (e.g., 'http://host:8080' )
@@ -21,86 +30,198 @@ class MarathonInterface(object):
         :param str password: Basic auth password
         :param int timeout: Timeout (in seconds) for requests to Marathon
         """
+        PlatformDriver.__init__(self, app_info)
         self.server = server
-        self.netskaler = netskaler
-        self.app_info = app_info
         self.auth = (username, password) if username and password else None
         self.timeout = timeout
-
-    def get_backends_for_app(self, appid):
-        """Get host endpoints for apps
-
-        :returns: endpoints dict
-        :rtype: dict
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers.update({'Content-Type': 'application/json',
+                                     'Accept': 'application/json'})
+        # app name -> {task id: (host, (port, ...))}, None until loaded
+        self.tasks = None
+        self.tasks_lock = threading.Lock()
+        self.stream = None
+
+    def _get(self, path, params=None):
+        """GET a Marathon API path with the keep-alive session
+
+        :returns: decoded JSON body, or None on error
         """
-        response = None
-        headers = {'Content-Type': 'application/json',
-                   'Accept': 'application/json'}
-        url = self.server + 'v2/apps' + appid + "/tasks"
+        url = self.server + path
         try:
-            response = requests.request('GET', url,
-                                        headers=headers,
-                                        auth=self.auth)
+            response = self.session.get(url, params=params)
         except requests.exceptions.RequestException as e:
             logger.error('Error while calling %s: %s', url, e.message)
-            return []
+            return None
         if response.status_code >= 300:
             logger.error('Got HTTP {code}: {body}'.
                          format(code=response.status_code, body=response.text))
+            return None
+        return response.json()
+
+    def _task_backends(self, tasks):
+        """task id -> (host, ports) for the running tasks of an app"""
+        return dict((t['id'], (t['host'], tuple(t['ports']))) for t in tasks
+                    if t.get('ports') and
+                    t.get('state', 'TASK_RUNNING') == 'TASK_RUNNING')
+
+    def _app_tasks(self, appname):
+        """(host, ports) of the running tasks of an app, from the task
+        table if loaded, else from the REST API
+
+        :returns: list of (host, ports), or None on error
+        """
+        with self.tasks_lock:
+            tasks = self.tasks.get(appname) if self.tasks else None
+            if tasks is not None:
+                return list(tasks.values())
+        body = self._get('v2/apps/' + appname + "/tasks")
+        if body is None:
+            return None
+        return list(self._task_backends(body['tasks']).values())
+
+    def get_backends_for_app(self, appid):
+        """Get host endpoints for apps, on the first port of each task
+
+        :returns: list of (host, port)
+        :rtype: list
+        """
+        tasks = self._app_tasks(appid.lstrip('/'))
+        if tasks is None:
             return []
-        return [(t['host'], t['ports'][0])  # TODO: what if there are > 1 ports
-                for t in response.json()['tasks']]
+        return [(host, ports[0]) for host, ports in tasks]
+
+    def get_port_backends_for_app(self, appname):
+        """Get host endpoints for every port declared for an app. A port
+        is the task port at its `index`, by default its position in the
+        declared list.
+
+        :returns: port name -> list of (host, port)
+        :rtype: dict
+        """
+        tasks = self._app_tasks(appname) or []
+        result = {}
+        for i, port in enumerate(self.ports(appname)):
+            index = port.get('index', i)
+            result[port['name']] = [(host, ports[index])
+                                    for host, ports in tasks
+                                    if len(ports) > index]
+        return result
+
+    def load_tasks(self):
+        """Seed the task table of every managed app with one request
+
+        :returns: True on success
+        """
+        body = self._get('v2/apps', params={'embed': 'apps.tasks'})
+        if body is None:
+            return False
+        tasks = dict((name, {}) for name in self.appnames)
+        for app in body['apps']:
+            name = app['id'].lstrip('/')
+            if name in tasks:
+                tasks[name] = self._task_backends(app.get('tasks') or [])
+        with self.tasks_lock:
+            self.tasks = tasks
+        return True
+
+    def apply_event(self, ev):
+        """Update the task table from a status_update_event
+
+        :returns: name of the app whose backends changed, or None
+        """
+        app = (ev['appId'] or '').lstrip('/')
+        task_id = ev['taskId']
+        status = ev['taskStatus']
+        with self.tasks_lock:
+            loaded = self.tasks is not None
+        if not loaded:
+            # seeding failed: try again rather than lose the event, and
+            # until it works have the app's tasks read from the REST API
+            if self.load_tasks():
+                self.changed_all()
+                return None
+            if app not in self.apps:
+                metrics.EVENTS_DROPPED.inc(platform=self.platform)
+                return None
+            return app
+        with self.tasks_lock:
+            if app not in self.tasks:
+                metrics.EVENTS_DROPPED.inc(platform=self.platform)
+                return None
+            tasks = self.tasks[app]
+            if status == 'TASK_RUNNING':
+                if not ev.get('ports'):
+                    # older Marathon versions do not send the ports
+                    refetch = True
+                else:
+                    refetch = False
+                    backend = (ev['host'], tuple(ev['ports']))
+                    if tasks.get(task_id) == backend:
+                        return None
+                    tasks[task_id] = backend
+            elif status in TERMINAL_STATES:
+                refetch = False
+                if tasks.pop(task_id, None) is None:
+                    return None
+            else:
+                return None
+        if refetch:
+            body = self._get('v2/apps/' + app + '/tasks')
+            if body is None:
+                return None
+            with self.tasks_lock:
+                self.tasks[app] = self._task_backends(body['tasks'])
+        return app
 
     def events(self):
         """Get event stream
            Requires Marathon v0.9. See:
            https://mesosphere.github.io/marathon/docs/rest-api.html#event-stream
+           Reconnects when the stream breaks and resyncs the task table
+           each time the stream opens, so changes made before it opened
+           are not missed.
         """
-        path = 'v2/events'
-        url = self.server + path
-        headers = {'Content-Type': 'application/json',
-                   'Accept': 'text/event-stream'}
-        r = requests.get(url,
-                         auth=self.auth,
-                         headers=headers,
-                         stream=True)
-        for line in r.iter_lines():
-            if line and line.find("data:") > -1:
-                event = json.loads(line[line.find("data:") +
-                                        len('data: '):].rstrip())
-                if event['eventType'] == 'status_update_event':
-                    yield {k: event[k]
-                           for k in ['appId', 'host', 'taskStatus', 'taskId']}
-            yield None
-
-    def watch_all_apps(self):
-        appnames = map(lambda x: '/' + x['name'], self.app_info['apps'])
+        self.stream = EventStream(self.session, self.server + 'v2/events',
+                                  event_types=['status_update_event'],
+                                  on_open=self.resync)
+        for event_type, event in self.stream:
+            ev = {k: event.get(k)
+                  for k in ['appId', 'host', 'taskStatus', 'taskId']}
+            ev['ports'] = event.get('ports')
+            yield ev
+
+    def resync(self):
+        """Reload all tasks and report every app, after events may have
+        been missed"""
+        logger.info("Resyncing Marathon tasks")
+        if not self.load_tasks():
+            # events only apply deltas, so a table that missed some must
+            # not be used; the next event seeds it again
+            with self.tasks_lock:
+                self.tasks = None
+            return
+        self.changed_all()
+
+    def watch(self):
         for ev in self.events():
-            if ev is None:
-                continue
-            app = ev['appId']
-            host = ev['host']
-            status = ev['taskStatus']
-            relevant = status in ['TASK_RUNNING',
-                                  'TASK_FINISHED',
-                                  'TASK_FAILED',
-                                  'TASK_KILLED',
-                                  'TASK_LOST']
-            if app is not None\
-                    and app in appnames and relevant:
-                logger.info("Configuring NS for app %s, "
-                            "host=%.12s status=%s" % (app, host, status))
-                self.configure_ns_for_app(app.lstrip("/"))
-
-    def configure_ns_for_app(self, appname):
-        backends = self.get_backends_for_app("/" + appname)
-        logger.debug("Backends for %s are %s" % (appname, str(backends)))
-        self.netskaler.configure_app(appname,  backends)
-
-    def configure_ns_for_all_apps(self):
-        appnames = map(lambda x:  x['name'], self.app_info['apps'])
-        for app in appnames:
-            self.configure_ns_for_app(app)
+            app = self.apply_event(ev)
+            if app is not None:
+                logger.info("Backends of app %s changed, "
+                            "host=%.12s status=%s" %
+                            (app, ev['host'], ev['taskStatus']))
+                self.changed(app)
+
+    def backends(self, appname):
+        if self.ports(appname):
+            return self.get_port_backends_for_app(appname)
+        return self.get_backends_for_app("/" + appname)
+
+    def snapshot(self):
+        """Backends of every app, from one request for all tasks"""
+        self.load_tasks()
+        return PlatformDriver.snapshot(self)
 
 
 if __name__ == "__main__":
@@ -114,12 +235,11 @@ if __name__ == "__main__":
     app_info = json.loads(os.environ['APP_INFO'])
     appnames = map(lambda x: x['name'], app_info['apps'])
 
-    marathon = MarathonInterface(result.marathon_url)
+    marathon = MarathonInterface(result.marathon_url, app_info)
     for app in appnames:
-        endpoints = marathon.get_app_endpoints("/" + app)
+        endpoints = marathon.get_backends_for_app("/" + app)
         logger.info("Endpoints for app " + app + ": " + str(endpoints))
 
-    for e in marathon.events():
-        if e is not None and e in appnames:
-            endpoints = marathon.get_app_endpoints(e)
-            logger.info("Endpoints for app " + e + ": " + str(endpoints))
+    for appname in marathon.stream_changes():
+        endpoints = marathon.backends(appname)
+        logger.info("Endpoints for app " + appname + ": " + str(endpoints))
@@ -0,0 +1,99 @@
+"""
+Reconnecting reader for Marathon's server-sent event stream
+"""
+import json
+import logging
+import time
+import requests.exceptions
+
+import metrics
+
+
+logger = logging.getLogger('docker_netscaler')
+
+
+class EventStream(object):
+    """
+    Iterates over (event type, event) from a server-sent event stream.
+
+    Only the wanted event types are requested from the server
+    (`?event_type=`, Marathon >= 1.2) and, for servers that ignore the
+    filter, other events are dropped on their `event:` line before their
+    data is decoded. When the stream breaks it is re-opened with
+    exponential backoff. `on_open` is called each time the stream is open,
+    the first time included, so the caller can resync whatever it may
+    have missed before the stream started or while it was down.
+    """
+
+    def __init__(self, session, url, event_types=None, read_timeout=300,
+                 on_open=None, max_backoff=30):
+        """Constructor
+
+        :param requests.Session session: session to open the stream with
+        :param str url: event stream URL
+        :param list event_types: event types to receive, None for all
+        :param int read_timeout: seconds without data before reconnecting
+        :param on_open: called without arguments after every open
+        """
+        self.session = session
+        self.url = url
+        self.event_types = event_types
+        self.read_timeout = read_timeout
+        self.on_open = on_open
+        self.max_backoff = max_backoff
+        self.reconnects = 0
+        self.dropped = 0
+
+    def _open(self):
+        params = {'event_type': self.event_types} if self.event_types \
+            else None
+        response = self.session.get(self.url,
+                                    params=params,
+                                    headers={'Accept': 'text/event-stream'},
+                                    stream=True,
+                                    timeout=(10, self.read_timeout))
+        response.raise_for_status()
+        return response
+
+    def _parse(self, response):
+        event_type = None
+        # lines as each chunk arrives, not once 512 bytes have been read
+        for line in response.iter_lines(chunk_size=None):
+            if not line:
+                event_type = None  # end of event
+                continue
+            if line.startswith(b'event:'):
+                event_type = line[6:].strip().decode('utf-8')
+                continue
+            if not line.startswith(b'data:'):
+                continue  # id:, retry: and comments
+            if self.event_types and event_type is not None and \
+                    event_type not in self.event_types:
+                self.dropped += 1
+                metrics.EVENTS_DROPPED.inc(platform='marathon')
+                continue
+            event = json.loads(line[5:].decode('utf-8'))
+            event_type = event_type or event.get('eventType')
+            if self.event_types and event_type not in self.event_types:
+                self.dropped += 1
+                metrics.EVENTS_DROPPED.inc(platform='marathon')
+                continue
+            yield event_type, event
+
+    def __iter__(self):
+        failures = 0
+        while True:
+            try:
+                response = self._open()
+                if self.on_open is not None:
+                    self.on_open()
+                failures = 0
+                for event in self._parse(response):
+                    yield event
+                logger.warn("Event stream %s closed" % self.url)
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.warn("Event stream %s interrupted: %s" % (self.url, e))
+            failures += 1
+            self.reconnects += 1
+            metrics.WATCH_RECONNECTS.inc(platform='marathon')
+            time.sleep(min(self.max_backoff, 2 ** failures))
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Counters, gauges and histograms for Nitrox, served in the Prometheus
+text format from an optional embedded HTTP endpoint (`/metrics`).
+"""
+
+import logging
+import threading
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+logger = logging.getLogger('docker_netscaler')
+
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+LATENCY_BUCKETS = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+        .replace('"', r'\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (n, _escape(v)) for n, v in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # tuple of label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s takes labels %s, got %s" %
+                             (self.name, self.labelnames, sorted(labels)))
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def samples(self):
+        """:returns: list of (suffix, label values, extra labels, value)"""
+        with self._lock:
+            return [('', key, (), value)
+                    for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix,
+                                        _labels(self.labelnames, key, extra),
+                                        _number(value)))
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """A value that is set, or read from a function when scraped"""
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super(Gauge, self).__init__(name, help, labelnames)
+        self._functions = {}
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = func
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, func in functions.items():
+            try:
+                values[key] = func()
+            except Exception as e:
+                logger.debug("Cannot read %s%s: %s" % (self.name, key, e))
+        return [('', key, (), value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key,
+                                             ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total) in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    samples.append(('_bucket', key,
+                                    (('le', _number(bound)),), count))
+                samples.append(('_sum', key, (), total))
+                samples.append(('_count', key, (), counts[-1]))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics)
+        return '\n'.join(m.render() for m in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+NITRO_CALLS = REGISTRY.register(Counter(
+    'nitrox_nitro_calls_total',
+    'NITRO requests by resource, operation and result (ok, or the NITRO '
+    'errorcode)', ('resource', 'operation', 'result')))
+NITRO_CALL_SECONDS = REGISTRY.register(Histogram(
+    'nitrox_nitro_call_seconds', 'Duration of NITRO requests',
+    ('resource', 'operation')))
+NITRO_LOGINS = REGISTRY.register(Counter(
+    'nitrox_nitro_logins_total', 'Logins to the NetScaler'))
+EVENTS_RECEIVED = REGISTRY.register(Counter(
+    'nitrox_events_received_total',
+    'Platform changes reported for managed apps', ('platform',)))
+EVENTS_DROPPED = REGISTRY.register(Counter(
+    'nitrox_events_dropped_total',
+    'Platform events ignored because they are not about a managed app',
+    ('platform',)))
+EVENTS_COALESCED = REGISTRY.register(Counter(
+    'nitrox_events_coalesced_total',
+    'Changes merged into a reconciliation that was already pending'))
+WATCH_RECONNECTS = REGISTRY.register(Counter(
+    'nitrox_watch_reconnects_total',
+    'Platform watch streams re-opened after an error or timeout',
+    ('platform',)))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    'nitrox_queue_depth', 'Changes or reconciliations waiting, per queue',
+    ('queue',)))
+RECONCILE_LATENCY = REGISTRY.register(Histogram(
+    'nitrox_reconcile_latency_seconds',
+    'Time from a platform change to its backends being applied on the '
+    'NetScaler', ('app', 'platform'), buckets=LATENCY_BUCKETS))
+TARGET_APPLY_SECONDS = REGISTRY.register(Histogram(
+    'nitrox_target_apply_seconds',
+    'Time to apply a change to one NetScaler, retries included',
+    ('target',), buckets=LATENCY_BUCKETS))
+TARGET_APPLY_FAILURES = REGISTRY.register(Counter(
+    'nitrox_target_apply_failures_total',
+    'Changes not applied to a NetScaler after all retries', ('target',)))
+TARGET_SKIPPED = REGISTRY.register(Counter(
+    'nitrox_target_skipped_total',
+    'Changes held back because the circuit to a NetScaler was open',
+    ('target',)))
+TARGET_CIRCUIT_OPEN = REGISTRY.register(Gauge(
+    'nitrox_target_circuit_open',
+    '1 while changes to a NetScaler are held back after repeated '
+    'failures', ('target',)))
+TARGET_FAILOVERS = REGISTRY.register(Counter(
+    'nitrox_target_failovers_total',
+    'Times the sessions to a NetScaler HA pair moved to another node',
+    ('target',)))
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, addr='', registry=REGISTRY):
+    """Serve the metrics at http://addr:port/metrics on a daemon thread
+
+    :returns: the HTTP server
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_response(404)
+                self.end_headers()
+                return
+            data = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, *args):
+            pass
+
+    server = _Server((addr, int(port)), Handler)
+    t = threading.Thread(target=server.serve_forever, name='Metrics')
+    t.daemon = True
+    t.start()
+    logger.info("Serving metrics on port %d" % server.server_address[1])
+    return server
@@ -2,77 +2,275 @@
 
 from functools import wraps
 import logging
+import threading
+import time
 
+import requests
 from nssrc.com.citrix.netscaler.nitro.exception.nitro_exception \
     import nitro_exception
 from nssrc.com.citrix.netscaler.nitro.resource.config.lb.lbvserver \
     import lbvserver
-from nssrc.com.citrix.netscaler.nitro.service.nitro_service\
-    import nitro_service
+from nssrc.com.citrix.netscaler.nitro.resource.config.lb.lbmonitor \
+    import lbmonitor
 from nssrc.com.citrix.netscaler.nitro.resource.config.basic.servicegroup\
     import servicegroup
 from nssrc.com.citrix.netscaler.nitro.resource.config.lb.lbvserver_servicegroup_binding\
     import lbvserver_servicegroup_binding
 from nssrc.com.citrix.netscaler.nitro.resource.config.basic.servicegroup_servicegroupmember_binding\
     import servicegroup_servicegroupmember_binding
+from nssrc.com.citrix.netscaler.nitro.resource.config.basic.servicegroup_lbmonitor_binding\
+    import servicegroup_lbmonitor_binding
+from nssrc.com.citrix.netscaler.nitro.resource.config.ha.hanode \
+    import hanode
+
+import metrics
+from ns_session import NitroSessionPool, NS_SESSION_EXPIRED
+from state_cache import StateCache
+from plan import ChangePlan, GroupPlan, DEFAULT_WEIGHT
+from ns_snapshot import NetscalerSnapshot
+from drain import DrainTracker
+from app_options import AppOptions, drift, monitor_name
 
 
 logger = logging.getLogger('docker_netscaler')
 
+# NITRO errorcodes of bulk items that are already in the desired state
+NS_NO_SUCH_RESOURCE = 258
+NS_RESOURCE_EXISTS = 273
+
+
+class BulkRejected(Exception):
+    """The NetScaler rejected items of bulk requests"""
+
+    def __init__(self, rejected):
+        self.rejected = rejected
+        self.message = "NetScaler rejected %d operations, e.g., [%s] %s" % \
+            (len(rejected), rejected[0][1], rejected[0][2])
+        Exception.__init__(self, self.message)
+
+
+def backend_set(srvrs):
+    """Normalise a list of (ip, port) or (ip, port, weight) backends into
+    a set of (ip, port, weight)"""
+    return set((s[0], int(s[1]),
+                int(s[2]) if len(s) > 2 and s[2] else DEFAULT_WEIGHT)
+               for s in srvrs)
+
+
+def port_group_name(appname, port):
+    """Name of the lbvserver and service group for a named port of an app"""
+    return "%s-%s" % (appname, port)
+
+
+def nitro_resource(resource_cls, attrs):
+    """:returns: a resource_cls with the attributes attrs"""
+    resource = resource_cls()
+    for k, v in sorted(attrs.items()):
+        setattr(resource, k, v)
+    return resource
+
 
 def ns_session_scope(func):
     @wraps(func)
-    def login_logout(self, *args, **kwargs):
-        self.ns_session = nitro_service(self.nsip, 'HTTP')
-        self.ns_session.set_credential(self.nslogin, self.nspasswd)
-        self.ns_session.timeout = 600
-        self.ns_session.login()
-        result = func(self, *args, **kwargs)
-        self.ns_session.logout()
-        self.ns_session = None
-        return result
-    return login_logout
+    def with_pooled_session(self, *args, **kwargs):
+        def scoped(service):
+            self.ns_session = service
+            try:
+                return func(self, *args, **kwargs)
+            finally:
+                self.ns_session = None
+        return self.sessions.run(scoped)
+    return with_pooled_session
 
 
-class NetscalerInterface:
+class NetscalerInterface(object):
 
     def __init__(self, nsip, nslogin, nspasswd, app_info,
-                 configure_frontends=False):
+                 configure_frontends=False, session_pool_size=1,
+                 session_timeout=600, bulk_batch_size=100, state_ttl=300,
+                 drain_timeout=0, ha_nodes=None, raise_errors=False):
         self.nsip = nsip
+        # management IPs of the other nodes of an HA pair; the sessions
+        # follow whichever node is primary, see follow_primary
+        self.ha_nodes = [n for n in ha_nodes or [] if n != nsip]
+        # re-raise configuration errors, and raise BulkRejected for bulk
+        # items the NetScaler rejected, after logging them, so that the
+        # caller can retry (NetscalerFanout)
+        self.raise_errors = raise_errors
         self.nslogin = nslogin
         self.nspasswd = nspasswd
-        self.ns_session = None
+        self.sessions = NitroSessionPool(nsip, nslogin, nspasswd,
+                                         size=session_pool_size,
+                                         timeout=session_timeout)
+        self._local = threading.local()
+        # max number of members added/deleted per NITRO request
+        self.bulk_batch_size = max(1, int(bulk_batch_size))
+        # backends last pushed per app; re-read from the NetScaler after
+        # state_ttl seconds
+        self.state_cache = StateCache(ttl=state_ttl)
+        self.state_ttl = state_ttl
+        # removed members are disabled for up to drain_timeout seconds
+        # before they are unbound; 0 unbinds them right away
+        self.drain_timeout = int(drain_timeout)
+        self.drains = DrainTracker(timeout=self.drain_timeout)
+        # bulk read of the NetScaler that the first reconciliation of each
+        # service group diffs against, see load_baseline
+        self.baseline = None
         self.app_info = app_info
         """
         app_info expected structure:
         '{"appkey": "com.citrix.lb.appname",
           "apps": [{"name": "foo0", "lb_ip":"10.220.73.122", "lb_port":"443"},
                    {"name": "foo1", "lb_ip":"10.220.73.123", "lb_port":"80"},
-                   {"name":"foo2"}, {"name":"foo3"}]}'
+                   {"name":"foo2"}, {"name":"foo3"},
+                   {"name": "foo4", "lb_ip":"10.220.73.124",
+                    "ports": [{"name": "http", "port": 80, "lb_port": "80"},
+                              {"name": "grpc", "port": 9090}]}]}'
+        Each named port of an app gets its own lbvserver and service group,
+        named <app>-<port name>. Apps and ports may set the lbmethod,
+        servicetype and other lbvserver/servicegroup attributes, see
+        AppOptions.
         """
+        # lbvserver/service group name -> AppOptions
+        self.options = {}
+        for app in self.app_info['apps']:
+            self.options[app['name']] = AppOptions.from_app(app)
+            for port in app.get('ports') or []:
+                self.options[port_group_name(app['name'], port['name'])] = \
+                    AppOptions.from_app(app, port)
         if configure_frontends:
-            frontends = [(l['name'], l['lb_ip'], l['lb_port'])
-                         for l in self.app_info['apps']
-                         if l.get('lb_ip') and l.get('lb_port')]
-            for f in frontends:
-                self.configure_lb_frontend(f[0], f[1], f[2])
+            self.configure_frontends()
+
+    @property
+    def ns_session(self):
+        """nitro_service in use by the current thread"""
+        return getattr(self._local, 'ns_session', None)
+
+    @ns_session.setter
+    def ns_session(self, service):
+        self._local.ns_session = service
+
+    def session_stats(self):
+        return self.sessions.stats()
+
+    def draining_apps(self):
+        """:returns: app -> service groups with members being drained"""
+        return self.drains.by_app()
+
+    @ns_session_scope
+    def _ha_status(self):
+        """:returns: (state of the node the sessions are logged in to,
+            address of the primary node or None, addresses of the peers)
+        """
+        local, primary, peers = None, None, []
+        for node in self._nitro(hanode, 'get') or []:
+            state = str(getattr(node, 'state', '') or '').upper()
+            if str(node.id) == '0':
+                local = state
+            elif node.ipaddress:
+                peers.append(node.ipaddress)
+                if state == 'PRIMARY':
+                    primary = node.ipaddress
+        return local, primary, peers
+
+    def _use_node(self, address):
+        if address != self.nsip:
+            logger.info("Switching NITRO sessions from %s to %s" %
+                        (self.nsip, address))
+            self.nsip = address
+            self.sessions.set_address(address)
+
+    def follow_primary(self):
+        """Point the sessions at the primary node of an HA pair: the node
+        in use if it is primary (or not part of a pair), else the primary
+        it reports, else the first of the other known nodes that is
+        primary. A cluster is configured through its cluster IP, which
+        needs no following.
+
+        :returns: True if the sessions moved to another node
+        :raises: the error of the last node tried if none could be read
+        """
+        current = self.nsip
+        error = None
+        for address in [current] + [n for n in self.ha_nodes
+                                    if n != current]:
+            self._use_node(address)
+            try:
+                local, primary, peers = self._ha_status()
+            except Exception as e:
+                logger.warn("Cannot read the HA state of %s: %s" %
+                            (address, e))
+                error = e
+                continue
+            for peer in peers:
+                if peer not in self.ha_nodes:
+                    self.ha_nodes.append(peer)
+            if local == 'SECONDARY':
+                if not primary:
+                    continue
+                self._use_node(primary)
+            return self.nsip != current
+        self._use_node(current)
+        raise error or RuntimeError("No primary NetScaler among %s" %
+                                    ([current] + self.ha_nodes))
+
+    def shutdown(self):
+        self.sessions.close()
+
+    def _nitro(self, resource_cls, op, *args):
+        """Call a NITRO SDK operation with the current session, recording
+        it in the call metrics"""
+        start = time.time()
+        result = 'ok'
+        try:
+            return getattr(resource_cls, op)(self.ns_session, *args)
+        except nitro_exception as ne:
+            result = str(ne.errorcode)
+            raise
+        except Exception:
+            result = 'error'
+            raise
+        finally:
+            resource = resource_cls.__name__
+            metrics.NITRO_CALLS.inc(resource=resource, operation=op,
+                                    result=result)
+            metrics.NITRO_CALL_SECONDS.observe(time.time() - start,
+                                               resource=resource,
+                                               operation=op)
+
+    def configure_frontends(self):
+        """Create the lbvservers of the apps (and ports) that have an
+        lb_ip and lb_port"""
+        frontends = [(l['name'], l['lb_ip'], l['lb_port'])
+                     for l in self.app_info['apps']
+                     if l.get('lb_ip') and l.get('lb_port')]
+        frontends += [(port_group_name(l['name'], p['name']), l['lb_ip'],
+                       p['lb_port'])
+                      for l in self.app_info['apps'] if l.get('lb_ip')
+                      for p in l.get('ports') or [] if p.get('lb_port')]
+        for f in frontends:
+            self.configure_lb_frontend(f[0], f[1], f[2])
+
+    def _options(self, name):
+        """:returns: AppOptions of an lbvserver/service group"""
+        return self.options.get(name) or AppOptions()
 
     def _create_service_group(self, grpname):
         try:
-            svc_grp = servicegroup.get(self.ns_session, grpname)
+            svc_grp = self._nitro(servicegroup, 'get', grpname)
             if (svc_grp.servicegroupname == grpname):
                 logger.info("Service group %s already configured " % grpname)
                 return
         except nitro_exception as e:
             pass
-        svc_grp = servicegroup()
-        svc_grp.servicegroupname = grpname
-        svc_grp.servicetype = "HTTP"
-        servicegroup.add(self.ns_session, svc_grp)
+        settings = self._options(grpname).create_servicegroup()
+        settings['servicegroupname'] = grpname
+        self._nitro(servicegroup, 'add',
+                    nitro_resource(servicegroup, settings))
 
-    def _create_lb(self, lbname, lbmethod, vip, port):
+    def _create_lb(self, lbname, vip, port):
         try:
-            lb = lbvserver.get(self.ns_session, lbname)
+            lb = self._nitro(lbvserver, 'get', lbname)
             if (lb.name == lbname) and \
                     (lb.ipv46 == vip) and \
                     (str(lb.port) == port):
@@ -86,18 +284,14 @@ class NetscalerInterface:
         except nitro_exception as e:
             pass
 
-        lb = lbvserver()
-        lb.name = lbname
-        lb.ipv46 = vip
-        lb.servicetype = "HTTP"
-        lb.port = port
-        lb.lbmethod = lbmethod
-        lbvserver.add(self.ns_session, lb)
+        settings = self._options(lbname).create_lbvserver()
+        settings.update(name=lbname, ipv46=vip, port=port)
+        self._nitro(lbvserver, 'add', nitro_resource(lbvserver, settings))
 
     def _add_service(self, grpname, srvr_ip, srvr_port):
         try:
-            bindings = servicegroup_servicegroupmember_binding.get(
-                self.ns_session, grpname)
+            bindings = self._nitro(servicegroup_servicegroupmember_binding,
+                                   'get', grpname)
             for binding in bindings:
                 if binding.ip == srvr_ip and str(binding.port) == srvr_port:
                     logger.info("Service %s:%s is already bound to service \
@@ -110,12 +304,12 @@ class NetscalerInterface:
         binding.servicegroupname = grpname
         binding.ip = srvr_ip
         binding.port = srvr_port
-        servicegroup_servicegroupmember_binding.add(self.ns_session, binding)
+        self._nitro(servicegroup_servicegroupmember_binding, 'add', binding)
 
     def _bind_service_group_lb(self, lbname, grpname):
         try:
-            bindings = lbvserver_servicegroup_binding.get(self.ns_session,
-                                                          lbname)
+            bindings = self._nitro(lbvserver_servicegroup_binding, 'get',
+                                   lbname)
             for b in bindings:
                 if b.name == lbname and b.servicegroupname == grpname:
                     logger.info("LB %s is already bound to service group %s"
@@ -127,70 +321,793 @@ class NetscalerInterface:
         binding = lbvserver_servicegroup_binding()
         binding.name = lbname
         binding.servicegroupname = grpname
-        lbvserver_servicegroup_binding.add(self.ns_session, binding)
+        self._nitro(lbvserver_servicegroup_binding, 'add', binding)
 
-    def _configure_services(self, grpname, srvrs):
-        to_add = srvrs
-        to_remove = []
+    def _member_binding(self, grpname, srvr):
+        """:param srvr: (ip, port), or (ip, port, weight) to bind"""
+        binding = servicegroup_servicegroupmember_binding()
+        binding.servicegroupname = grpname
+        binding.ip = srvr[0]
+        binding.port = srvr[1]
+        if len(srvr) > 2:
+            binding.weight = srvr[2]
+        return binding
+
+    def _bulk_errors(self, chunk, ne):
+        """Map a NITRO exception raised by a bulk request to the items that
+        failed. The per-item results are only available when the
+        NetScaler was asked to continue on error."""
+        response = getattr(ne, 'response', None)
+        if not isinstance(response, list) or len(response) != len(chunk):
+            return [(r, ne.errorcode, ne.message) for r in chunk]
+        failed = []
+        for r, item in zip(chunk, response):
+            if isinstance(item, dict):
+                errorcode = item.get('errorcode', 0)
+                message = item.get('message', '')
+            else:
+                errorcode = getattr(item, 'errorcode', 0)
+                message = getattr(item, 'message', '')
+            if errorcode:
+                failed.append((r, errorcode, message))
+        return failed
+
+    def _bulk_apply(self, resource_cls, op, resources):
+        """Apply op ('add', 'delete', 'disable', ...) to resources using the
+        list form of the SDK call, bulk_batch_size resources per NITRO request.
+
+        :returns: list of (resource, errorcode, message) for failed items
+        :rtype: list
+        """
+        failed = []
+        size = self.bulk_batch_size
+        self.ns_session.onerror = "CONTINUE"
+        for i in range(0, len(resources), size):
+            chunk = resources[i:i + size]
+            try:
+                self._nitro(resource_cls, op,
+                            chunk if len(chunk) > 1 else chunk[0])
+            except nitro_exception as ne:
+                if ne.errorcode == NS_SESSION_EXPIRED:
+                    raise
+                failed.extend(self._bulk_errors(chunk, ne))
+        for r, errorcode, message in failed:
+            logger.warn("Failed to %s %s: [%s] %s"
+                        % (op, self._describe(r), errorcode, message))
+            if (op, errorcode) not in (('add', NS_RESOURCE_EXISTS),
+                                       ('delete', NS_NO_SUCH_RESOURCE)):
+                self._rejected().append((r, errorcode, message))
+        return failed
+
+    def _rejected(self):
+        """Failed bulk items of the current thread, other than adds of
+        items that exist and deletes of items that do not"""
+        if getattr(self._local, 'rejected', None) is None:
+            self._local.rejected = []
+        return self._local.rejected
+
+    def _check_rejected(self):
+        """With raise_errors, raise BulkRejected for the bulk items
+        rejected since the last check, so that the caller can retry
+
+        :returns: True if no item was rejected
+        """
+        rejected, self._local.rejected = self._rejected(), []
+        if rejected and self.raise_errors:
+            raise BulkRejected(rejected)
+        return not rejected
+
+    def _describe(self, r):
+        if isinstance(r, servicegroup_servicegroupmember_binding):
+            return "%s:%s in service group %s" % (r.ip, r.port,
+                                                  r.servicegroupname)
+        if isinstance(r, lbvserver_servicegroup_binding):
+            return "service group %s binding to LB %s" % (r.servicegroupname,
+                                                          r.name)
+        if isinstance(r, lbvserver):
+            return "LB %s" % r.name
+        if isinstance(r, lbmonitor):
+            return "monitor %s" % r.monitorname
+        if isinstance(r, servicegroup_lbmonitor_binding):
+            return "monitor %s binding to service group %s" % (
+                r.monitor_name, r.servicegroupname)
+        if getattr(r, 'servername', None):
+            return "%s:%s in service group %s" % (r.servername, r.port,
+                                                  r.servicegroupname)
+        return "service group %s" % r.servicegroupname
+
+    def _read_members(self, grpname):
+        """:returns: list of ((ip, port, weight), state, svrstate) of the
+            members bound to the service group"""
+        try:
+            bindings = self._nitro(servicegroup_servicegroupmember_binding,
+                                   'get', grpname)
+        except nitro_exception as e:
+            if e.errorcode == NS_SESSION_EXPIRED:
+                raise
+            return []  # no bindings
+        return [((b.ip, int(b.port),
+                  int(getattr(b, 'weight', None) or DEFAULT_WEIGHT)),
+                 getattr(b, 'state', None), getattr(b, 'svrstate', None))
+                for b in bindings or [] if int(b.port) != 0]
+
+    def _get_services(self, grpname):
+        """:returns: set of (ip, port, weight) bound to the service group"""
+        return set(m for m, _, _ in self._read_members(grpname))
+
+    def _member_sets(self, grpname, app, members, desired):
+        """Split the members read from a service group into those bound,
+        those draining and those that are done draining. Members are only
+        drained when drain_timeout is set, and only Nitrox's own drains
+        are draining: the members the drain tracker follows, and disabled
+        members that are no longer desired, e.g., drains pending before a
+        restart. Other disabled members were disabled by an operator and
+        are left disabled.
+
+        :param members: list of ((ip, port, weight), state, svrstate)
+        :param desired: (ip, port, weight) of the desired members
+        :returns: (bound, draining, drained) sets of (ip, port, weight)
+        """
+        enabled, draining, drained = set(), set(), set()
+        wanted = set(b[:2] for b in desired)
+        tracked = self.drains.draining(grpname)
+        for member, state, svrstate in members:
+            key = member[:2]
+            if state != 'DISABLED' and key in tracked:
+                # enabled again by someone else
+                self.drains.discard(grpname, key)
+            if not self.drain_timeout or state != 'DISABLED' or \
+                    (key in wanted and key not in tracked):
+                enabled.add(member)
+                continue
+            self.drains.add(grpname, app, key, weight=member[2])
+            draining.add(member)
+            if svrstate == 'OUT OF SERVICE' or \
+                    self.drains.expired(grpname, member[:2]):
+                drained.add(member)
+        return enabled, draining, drained
+
+    def _existing_groups(self, names):
+        """:returns: name -> servicegroup of the names that are configured
+            service groups, read with one request for all of them
+        :rtype: dict
+        """
+        return self._existing(servicegroup, 'servicegroupname', names)
+
+    def _existing_lbs(self, names):
+        """:returns: name -> lbvserver of the names that are configured
+            lbvservers, read with one request for all of them
+        :rtype: dict
+        """
+        return self._existing(lbvserver, 'name', names)
+
+    def _existing_monitors(self, names):
+        """:returns: name -> lbmonitor of the names that are configured
+            monitors, read with one request for all of them
+        :rtype: dict
+        """
+        return self._existing(lbmonitor, 'monitorname', names)
+
+    def _monitor_bindings(self, grpnames):
+        """:returns: set of (service group, monitor) bindings of the
+            service groups, read in bulk when there are several
+        :rtype: set
+        """
+        grpnames = set(grpnames)
+        bindings = None
+        if len(grpnames) > 1:
+            bindings = self._bulk_bindings('servicegroup_lbmonitor_binding')
+        if bindings is not None:
+            return set((b.get('servicegroupname'), b.get('monitor_name'))
+                       for b in bindings
+                       if b.get('servicegroupname') in grpnames)
+        result = set()
+        for grpname in grpnames:
+            try:
+                found = self._nitro(servicegroup_lbmonitor_binding, 'get',
+                                    grpname)
+            except nitro_exception as e:
+                if e.errorcode == NS_SESSION_EXPIRED:
+                    raise
+                continue  # no such service group, or no monitors
+            result.update((grpname, b.monitor_name) for b in found or [])
+        return result
+
+    def _monitor_changes(self, grpname, monitors, bindings):
+        """:returns: the GroupPlan arguments that create, update and bind
+            the service group's lbmonitor
+        :param dict monitors: name -> lbmonitor read from the NetScaler
+        :param set bindings: (service group, monitor) bindings read from
+            the NetScaler
+        :rtype: dict
+        """
+        monitor = self._options(grpname).monitor_settings(grpname)
+        if monitor is None:
+            return {}
+        current = monitors.get(monitor['monitorname'])
+        update_monitor, fixed = drift(current, monitor)
+        if fixed:
+            logger.warn("Monitor %s must be recreated to change %s"
+                        % (monitor['monitorname'], fixed))
+        return {'monitor': monitor,
+                'create_monitor': current is None,
+                'update_monitor': update_monitor,
+                'bind_monitor': (grpname, monitor['monitorname'])
+                not in bindings}
+
+    def _existing(self, resource_cls, key, names):
+        try:
+            if len(names) == 1:
+                found = [self._nitro(resource_cls, 'get', names[0])]
+            else:
+                found = self._nitro(resource_cls, 'get') or []
+        except nitro_exception as e:
+            if e.errorcode == NS_SESSION_EXPIRED:
+                raise
+            return {}  # no such resource
+        names = set(names)
+        return dict((getattr(r, key), r) for r in found
+                    if getattr(r, key) in names)
+
+    def _drift(self, grpname, group, lb):
+        """:returns: (service group, lbvserver) attributes that differ from
+            the app's options, with their desired values
+        :param group: servicegroup read from the NetScaler, None if it does
+            not exist
+        :param lb: lbvserver read from the NetScaler, None if it was not
+            read or does not exist
+        """
+        options = self._options(grpname)
+        update_group, fixed = drift(group, options.servicegroup_settings())
+        if fixed:
+            logger.warn("Service group %s must be recreated to change %s"
+                        % (grpname, fixed))
+        update_lb, fixed = drift(lb, options.lbvserver_settings())
+        if fixed:
+            logger.warn("LB %s must be recreated to change %s"
+                        % (grpname, fixed))
+        return update_group, update_lb
+
+    def _lb_bound(self, lbname, grpname):
+        """:returns: True if the service group is bound to the LB"""
         try:
-            bindings = servicegroup_servicegroupmember_binding.get(
-                self.ns_session, grpname)
-            existing = [(b.ip, b.port) for b in bindings if b.port != 0]
-            to_remove = list(set(existing) - set(srvrs))
-            to_add = list(set(srvrs) - set(existing))
-            to_leave = list(set(srvrs) & set(existing))
+            bindings = self._nitro(lbvserver_servicegroup_binding, 'get',
+                                   lbname)
         except nitro_exception as e:
-            pass  # no bindings
-        for s in to_remove:
-            binding = servicegroup_servicegroupmember_binding()
-            binding.servicegroupname = grpname
-            binding.ip = s[0]
-            binding.port = s[1]
-            logger.info("Unbinding %s:%s from service group %s " % (s[0], s[1],
-                        grpname))
-            servicegroup_servicegroupmember_binding.delete(self.ns_session,
-                                                           binding)
-        for s in to_add:
-            binding = servicegroup_servicegroupmember_binding()
-            binding.servicegroupname = grpname
-            binding.ip = s[0]
-            binding.port = s[1]
-            logger.info("Binding %s:%s from service group %s " %
-                        (s[0], s[1], grpname))
-            servicegroup_servicegroupmember_binding.add(self.ns_session,
-                                                        binding)
-        for s in to_leave:
-            logger.info("%s:%s is already bound to  service group %s"
-                        % (s[0], s[1], grpname))
+            if e.errorcode == NS_SESSION_EXPIRED:
+                raise
+            return False
+        return any(b.servicegroupname == grpname for b in bindings or [])
+
+    def _plan_groups(self, groups, plan, use_cache=True, baseline=None):
+        """Add the changes for groups to plan. Groups in the state cache
+        are planned from it, groups in the baseline snapshot from that, and
+        the others are read from the NetScaler.
+
+        :param dict groups: service group name -> (app, set of
+            (ip, port, weight))
+        :param NetscalerSnapshot baseline: defaults to self.baseline
+        """
+        if baseline is None:
+            baseline = self.baseline
+        uncached = []
+        for grpname in sorted(groups):
+            app, srvrs = groups[grpname]
+            cached = self.state_cache.get(grpname) if use_cache else None
+            if cached is None:
+                uncached.append(grpname)
+            else:
+                # service group and binding were in place at the last
+                # sync, only push the difference in members
+                plan.add(GroupPlan(
+                    grpname, app, srvrs, cached.backends,
+                    draining=self.drains.members(grpname),
+                    drained=self.drains.expired_members(grpname),
+                    drain_delay=self.drain_timeout))
+        known = {}
+        for grpname in uncached:
+            state = baseline.take(grpname) if baseline is not None else None
+            if state is not None:
+                known[grpname] = state
+        unknown = [g for g in uncached if g not in known]
+        existing = self._existing_groups(unknown) if unknown else {}
+        # lbvservers are only read for apps with lbvserver options
+        lbnames = [g for g in uncached
+                   if self._options(g).lbvserver_settings()]
+        lbs = self._existing_lbs(lbnames) if lbnames else {}
+        # and monitors for apps with a monitor
+        monitored = [g for g in uncached if self._options(g).monitor]
+        monitors = self._existing_monitors(
+            [monitor_name(g) for g in monitored]) if monitored else {}
+        monitor_bindings = self._monitor_bindings(monitored) \
+            if monitored else set()
+        for grpname in uncached:
+            app, srvrs = groups[grpname]
+            if grpname in known:
+                exists, bound, members, group = known[grpname]
+            else:
+                exists = grpname in existing
+                group = existing.get(grpname)
+                members = self._read_members(grpname) if exists else []
+                bound = exists and self._lb_bound(grpname, grpname)
+            update_group, update_lb = self._drift(grpname, group,
+                                                  lbs.get(grpname))
+            enabled, draining, drained = self._member_sets(grpname, app,
+                                                           members, srvrs)
+            plan.add(GroupPlan(grpname, app, srvrs, enabled,
+                               create_group=not exists,
+                               bind_lb=not bound,
+                               synced=True,
+                               draining=draining,
+                               drained=drained,
+                               drain_delay=self.drain_timeout,
+                               group_settings=self._options(
+                                   grpname).create_servicegroup(),
+                               update_group=update_group,
+                               update_lb=update_lb,
+                               **self._monitor_changes(grpname, monitors,
+                                                       monitor_bindings)))
+
+    def _bulk_bindings(self, resource):
+        """Every binding of one kind on the NetScaler, read with a single
+        NITRO request using the bulkbindings query, which the SDK does not
+        expose.
+
+        :returns: list of bindings (dicts), or None if the NetScaler did
+            not return them
+        """
+        url = "%s://%s/nitro/v1/config/%s" % (self.sessions.protocol.lower(),
+                                              self.nsip, resource)
+        start = time.time()
+        result = 'error'
+        try:
+            response = requests.get(
+                url, params={'bulkbindings': 'yes'},
+                headers={'Cookie': 'NITRO_AUTH_TOKEN=%s' %
+                         self.ns_session.sessionid},
+                verify=False, timeout=60)
+            body = response.json()
+            errorcode = body.get('errorcode', 0)
+            result = str(errorcode) if errorcode else 'ok'
+        except (requests.RequestException, ValueError) as e:
+            logger.warn("Bulk read of %s failed: %s" % (resource, e))
+            return None
+        finally:
+            metrics.NITRO_CALLS.inc(resource=resource, operation='bulkget',
+                                    result=result)
+            metrics.NITRO_CALL_SECONDS.observe(time.time() - start,
+                                               resource=resource,
+                                               operation='bulkget')
+        if errorcode == NS_SESSION_EXPIRED:
+            raise nitro_exception(errorcode, body.get('message', ''),
+                                  body.get('severity', 'ERROR'))
+        if errorcode:
+            logger.warn("Bulk read of %s failed: [%s] %s"
+                        % (resource, errorcode, body.get('message')))
+            return None
+        return body.get(resource) or []
+
+    def _read_snapshot(self, names):
+        """Read the state of the service groups `names` with a fixed number
+        of NITRO requests: a list of the service groups, then one bulk
+        read each of the LB and the member bindings. If the NetScaler does
+        not return bulk bindings they are read per configured group.
+
+        :rtype: NetscalerSnapshot
+        """
+        groups = self._existing_groups(names) if names else {}
+        lb_bindings = set()
+        members = {}
+        if groups:
+            lbs = self._bulk_bindings('lbvserver_servicegroup_binding')
+            if lbs is None:
+                lb_bindings = set((g, g) for g in groups
+                                  if self._lb_bound(g, g))
+            else:
+                lb_bindings = set((b.get('name'), b.get('servicegroupname'))
+                                  for b in lbs
+                                  if b.get('servicegroupname') in groups)
+            bindings = self._bulk_bindings(
+                'servicegroup_servicegroupmember_binding')
+            if bindings is None:
+                members = dict((g, self._read_members(g)) for g in groups)
+            else:
+                for b in bindings:
+                    grpname = b.get('servicegroupname')
+                    if grpname in groups and int(b.get('port', 0)) != 0:
+                        members.setdefault(grpname, []).append(
+                            ((b['ip'], int(b['port']),
+                              int(b.get('weight') or DEFAULT_WEIGHT)),
+                             b.get('state'), b.get('svrstate')))
+        return NetscalerSnapshot(names, groups, lb_bindings, members,
+                                 ttl=self.state_ttl)
+
+    @ns_session_scope
+    def load_baseline(self, desired):
+        """Read every service group of the desired apps from the
+        NetScaler in a few bulk requests, so that their first
+        reconciliation diffs against this instead of reading each group.
+
+        :param dict desired: app name -> backends, as reported by
+            PlatformDriver.snapshot
+        """
+        names = sorted(self._desired_groups(desired))
+        try:
+            self.baseline = self._read_snapshot(names)
+            logger.info("Read NetScaler state of %d service groups: %s"
+                        % (len(names), self.baseline.stats()))
+        except nitro_exception as ne:
+            if ne.errorcode == NS_SESSION_EXPIRED:
+                raise
+            logger.warn("Nitro Exception: %s" % ne.message)
+            self.baseline = None
+
+    def clear_baseline(self):
+        self.baseline = None
+
+    def _desired_groups(self, desired):
+        """:param dict desired: app name -> list of backends, or port
+            name -> list of backends for apps with several ports
+        :returns: service group name -> (app, set of (ip, port, weight))
+        """
+        groups = {}
+        for app, backends in desired.items():
+            if isinstance(backends, dict):
+                for port, srvrs in backends.items():
+                    groups[port_group_name(app, port)] = \
+                        (app, backend_set(srvrs))
+            else:
+                groups[app] = (app, backend_set(backends))
+        return groups
+
+    @ns_session_scope
+    def plan(self, desired):
+        """Compute the changes that configure the desired backends,
+        reading the current state from the NetScaler, without applying
+        them.
+
+        :param dict desired: app name -> backends, as reported by
+            PlatformDriver.snapshot
+        :rtype: ChangePlan
+        """
+        plan = ChangePlan(self.bulk_batch_size)
+        groups = self._desired_groups(desired)
+        self._plan_groups(groups, plan, use_cache=False,
+                          baseline=self._read_snapshot(sorted(groups)))
+        return plan
+
+    @ns_session_scope
+    def apply_plan(self, plan):
+        """Apply a plan, e.g., one computed earlier by `plan`. Members
+        bound or unbound since it was computed are reported as failed
+        operations."""
+        self._local.rejected = []
+        try:
+            self._apply_plan(plan)
+            self._check_rejected()
+        finally:
+            # the NetScaler may have changed since the plan was made
+            for g in plan:
+                self.state_cache.invalidate(g.name)
+
+    def _apply_plan(self, plan):
+        """Apply every change of a plan, each kind in shared bulk
+        requests (chunked by bulk_batch_size).
+
+        :returns: service group name -> set of (ip, port, weight) bound
+            afterwards
+        :rtype: dict
+        """
+        created = []
+        updated_groups = []
+        updated_lbs = []
+        bound_lbs = []
+        new_monitors = []
+        updated_monitors = []
+        bound_monitors = []
+        for g in plan:
+            if g.create_group:
+                settings = dict(g.group_settings or
+                                AppOptions().create_servicegroup())
+                settings['servicegroupname'] = g.name
+                created.append(nitro_resource(servicegroup, settings))
+            elif g.update_group:
+                logger.info("Setting %s of service group %s" %
+                            (g.update_group, g.name))
+                settings = dict(g.update_group, servicegroupname=g.name)
+                updated_groups.append(nitro_resource(servicegroup, settings))
+            if g.update_lb:
+                logger.info("Setting %s of LB %s" % (g.update_lb, g.name))
+                settings = dict(g.update_lb, name=g.name)
+                updated_lbs.append(nitro_resource(lbvserver, settings))
+            if g.bind_lb:
+                binding = lbvserver_servicegroup_binding()
+                binding.name = g.name  # Reuse lbname
+                binding.servicegroupname = g.name
+                bound_lbs.append(binding)
+            if g.monitor is None:
+                continue
+            if g.create_monitor:
+                logger.info("Creating monitor %s" % g.monitor['monitorname'])
+                new_monitors.append(nitro_resource(lbmonitor, g.monitor))
+            elif g.update_monitor:
+                logger.info("Setting %s of monitor %s" %
+                            (g.update_monitor, g.monitor['monitorname']))
+                # NITRO needs the type to update a monitor
+                settings = dict(g.update_monitor,
+                                monitorname=g.monitor['monitorname'],
+                                type=g.monitor['type'])
+                updated_monitors.append(nitro_resource(lbmonitor, settings))
+            if g.bind_monitor:
+                binding = servicegroup_lbmonitor_binding()
+                binding.servicegroupname = g.name
+                binding.monitor_name = g.monitor['monitorname']
+                bound_monitors.append(binding)
+        self._bulk_apply(servicegroup, 'add', created)
+        self._bulk_apply(lbmonitor, 'add', new_monitors)
+        self._bulk_apply(servicegroup, 'update', updated_groups)
+        self._bulk_apply(lbvserver, 'update', updated_lbs)
+        self._bulk_apply(lbmonitor, 'update', updated_monitors)
+        self._bulk_apply(lbvserver_servicegroup_binding, 'add', bound_lbs)
+        self._bulk_apply(servicegroup_lbmonitor_binding, 'add',
+                         bound_monitors)
+        return self._sync_members(plan)
+
+    def _member_state_change(self, grpname, srvr, delay=None):
+        """servicegroup resource to enable or (gracefully, for delay
+        seconds) disable one member, or to update its weight if srvr has
+        one"""
+        svc_grp = servicegroup()
+        svc_grp.servicegroupname = grpname
+        svc_grp.servername = srvr[0]
+        svc_grp.port = srvr[1]
+        if len(srvr) > 2:
+            svc_grp.weight = srvr[2]
+        if delay is not None:
+            svc_grp.delay = delay
+            svc_grp.graceful = "YES"
+        return svc_grp
+
+    def _sync_members(self, plan):
+        """Bind the desired members of every service group of the plan
+        and unbind (or drain) everything else. Each kind of change is sent
+        for all groups in one bulk request: draining members that are
+        wanted again are enabled first, then new members bound, the
+        weights of bound members updated, removed members drained and
+        drained ones unbound.
+
+        :returns: service group name -> set of (ip, port, weight) bound
+            (and in service) afterwards
+        :rtype: dict
+        """
+        to_enable = []
+        to_add = []
+        to_update = []
+        to_drain = []
+        to_remove = []
+        for g in plan:
+            for s in g.to_enable:
+                logger.info("Enabling draining %s:%s in service group %s" %
+                            (s[0], s[1], g.name))
+                to_enable.append(self._member_state_change(g.name, s))
+            for s in g.to_add:
+                logger.info("Binding %s:%s from service group %s " %
+                            (s[0], s[1], g.name))
+                to_add.append(self._member_binding(g.name, s))
+            for s in g.to_update:
+                logger.info("Setting weight of %s:%s in service group %s "
+                            "to %d" % (s[0], s[1], g.name, s[2]))
+                to_update.append(self._member_state_change(g.name, s))
+            # the delay the plan was made with, which may differ from
+            # drain_timeout for an applied plan
+            delay = g.drain_delay or self.drain_timeout
+            for s in g.to_drain:
+                logger.info("Draining %s:%s from service group %s for %ds" %
+                            (s[0], s[1], g.name, delay))
+                to_drain.append(self._member_state_change(g.name, s[:2],
+                                                          delay=delay))
+            for s in g.to_remove:
+                logger.info("Unbinding %s:%s from service group %s " %
+                            (s[0], s[1], g.name))
+                to_remove.append(self._member_binding(g.name, s[:2]))
+            unchanged = g.backends - set(g.to_add) - set(g.to_update)
+            for s in sorted(s for s in unchanged
+                            if s[:2] not in g.to_enable):
+                logger.info("%s:%s is already bound to  service group %s"
+                            % (s[0], s[1], g.name))
+        not_enabled = self._bulk_apply(servicegroup, 'enable', to_enable)
+        not_added = self._bulk_apply(
+            servicegroup_servicegroupmember_binding, 'add', to_add)
+        not_updated = self._bulk_apply(servicegroup, 'update', to_update)
+        not_drained = self._bulk_apply(servicegroup, 'disable', to_drain)
+        not_removed = self._bulk_apply(
+            servicegroup_servicegroupmember_binding, 'delete', to_remove)
+        # service group name -> {(ip, port): (ip, port, weight)}
+        bound = dict((g.name, dict((b[:2], b) for b in g.backends))
+                     for g in plan)
+        groups = dict((g.name, g) for g in plan)
+        for r in to_enable:
+            self.drains.discard(r.servicegroupname, (r.servername, r.port))
+        for r, _, _ in not_enabled:
+            bound[r.servicegroupname].pop((r.servername, r.port), None)
+            self.drains.add(r.servicegroupname,
+                            groups[r.servicegroupname].app,
+                            (r.servername, r.port))
+        for r, _, _ in not_added:
+            bound[r.servicegroupname].pop((r.ip, r.port), None)
+        for r, _, _ in not_updated:
+            # still bound at the weight it had
+            key = (r.servername, r.port)
+            previous = groups[r.servicegroupname].existing.get(key)
+            if previous is None:
+                bound[r.servicegroupname].pop(key, None)
+            elif key in bound[r.servicegroupname]:
+                bound[r.servicegroupname][key] = previous
+        failed = set(id(r) for r, _, _ in not_drained)
+        for r in to_drain:
+            key = (r.servername, r.port)
+            if id(r) in failed:
+                bound[r.servicegroupname][key] = groups[
+                    r.servicegroupname].existing.get(key,
+                                                     key + (DEFAULT_WEIGHT,))
+            else:
+                previous = groups[r.servicegroupname].existing.get(key)
+                self.drains.add(r.servicegroupname,
+                                groups[r.servicegroupname].app, key,
+                                weight=previous[2] if previous else None)
+        failed = set(id(r) for r, _, _ in not_removed)
+        for r in to_remove:
+            key = (r.ip, r.port)
+            if id(r) in failed:
+                if key not in self.drains.draining(r.servicegroupname):
+                    bound[r.servicegroupname][key] = groups[
+                        r.servicegroupname].existing.get(
+                            key, key + (DEFAULT_WEIGHT,))
+            else:
+                self.drains.discard(r.servicegroupname, key, drained=True)
+        return dict((name, set(members.values()))
+                    for name, members in bound.items())
+
+    @ns_session_scope
+    def sweep_drains(self, grpnames):
+        """Unbind the members of the service groups that are done
+        draining: out of service on the NetScaler, or draining for longer
+        than drain_timeout. Members that are no longer disabled (or
+        bound) are not tracked any more.
+
+        :returns: number of members unbound
+        """
+        self._local.rejected = []
+        to_remove = []
+        for grpname in grpnames:
+            draining = self.drains.draining(grpname)
+            if not draining:
+                continue
+            current = dict((m[:2], (state, svrstate))
+                           for m, state, svrstate
+                           in self._read_members(grpname))
+            for member in sorted(draining):
+                state, svrstate = current.get(member, (None, None))
+                if state != 'DISABLED':
+                    self.drains.discard(grpname, member)
+                elif svrstate == 'OUT OF SERVICE' or \
+                        self.drains.expired(grpname, member):
+                    logger.info("Unbinding drained %s:%s from service "
+                                "group %s" % (member[0], member[1],
+                                              grpname))
+                    to_remove.append(self._member_binding(grpname, member))
+        failed = set(id(r) for r, _, _ in self._bulk_apply(
+            servicegroup_servicegroupmember_binding, 'delete', to_remove))
+        for r in to_remove:
+            if id(r) not in failed:
+                self.drains.discard(r.servicegroupname, (r.ip, r.port),
+                                    drained=True)
+        self._check_rejected()
+        return len(to_remove) - len(failed)
+
+    def _configure_services(self, grpname, srvrs, existing=None):
+        """Bind srvrs to the service group and unbind everything else.
+
+        :param existing: members known to be bound already; read from the
+            NetScaler if None
+        :returns: set of (ip, port, weight) bound to the service group
+            afterwards
+        :rtype: set
+        """
+        if existing is None:
+            existing = self._get_services(grpname)
+        plan = ChangePlan(self.bulk_batch_size)
+        plan.add(GroupPlan(grpname, grpname, backend_set(srvrs), existing))
+        return self._sync_members(plan)[grpname]
 
     @ns_session_scope
     def configure_lb_frontend(self, lbname, lb_vip, lb_port):
         try:
-            self._create_lb(lbname, "ROUNDROBIN", lb_vip, lb_port)
+            self._create_lb(lbname, lb_vip, lb_port)
         except nitro_exception as ne:
+            if ne.errorcode == NS_SESSION_EXPIRED:
+                raise
             logger.warn("Nitro Exception: %s" % ne.message)
+            if self.raise_errors:
+                raise
         except Exception as e:
             logger.warn("Exception: %s" % e.message)
+            if self.raise_errors:
+                raise
 
     @ns_session_scope
     def configure_lb(self, lbname, lb_vip, lb_ports, srvrs):
+        self.state_cache.invalidate(lbname)
         try:
-            self._create_lb(lbname, "ROUNDROBIN", lb_vip, lb_ports)
+            self._create_lb(lbname, lb_vip, lb_ports)
             self._create_service_group(lbname)  # Reuse lbname
             self._bind_service_group_lb(lbname, lbname)
-            self._configure_services(lbname, srvrs)
+            bound = self._configure_services(lbname, srvrs)
+            self.state_cache.put(lbname, bound, synced=True)
         except nitro_exception as ne:
+            if ne.errorcode == NS_SESSION_EXPIRED:
+                raise
             logger.warn("Nitro Exception: %s" % ne.message)
         except Exception as e:
             logger.warn("Exception: %s" % e.message)
 
-    @ns_session_scope
     def configure_app(self, lbname,  srvrs):
+        """:returns: True if the backends are configured"""
+        srvrs = backend_set(srvrs)
+        if self.state_cache.unchanged(lbname, srvrs):
+            logger.info("Backends for %s are unchanged, skipping" % lbname)
+            return True
+        return self._configure_groups({lbname: (lbname, srvrs)})
+
+    def configure_app_ports(self, appname, port_backends):
+        """Configure the service group of every named port of an app in
+        one pass, sharing the bulk member requests.
+
+        :param dict port_backends: port name -> list of (ip, port) or
+            (ip, port, weight)
+        :returns: True if the backends are configured
+        """
+        groups = {}
+        for port, srvrs in port_backends.items():
+            grpname = port_group_name(appname, port)
+            srvrs = backend_set(srvrs)
+            if self.state_cache.unchanged(grpname, srvrs):
+                logger.info("Backends for %s are unchanged, skipping"
+                            % grpname)
+                continue
+            groups[grpname] = (appname, srvrs)
+        if groups:
+            return self._configure_groups(groups)
+        return True
+
+    @ns_session_scope
+    def _configure_groups(self, groups):
+        """:param dict groups: lbvserver/service group name ->
+            (app, set of (ip, port, weight))
+        :returns: True if every change was applied; without raise_errors
+            failures are logged and False is returned
+        """
+        self._local.rejected = []
         try:
-            self._create_service_group(lbname)  # Reuse lbname
-            self._bind_service_group_lb(lbname, lbname)
-            self._configure_services(lbname, srvrs)
+            plan = ChangePlan(self.bulk_batch_size)
+            self._plan_groups(groups, plan)
+            bound = self._apply_plan(plan)
+            for g in plan:
+                self.state_cache.put(g.name, bound[g.name], synced=g.synced)
+            # the groups are read again when the change is retried
+            return self._check_rejected()
         except nitro_exception as ne:
+            for grpname in groups:
+                self.state_cache.invalidate(grpname)
+            if ne.errorcode == NS_SESSION_EXPIRED:
+                raise
             logger.warn("Nitro Exception: %s" % ne.message)
+            if self.raise_errors:
+                raise
         except Exception as e:
+            for grpname in groups:
+                self.state_cache.invalidate(grpname)
             logger.warn("Exception: %s" % e.message)
+            if self.raise_errors:
+                raise
+        return False
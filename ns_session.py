@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from nssrc.com.citrix.netscaler.nitro.exception.nitro_exception \
+    import nitro_exception
+from nssrc.com.citrix.netscaler.nitro.service.nitro_service\
+    import nitro_service
+
+import metrics
+
+
+logger = logging.getLogger('docker_netscaler')
+
+# NITRO errorcode for "Session expired or killed. Please login again"
+NS_SESSION_EXPIRED = 444
+
+
+class NitroSession(object):
+    """An authenticated nitro_service plus bookkeeping"""
+
+    def __init__(self, service, nsip=None):
+        self.service = service
+        self.nsip = nsip
+        self.created = time.time()
+        self.last_used = self.created
+
+    def age(self):
+        return time.time() - self.created
+
+    def idle(self):
+        return time.time() - self.last_used
+
+
+class NitroSessionPool(object):
+    """Long-lived pool of logged-in NITRO sessions.
+
+    Sessions are handed out to one caller at a time, so the pool size
+    bounds the number of concurrent NITRO conversations. A session that
+    has been idle for close to the NetScaler session timeout is logged in
+    again before it is handed out, and a session that the NetScaler
+    expired anyway is re-authenticated once by `run`.
+    """
+
+    def __init__(self, nsip, nslogin, nspasswd, size=1, timeout=600,
+                 refresh_margin=60, protocol='HTTP'):
+        """Constructor
+
+        :param str nsip: NetScaler management IP
+        :param int size: maximum number of concurrent sessions
+        :param int timeout: NITRO session (idle) timeout in seconds
+        :param int refresh_margin: re-login sessions that have been idle
+            for more than timeout - refresh_margin seconds
+        """
+        self.nsip = nsip
+        self.nslogin = nslogin
+        self.nspasswd = nspasswd
+        self.size = max(1, int(size))
+        self.timeout = int(timeout)
+        self.refresh_margin = int(refresh_margin)
+        self.protocol = protocol
+        self.logins = 0
+        self.logouts = 0
+        self.relogins = 0
+        self._idle = []
+        self._sessions = set()
+        self._pending = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def _login(self):
+        nsip = self.nsip
+        service = nitro_service(nsip, self.protocol)
+        service.set_credential(self.nslogin, self.nspasswd)
+        service.timeout = self.timeout
+        service.login()
+        metrics.NITRO_LOGINS.inc()
+        with self._cond:
+            self.logins += 1
+        logger.debug("Logged in to NetScaler %s (logins=%d)" %
+                     (nsip, self.logins))
+        return NitroSession(service, nsip)
+
+    def _logout(self, session):
+        try:
+            session.service.logout()
+        except Exception as e:
+            logger.debug("Ignoring error on logout from %s: %s" %
+                         (self.nsip, e))
+        with self._cond:
+            self.logouts += 1
+
+    def _is_stale(self, session):
+        return session.idle() >= self.timeout - self.refresh_margin
+
+    def acquire(self):
+        """Take a logged-in session out of the pool, blocking if all
+        sessions are in use"""
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("NITRO session pool for %s is closed"
+                                       % self.nsip)
+                if self._idle:
+                    session = self._idle.pop()
+                    break
+                if len(self._sessions) + self._pending < self.size:
+                    session = None
+                    self._pending += 1
+                    break
+                self._cond.wait()
+        if session is None:
+            try:
+                session = self._login()
+            finally:
+                with self._cond:
+                    self._pending -= 1
+                    if session is not None:
+                        self._sessions.add(session)
+                    self._cond.notify()
+        elif self._is_stale(session):
+            logger.debug("Refreshing NITRO session idle for %ds" %
+                         session.idle())
+            with self._cond:
+                self.relogins += 1
+            session = self.renew(session)
+        return session
+
+    def release(self, session):
+        """Return a session to the pool"""
+        session.last_used = time.time()
+        with self._cond:
+            # sessions to a node the pool no longer uses are dropped
+            closed = self._closed or session.nsip != self.nsip
+            if not closed:
+                self._idle.append(session)
+            else:
+                self._sessions.discard(session)
+            self._cond.notify()
+        if closed:
+            self._logout(session)
+
+    def set_address(self, nsip):
+        """Log in to another NetScaler from now on, e.g., the new primary
+        of an HA pair. Idle sessions are logged out right away, sessions
+        in use when they are released."""
+        with self._cond:
+            if nsip == self.nsip:
+                return
+            self.nsip = nsip
+            idle = self._idle
+            self._idle = []
+            for session in idle:
+                self._sessions.discard(session)
+            self._cond.notify_all()
+        for session in idle:
+            self._logout(session)
+
+    def renew(self, session):
+        """Replace a (possibly expired) session with a fresh login"""
+        with self._cond:
+            self._sessions.discard(session)
+            self._pending += 1
+        self._logout(session)
+        fresh = None
+        try:
+            fresh = self._login()
+        finally:
+            with self._cond:
+                self._pending -= 1
+                if fresh is not None:
+                    self._sessions.add(fresh)
+                self._cond.notify()
+        return fresh
+
+    @contextmanager
+    def session(self):
+        session = self.acquire()
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+    def run(self, func, *args, **kwargs):
+        """Call func(nitro_service, ...) with a pooled session.
+
+        If the NetScaler reports that the session has expired, log in
+        again and retry once.
+        """
+        session = self.acquire()
+        try:
+            try:
+                return func(session.service, *args, **kwargs)
+            except nitro_exception as ne:
+                if ne.errorcode != NS_SESSION_EXPIRED:
+                    raise
+                logger.info("NITRO session to %s expired, logging in again"
+                            % self.nsip)
+                with self._cond:
+                    self.relogins += 1
+                expired, session = session, None
+                session = self.renew(expired)
+                return func(session.service, *args, **kwargs)
+        finally:
+            if session is not None:
+                self.release(session)
+
+    def close(self):
+        """Log out of all idle sessions. Sessions in use are logged out
+        when they are released."""
+        with self._cond:
+            self._closed = True
+            idle = self._idle
+            self._idle = []
+            for session in idle:
+                self._sessions.discard(session)
+            self._cond.notify_all()
+        for session in idle:
+            self._logout(session)
+        logger.info("Closed NITRO sessions to %s: %s" %
+                    (self.nsip, self.stats()))
+
+    def stats(self):
+        with self._cond:
+            ages = [s.age() for s in self._sessions]
+            return {'logins': self.logins,
+                    'relogins': self.relogins,
+                    'logouts': self.logouts,
+                    'sessions': len(self._sessions),
+                    'idle': len(self._idle),
+                    'oldest_session_age': max(ages) if ages else 0,
+                    'newest_session_age': min(ages) if ages else 0}
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+
+class NetscalerSnapshot(object):
+    """The service groups, LB bindings and members of a set of managed
+    service groups, read from the NetScaler in a few bulk requests.
+
+    A snapshot is the baseline for the first diff of each service group
+    after it was read: `take` hands out a group's state once, after which
+    the state cache (or a fresh read) takes over. A snapshot older than
+    `ttl` seconds is not used at all.
+    """
+
+    def __init__(self, names, groups, lb_bindings, members, ttl=300):
+        """Constructor
+
+        :param names: the service group names the snapshot covers
+        :param dict groups: name -> servicegroup of the configured service
+            groups
+        :param lb_bindings: (lbvserver, service group) bindings
+        :param dict members: service group name -> list of
+            ((ip, port), state, svrstate) of its members
+        """
+        self.names = set(names)
+        self.groups = dict((n, g) for n, g in groups.items()
+                           if n in self.names)
+        self.lb_bindings = set(lb_bindings)
+        self.members = members
+        self.ttl = ttl
+        self.loaded = time.time()
+        self._lock = threading.Lock()
+
+    def expired(self):
+        return time.time() - self.loaded >= self.ttl
+
+    def take(self, grpname):
+        """:returns: (exists, bound to its lbvserver, members, servicegroup
+            read) for a service group, or None if the snapshot does not
+            cover it (any more)
+        """
+        with self._lock:
+            if grpname not in self.names or self.expired():
+                return None
+            self.names.discard(grpname)
+            exists = grpname in self.groups
+            return (exists,
+                    exists and (grpname, grpname) in self.lb_bindings,
+                    list(self.members.get(grpname, ())) if exists else [],
+                    self.groups.get(grpname))
+
+    def stats(self):
+        with self._lock:
+            return {'groups': len(self.groups),
+                    'members': sum(len(m) for m in self.members.values()),
+                    'pending': len(self.names)}
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+
+import json
+
+
+DEFAULT_WEIGHT = 1
+
+
+def _member(b):
+    """'ip:port', with the weight of (ip, port, weight) members that have
+    one other than the default"""
+    if len(b) > 2 and b[2] != DEFAULT_WEIGHT:
+        return "%s:%s weight=%d" % b[:3]
+    return "%s:%s" % b[:2]
+
+
+def _parse_member(text, weighted=False):
+    """:param bool weighted: parse into (ip, port, weight) rather than
+        (ip, port)"""
+    address, _, options = text.partition(' ')
+    ip, port = address.rsplit(':', 1)
+    if not weighted:
+        return ip, int(port)
+    options = dict(o.split('=', 1) for o in options.split())
+    return ip, int(port), int(options.get('weight', DEFAULT_WEIGHT))
+
+
+def _requests(count, batch_size):
+    """NITRO requests needed for count bulk operations"""
+    return (count + batch_size - 1) // batch_size
+
+
+class GroupPlan(object):
+    """Changes to one lbvserver/service group pair.
+
+    Desired and bound members are (ip, port, weight); a member is the
+    same member at any weight, so a weight change is an update rather
+    than a remove and an add.
+    """
+
+    def __init__(self, name, app, backends, existing, create_group=False,
+                 bind_lb=False, synced=False, draining=(), drained=(),
+                 drain_delay=0, group_settings=None, update_group=None,
+                 update_lb=None, monitor=None, create_monitor=False,
+                 update_monitor=None, bind_monitor=False):
+        """Constructor
+
+        :param str name: service group (and lbvserver) name
+        :param str app: app the service group belongs to
+        :param backends: desired (ip, port, weight) members
+        :param existing: (ip, port, weight) members bound (and in service)
+            now
+        :param bool create_group: the service group does not exist
+        :param bool bind_lb: the service group is not bound to its lbvserver
+        :param bool synced: existing was read from the NetScaler rather
+            than from the state cache
+        :param draining: members bound but disabled, draining, as
+            (ip, port, weight) or (ip, port) if the weight is not known
+        :param drained: (ip, port) of the draining members that can be
+            unbound now
+        :param int drain_delay: seconds removed members are disabled
+            gracefully for, to drain them, before they are unbound; 0
+            unbinds them right away
+        :param dict group_settings: attributes to create the service group
+            with
+        :param dict update_group: service group attributes that drifted,
+            with their desired values
+        :param dict update_lb: lbvserver attributes that drifted, with
+            their desired values
+        :param dict monitor: attributes of the service group's lbmonitor,
+            None if it has none
+        :param bool create_monitor: the lbmonitor does not exist
+        :param dict update_monitor: lbmonitor attributes that drifted,
+            with their desired values
+        :param bool bind_monitor: the lbmonitor is not bound to the
+            service group
+        """
+        self.name = name
+        self.app = app
+        self.backends = frozenset(backends)
+        desired = dict((b[:2], b) for b in self.backends)
+        existing = dict((b[:2], b) for b in existing)
+        draining = dict((b[:2], b) for b in draining)
+        self.to_add = sorted(b for k, b in desired.items()
+                             if k not in existing and k not in draining)
+        # draining members that are wanted again
+        self.to_enable = sorted(k for k in desired if k in draining)
+        # a draining member whose weight is not known gets the desired
+        # weight when it is enabled again
+        self.to_update = sorted(b for k, b in desired.items()
+                                if existing.get(k, b)[2:] != b[2:] or
+                                draining.get(k, b)[2:] != b[2:])
+        if drain_delay > 0:
+            self.to_drain = sorted(k for k in existing if k not in desired)
+            self.to_remove = sorted(tuple(b[:2]) for b in drained
+                                    if b[:2] not in desired)
+        else:
+            self.to_drain = []
+            self.to_remove = sorted(k for k in set(existing) | set(draining)
+                                    if k not in desired)
+        self.existing = existing
+        self.drain_delay = drain_delay
+        self.group_settings = dict(group_settings or {})
+        self.update_group = dict(update_group or {})
+        self.update_lb = dict(update_lb or {})
+        self.monitor = dict(monitor) if monitor else None
+        self.create_monitor = create_monitor
+        self.update_monitor = dict(update_monitor or {})
+        self.bind_monitor = bind_monitor
+        self.create_group = create_group
+        self.bind_lb = bind_lb
+        self.synced = synced
+
+    def to_dict(self):
+        return {'name': self.name,
+                'app': self.app,
+                'backends': [_member(b) for b in sorted(self.backends)],
+                'create_group': self.create_group,
+                'group_settings': self.group_settings,
+                'update_group': self.update_group,
+                'update_lb': self.update_lb,
+                'monitor': self.monitor,
+                'create_monitor': self.create_monitor,
+                'update_monitor': self.update_monitor,
+                'bind_monitor': self.bind_monitor,
+                'bind_lb': self.bind_lb,
+                'add': [_member(b) for b in self.to_add],
+                'update': [_member(b) for b in self.to_update],
+                'remove': [_member(b) for b in self.to_remove],
+                'drain': [_member(b) for b in self.to_drain],
+                'drain_delay': self.drain_delay,
+                'enable': [_member(b) for b in self.to_enable]}
+
+    @classmethod
+    def from_dict(cls, d):
+        plan = cls(d['name'], d['app'],
+                   [_parse_member(b, True) for b in d['backends']], (),
+                   create_group=d['create_group'], bind_lb=d['bind_lb'],
+                   group_settings=d.get('group_settings'),
+                   update_group=d.get('update_group'),
+                   update_lb=d.get('update_lb'),
+                   monitor=d.get('monitor'),
+                   create_monitor=d.get('create_monitor', False),
+                   update_monitor=d.get('update_monitor'),
+                   bind_monitor=d.get('bind_monitor', False),
+                   drain_delay=d.get('drain_delay', 0))
+        for key, attr, weighted in (('add', 'to_add', True),
+                                    ('update', 'to_update', True),
+                                    ('remove', 'to_remove', False),
+                                    ('drain', 'to_drain', False),
+                                    ('enable', 'to_enable', False)):
+            setattr(plan, attr, [_parse_member(b, weighted)
+                                 for b in d.get(key, [])])
+        return plan
+
+
+class ChangePlan(object):
+    """The NITRO changes that bring a set of apps to their desired
+    backends, computed without applying them.
+
+    A plan can be printed as JSON with per-app operation and request
+    counts, saved, and applied later with NetscalerInterface.apply_plan,
+    which sends each kind of change for all apps in shared bulk requests.
+    """
+
+    def __init__(self, bulk_batch_size=100):
+        self.bulk_batch_size = bulk_batch_size
+        self.groups = {}  # service group name -> GroupPlan
+
+    def add(self, group):
+        self.groups[group.name] = group
+
+    def __iter__(self):
+        return iter([self.groups[name] for name in sorted(self.groups)])
+
+    def _counts(self, groups):
+        ops = {'servicegroups_created':
+               len([g for g in groups if g.create_group]),
+               'servicegroups_updated':
+               len([g for g in groups if g.update_group]),
+               'lbvservers_updated': len([g for g in groups if g.update_lb]),
+               'lb_bindings_added': len([g for g in groups if g.bind_lb]),
+               'monitors_created':
+               len([g for g in groups if g.create_monitor]),
+               'monitors_updated':
+               len([g for g in groups if g.update_monitor]),
+               'monitor_bindings_added':
+               len([g for g in groups if g.bind_monitor]),
+               'members_added': sum(len(g.to_add) for g in groups),
+               'members_updated': sum(len(g.to_update) for g in groups),
+               'members_removed': sum(len(g.to_remove) for g in groups),
+               'members_drained': sum(len(g.to_drain) for g in groups),
+               'members_enabled': sum(len(g.to_enable) for g in groups)}
+        ops['requests'] = sum(_requests(ops[k], self.bulk_batch_size)
+                              for k in sorted(ops))
+        return ops
+
+    def summary(self):
+        """Operation counts and estimated NITRO requests, per app (as if
+        applied alone) and for the whole plan (applied in one batch)
+
+        :rtype: dict
+        """
+        apps = {}
+        for g in self.groups.values():
+            apps.setdefault(g.app, []).append(g)
+        result = self._counts(list(self.groups.values()))
+        result['apps'] = dict((app, self._counts(groups))
+                              for app, groups in apps.items())
+        return result
+
+    def to_dict(self):
+        return {'bulk_batch_size': self.bulk_batch_size,
+                'summary': self.summary(),
+                'groups': [g.to_dict() for g in self]}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    @classmethod
+    def from_dict(cls, d):
+        plan = cls(d.get('bulk_batch_size', 100))
+        for g in d['groups']:
+            plan.add(GroupPlan.from_dict(g))
+        return plan
+
+    @classmethod
+    def from_json(cls, text):
+        return cls.from_dict(json.loads(text))
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+import logging
+import threading
+import time
+
+import metrics
+from workers import KeyedLock
+
+
+logger = logging.getLogger('docker_netscaler')
+
+
+class Reconciler(object):
+    """Configures the NetScaler from a PlatformDriver.
+
+    Every app is configured once from the driver's snapshot, then again
+    each time the driver reports it changed. Changes go through the
+    coalescer and the pool when they are given, so every driver gets the
+    same batching, concurrency and NetScaler state caching. When the
+    NetScaler drains removed members, a sweeper unbinds them once they
+    are drained.
+    """
+
+    def __init__(self, netskaler, pool=None, coalescer=None,
+                 sweep_interval=10):
+        """Constructor
+
+        :param NetscalerInterface netskaler: Netscaler object, or a
+            NetscalerFanout of several
+        :param ReconcilePool pool: configures apps concurrently (optional)
+        :param EventCoalescer coalescer: batches changes per app (optional)
+        :param int sweep_interval: seconds between drain sweeps
+        """
+        self.netskaler = netskaler
+        self.pool = pool
+        self.coalescer = coalescer
+        self.sweep_interval = sweep_interval
+        self.app_locks = KeyedLock()
+
+    def apply(self, appname, backends):
+        """Configure an app with the backends a driver reported
+
+        :returns: True if the NetScaler took the change
+        """
+        lock = self.app_locks(appname)
+        lock.acquire()
+        try:
+            logger.debug("Backends for %s are %s" % (appname, str(backends)))
+            if isinstance(backends, dict):
+                return self.netskaler.configure_app_ports(appname, backends)
+            return self.netskaler.configure_app(appname, backends)
+        finally:
+            lock.release()
+
+    def reconcile(self, driver, appname):
+        """Read the current backends of an app and configure them. The
+        time from the app's change is only measured once the change is
+        applied; a failed attempt leaves it to the next one."""
+        since = driver.take_change_time(appname)
+        try:
+            applied = self.apply(appname, driver.backends(appname))
+        except Exception:
+            driver.restore_change_time(appname, since)
+            raise
+        if not applied:
+            driver.restore_change_time(appname, since)
+        elif since is not None:
+            metrics.RECONCILE_LATENCY.observe(time.time() - since,
+                                              app=appname,
+                                              platform=driver.platform)
+
+    def sweep(self, appname, grpnames):
+        """Unbind the drained members of an app's service groups"""
+        lock = self.app_locks(appname)
+        lock.acquire()
+        try:
+            self.netskaler.sweep_drains(grpnames)
+        finally:
+            lock.release()
+
+    def _sweep_drains(self):
+        while True:
+            time.sleep(self.sweep_interval)
+            for appname, grpnames in sorted(
+                    self.netskaler.draining_apps().items()):
+                if self.pool is not None:
+                    self.pool.submit(appname, self.sweep, appname, grpnames)
+                    continue
+                try:
+                    self.sweep(appname, grpnames)
+                except Exception as e:
+                    logger.error("Drain sweep of %s failed: %s" %
+                                 (appname, e))
+
+    def start_sweeper(self):
+        t = threading.Thread(target=self._sweep_drains, name='DrainSweeper')
+        t.daemon = True
+        t.start()
+
+    def sync(self, driver):
+        """Configure every app from one snapshot of the platform, diffing
+        against one bulk read of the NetScaler"""
+        snapshot = driver.snapshot()
+        logger.info("Configuring for app names: %s" % sorted(snapshot))
+        self.netskaler.load_baseline(snapshot)
+        try:
+            for appname in sorted(snapshot):
+                if self.pool is None:
+                    self.apply(appname, snapshot[appname])
+                else:
+                    self.pool.submit(appname, self.apply, appname,
+                                     snapshot[appname])
+            if self.pool is not None:
+                self.pool.wait()
+        finally:
+            self.netskaler.clear_baseline()
+
+    def run(self, driver):
+        """Sync, then follow the driver's changes until it stops"""
+        self.sync(driver)
+        if self.netskaler.drain_timeout:
+            self.start_sweeper()
+        for appname in driver.stream_changes():
+            if self.coalescer is not None:
+                self.coalescer.submit(appname, self.reconcile, driver,
+                                      appname)
+            elif self.pool is not None:
+                self.pool.submit(appname, self.reconcile, driver, appname)
+            else:
+                try:
+                    self.reconcile(driver, appname)
+                except Exception as e:
+                    logger.error("Reconciliation of %s failed: %s" %
+                                 (appname, e))
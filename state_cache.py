@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+import threading
+import time
+
+
+class AppState(object):
+    """What Nitrox last pushed to the NetScaler for one app"""
+
+    def __init__(self, backends, synced):
+        self.backends = frozenset(backends)
+        # last time the state was read back from the NetScaler
+        self.synced = synced
+
+
+class StateCache(object):
+    """Per-app cache of the backends last configured on the NetScaler.
+
+    An entry is trusted for `ttl` seconds after the app's configuration
+    was last read from the NetScaler; after that the next reconciliation
+    does a full read and resync. A ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._apps = {}
+        self._lock = threading.Lock()
+
+    def get(self, app):
+        """:returns: the AppState for app, or None if unknown or expired"""
+        with self._lock:
+            state = self._apps.get(app)
+            if state is not None and time.time() - state.synced < self.ttl:
+                return state
+            self._apps.pop(app, None)
+            return None
+
+    def unchanged(self, app, backends):
+        """True if backends match what was last pushed for app"""
+        state = self.get(app)
+        with self._lock:
+            if state is not None and state.backends == frozenset(backends):
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def put(self, app, backends, synced=False):
+        """Record backends as configured for app.
+
+        :param bool synced: the NetScaler state was just read back, so the
+            entry's ttl starts again
+        """
+        if not self.ttl:
+            return
+        with self._lock:
+            previous = self._apps.get(app)
+            if synced or previous is None:
+                when = time.time()
+            else:
+                when = previous.synced
+            self._apps[app] = AppState(backends, when)
+
+    def invalidate(self, app=None):
+        with self._lock:
+            if app is None:
+                self._apps.clear()
+            else:
+                self._apps.pop(app, None)
+
+    def stats(self):
+        with self._lock:
+            return {'apps': len(self._apps),
+                    'hits': self.hits,
+                    'misses': self.misses}
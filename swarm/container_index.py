@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+import threading
+
+from driver import backend_weight
+
+
+def container_weight(labels, weight_key):
+    """Weight of a container's backends, from its weight_key label"""
+    return backend_weight((labels or {}).get(weight_key))
+
+
+def listing_backends(container):
+    """(host IP, published port, container port) of a container from a
+    containers() listing
+
+    [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 806,
+      u'PrivatePort': 80}, {u'Type': u'tcp', u'PrivatePort': 443}]
+    """
+    return [(port['IP'], port['PublicPort'], port.get('PrivatePort'))
+            for port in container.get('Ports') or []
+            if port.get('PublicPort')]
+
+
+def inspect_backends(info):
+    """(host IP, published port, container port) of a container from
+    inspect_container()
+
+    {u'NetworkSettings': {u'Ports': {u'80/tcp': [{u'HostIp': u'0.0.0.0',
+                                                   u'HostPort': u'806'}]}},
+     u'Node': {u'IP': u'192.168.99.101', ...}}
+    Swarm adds the 'Node' of the container, whose IP replaces 0.0.0.0.
+    """
+    node_ip = (info.get('Node') or {}).get('IP')
+    result = []
+    ports = (info.get('NetworkSettings') or {}).get('Ports') or {}
+    for private, bindings in ports.items():
+        for b in bindings or []:
+            if not b.get('HostPort'):
+                continue
+            ip = b.get('HostIp') or '0.0.0.0'
+            if ip == '0.0.0.0' and node_ip:
+                ip = node_ip
+            result.append((ip, int(b['HostPort']),
+                           int(private.split('/')[0])))
+    return result
+
+
+class ContainerIndex(object):
+    """Container id -> app, and the published ports of each app's running
+    containers. Loaded from one listing and kept up to date from events,
+    so the backends of an app are known without listing the cluster."""
+
+    def __init__(self, weight_key=None):
+        """Constructor
+
+        :param str weight_key: label holding the weight of a container's
+            backends
+        """
+        self.weight_key = weight_key
+        self.loaded = False
+        self._apps = {}  # container id -> app name, None if not managed
+        # app name -> {container id: [(ip, port, container port, weight)]}
+        self._backends = {}
+        self._lock = threading.Lock()
+
+    def load(self, app_key, appnames, containers):
+        """Replace the index with a containers(all=True) listing"""
+        apps = {}
+        backends = dict((a, {}) for a in appnames)
+        for c in containers:
+            appname = (c.get('Labels') or {}).get(app_key)
+            if appname not in appnames:
+                continue
+            apps[c['Id']] = appname
+            running = c.get('State') == 'running' or \
+                (c.get('Status') or '').startswith('Up')
+            if running:
+                weight = container_weight(c.get('Labels'), self.weight_key)
+                backends[appname][c['Id']] = [
+                    b + (weight,) for b in listing_backends(c)]
+        with self._lock:
+            self._apps = apps
+            self._backends = backends
+            self.loaded = True
+
+    def known(self, c_id):
+        with self._lock:
+            return c_id in self._apps
+
+    def app_of(self, c_id):
+        with self._lock:
+            return self._apps.get(c_id)
+
+    def started(self, c_id, appname, backends, weight=1):
+        """:param backends: list of (ip, port, container port)"""
+        backends = [b + (weight,) for b in backends]
+        with self._lock:
+            self._apps[c_id] = appname
+            if appname is not None:
+                self._backends.setdefault(appname, {})[c_id] = backends
+
+    def stopped(self, c_id):
+        with self._lock:
+            appname = self._apps.get(c_id)
+            if appname is not None:
+                self._backends.get(appname, {}).pop(c_id, None)
+            return appname
+
+    def removed(self, c_id):
+        self.stopped(c_id)
+        with self._lock:
+            self._apps.pop(c_id, None)
+
+    def backends(self, appname, private_port=None):
+        """(host IP, published port, weight) of the running containers of
+        an app
+
+        :param int private_port: only the ports publishing this container
+            port, all published ports if None
+        """
+        with self._lock:
+            return [(ip, public, weight)
+                    for ports in self._backends.get(appname, {}).values()
+                    for ip, public, private, weight in ports
+                    if private_port is None or private == private_port]
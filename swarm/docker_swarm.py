@@ -1,18 +1,27 @@
 #!/usr/bin/env python
 
 import json
-import threading
+import time
+import requests.exceptions
 from docker import Client
+from docker import errors
 from docker import tls
 
+import metrics
+from driver import PlatformDriver
+from container_index import ContainerIndex, container_weight, \
+    inspect_backends, listing_backends
+
 import logging
 logger = logging.getLogger('docker_netscaler')
 
 
-class DockerSwarmInterface:
+class DockerSwarmInterface(PlatformDriver):
+    platform = 'swarm'
 
     def __init__(self, swarm_url, swarm_tls_ca_cert, swarm_tls_cert,
-                 swarm_tls_key, swarm_allow_insecure, app_info, netscaler):
+                 swarm_tls_key, swarm_allow_insecure, app_info):
+        PlatformDriver.__init__(self, app_info)
         tls_config = False
         if not swarm_allow_insecure:
             if swarm_url.startswith("tcp"):
@@ -23,91 +32,156 @@ class DockerSwarmInterface:
                                        verify=swarm_tls_ca_cert,
                                        assert_hostname=False)
         self.client = Client(base_url=swarm_url, tls=tls_config)
-        self.app_info = app_info
-        self.netskaler = netscaler
-        self.lock = threading.Lock()
+        self.app_key = app_info['appkey']
+        # label with the weight of a container's backends
+        self.weight_key = app_info.get('weightkey', 'com.citrix.lb.weight')
+        # container id -> app, and published ports of running containers
+        self.index = ContainerIndex(weight_key=self.weight_key)
 
-    def get_backends_for_app(self, app_label):
+    def get_backends_for_app(self, app_label, private_port=None):
         logger.info("Getting backends for app label %s" % app_label)
         containers = self.client.containers(filters={'status': 'running',
                                                      'label': [app_label]})
-        portConfigs = [n['Ports'] for n in containers]
         """
         [[{u'Type': u'tcp', u'PrivatePort': 443},
           {u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 807, u'PrivatePort': 80}],
           [{u'IP': u'0.0.0.0', u'Type': u'tcp', u'PublicPort': 806, u'PrivatePort': 80},
           {u'Type': u'tcp', u'PrivatePort': 443}]]
         """
-        result = []
-        for ports in portConfigs:
-            for port in ports:
-                if port.get('PublicPort'):
-                    # TODO: handle the case where more than one port is exposed
-                    result.append((port['IP'], port['PublicPort']))
+        return [(ip, public, container_weight(c.get('Labels'),
+                                              self.weight_key))
+                for c in containers
+                for ip, public, private in listing_backends(c)
+                if private_port is None or private == private_port]
+
+    def get_port_backends_for_app(self, appname):
+        """Backends of every port declared for an app, matched on the
+        container port: '{"name": "web", "ports": [{"name": "http",
+        "port": 80}, {"name": "admin", "port": 8081}]}'
 
+        :returns: port name -> list of (host IP, published port, weight)
+        :rtype: dict
+        """
+        result = {}
+        for port in self.ports(appname):
+            if self.index.loaded:
+                result[port['name']] = self.index.backends(appname,
+                                                           port['port'])
+            else:
+                result[port['name']] = self.get_backends_for_app(
+                    self.app_key + "=" + appname, port['port'])
         return result
 
-    def configure_ns_for_app(self, app_key, appname):
-        self.lock.acquire()
+    def backends(self, appname):
+        if self.ports(appname):
+            return self.get_port_backends_for_app(appname)
+        if self.index.loaded:
+            return self.index.backends(appname)
+        # backends = map(lambda y: ("192.168.99.100", y[1]), backends)
+        # TODO: remove above for actual swarm. With plain docker machine,
+        # host IP is "0.0.0.0" -- that cannot be load balanced. Docker
+        # swarm supplies correct host IP.
+        return self.get_backends_for_app(self.app_key + "=" + appname)
+
+    def snapshot(self):
+        """Backends of every app, from one listing of the containers"""
+        self.index_containers(self.app_key, self.appnames)
+        return PlatformDriver.snapshot(self)
+
+    def _inspect(self, c_id):
         try:
-            app_label = app_key + "=" + appname
-            backends = self.get_backends_for_app(app_label)
-            # backends = map(lambda y: ("192.168.99.100", y[1]), backends)
-            # TODO: remove above for actual swarm. With plain docker machine,
-            # host IP is "0.0.0.0" -- that cannot be load balanced. Docker
-            # swarm supplies correct host IP.
-            logger.debug("Backends are %s" % str(backends))
-            self.netskaler.configure_app(appname,  backends)
-        finally:
-            self.lock.release()
-
-    def configure_all(self):
-        app_key = self.app_info['appkey']
-        appnames = map(lambda x: x['name'], self.app_info['apps'])
-        logger.info("Configuring for app names: %s" % str(appnames))
-        for appname in appnames:
-            self.configure_ns_for_app(app_key, appname)
-        self.watch_all_apps()
-        self.wait_for_all()
-
-    def watch_app(self, app_key, appname):
-        app_label = app_key + "=" + appname
-        events = self.client.events(
-            filters={"event": ["start", "kill", "die"],
-                     "label": [app_label]})
-        for e in events:
-            evj = json.loads(e)
-            status = evj['status']
-            c_id = evj['id']
-            if status in ['start', 'die', 'kill']:
-                # TODO: BUG in docker swarm events does not actually apply
-                # filters. Use 'docker ps' to verify the app that is changing
-                # belongs to this thread
-                logger.debug("Event status: %s, id: %.12s" %
-                             (evj['status'], evj['id']))
-                containers = self.client.containers(
-                    all=True,
-                    filters={"label": [app_label]})
-                container_ids = [c.get('Id') for c in containers
-                                 if c.get('Id') == c_id]
-                if container_ids:
-                    logger.info("Configuring NS for app %s, "
-                                "container id=%.12s" % (appname, c_id))
-                    self.configure_ns_for_app(app_key, appname)
-
-    def watch_all_apps(self):
-        app_key = self.app_info['appkey']
-        appnames = map(lambda x: x['name'], self.app_info['apps'])
-        for appname in appnames:
-            logger.debug("Watching for events for app: %s" % str(appname))
-            t = threading.Thread(target=self.watch_app,
-                                 args=(app_key, appname,))
-            t.start()
-
-    def wait_for_all(self):
-        main_thread = threading.currentThread()
-        for t in threading.enumerate():
-            if t is main_thread:
-                continue
-            logging.debug('joining %s', t.getName())
-            t.join()
+            return self.client.inspect_container(c_id)
+        except errors.APIError as e:
+            logger.debug("Cannot inspect container %.12s: %s" % (c_id, e))
+            return None
+
+    def index_containers(self, app_key, appnames):
+        """Rebuild the container index with a single listing"""
+        containers = self.client.containers(all=True,
+                                            filters={'label': [app_key]})
+        self.index.load(app_key, appnames, containers)
+
+    def dispatch_event(self, app_key, appnames, evj):
+        """Apply one container event to the index and reconfigure the app
+        it belongs to. Only containers that have not been seen before, or
+        that (re)start, are inspected."""
+        status = evj.get('status')
+        c_id = evj.get('id')
+        if status not in ['start', 'die', 'kill', 'destroy'] or not c_id:
+            metrics.EVENTS_DROPPED.inc(platform=self.platform)
+            return
+        # TODO: BUG in docker swarm events does not actually apply
+        # filters. Events for containers of other apps (or none) are
+        # dropped here.
+        if status == 'destroy':
+            self.index.removed(c_id)
+            return
+        if status == 'kill':
+            return  # a 'die' follows if the container actually stops
+        known = self.index.known(c_id)
+        appname = self.index.app_of(c_id)
+        attributes = (evj.get('Actor') or {}).get('Attributes')
+        if not known and attributes is not None:
+            label = attributes.get(app_key)
+            if label not in appnames:
+                self.index.started(c_id, None, [])
+                metrics.EVENTS_DROPPED.inc(platform=self.platform)
+                return
+        elif known and appname is None:
+            metrics.EVENTS_DROPPED.inc(platform=self.platform)
+            return
+        if status == 'start':
+            # published ports are only known once the container is started
+            info = self._inspect(c_id)
+            if info is None:
+                return
+            labels = info['Config'].get('Labels') or {}
+            label = labels.get(app_key)
+            appname = label if label in appnames else None
+            self.index.started(c_id, appname,
+                               inspect_backends(info) if appname else [],
+                               container_weight(labels, self.weight_key))
+        elif not known:
+            info = self._inspect(c_id)
+            label = info and (info['Config'].get('Labels') or {}).get(app_key)
+            appname = label if label in appnames else None
+            self.index.started(c_id, appname, [])
+        else:
+            self.index.stopped(c_id)
+        if appname is None:
+            metrics.EVENTS_DROPPED.inc(platform=self.platform)
+            return
+        logger.info("Backends of app %s changed, status=%s "
+                    "container id=%.12s" % (appname, status, c_id))
+        self.changed(appname)
+
+    def watch_events(self, app_key, appnames):
+        """Single event stream for all apps. Reconnects with backoff.
+        Each time the stream is open, the first time included, the
+        containers are listed again and every app is reported, since
+        events may have been missed before the stream started or while
+        it was down."""
+        failures = 0
+        while True:
+            try:
+                events = self.client.events(
+                    filters={"event": ["start", "kill", "die", "destroy"],
+                             "label": [app_key]})
+                # the stream is open: later changes arrive as events
+                self.index_containers(app_key, appnames)
+                self.changed_all()
+                failures = 0
+                for e in events:
+                    self.dispatch_event(app_key, appnames, json.loads(e))
+                logger.warn("Docker event stream closed, reconnecting")
+            except (errors.APIError,
+                    requests.exceptions.RequestException,
+                    ValueError) as e:
+                logger.warn("Docker event stream interrupted: %s" % e)
+            failures += 1
+            metrics.WATCH_RECONNECTS.inc(platform=self.platform)
+            time.sleep(min(30, 2 ** failures))
+
+    def watch(self):
+        logger.debug("Watching for events for apps: %s" % str(self.appnames))
+        self.watch_events(self.app_key, self.appnames)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+
+import collections
+import logging
+import threading
+
+
+logger = logging.getLogger('docker_netscaler')
+
+
+class KeyedLock(object):
+    """One lock per key (e.g., per app), created on first use"""
+
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, key):
+        with self._lock:
+            lock = self._locks.get(key)
+            if lock is None:
+                lock = self._locks[key] = threading.Lock()
+            return lock
+
+
+class ReconcilePool(object):
+    """Bounded pool of threads that reconcile independent apps concurrently.
+
+    Work submitted for the same key (app) runs in submission order and
+    never concurrently; work for different keys runs on up to `size`
+    threads at once.
+    """
+
+    def __init__(self, size=4):
+        self.size = max(1, int(size))
+        self._tasks = {}  # key -> deque of (func, args)
+        self._ready = collections.deque()  # keys with work, not running
+        self._outstanding = 0
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = []
+        for i in range(self.size):
+            t = threading.Thread(target=self._work,
+                                 name='Reconciler-%d' % i)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, func, *args):
+        with self._cond:
+            tasks = self._tasks.get(key)
+            if tasks is None:
+                tasks = self._tasks[key] = collections.deque()
+                self._ready.append(key)
+            tasks.append((func, args))
+            self._outstanding += 1
+            self._cond.notify_all()
+
+    def wait(self):
+        """Block until all submitted work has run"""
+        with self._cond:
+            while self._outstanding:
+                self._cond.wait()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for t in self._threads:
+            t.join()
+
+    def queue_depth(self):
+        with self._cond:
+            return self._outstanding
+
+    def _next(self):
+        with self._cond:
+            while not self._ready and not self._stopped:
+                self._cond.wait()
+            if self._stopped:
+                return None, None, None
+            key = self._ready.popleft()
+            func, args = self._tasks[key].popleft()
+            return key, func, args
+
+    def _done(self, key):
+        with self._cond:
+            if self._tasks[key]:
+                self._ready.append(key)
+            else:
+                del self._tasks[key]
+            self._outstanding -= 1
+            self._cond.notify_all()
+
+    def _work(self):
+        while True:
+            key, func, args = self._next()
+            if key is None:
+                return
+            try:
+                func(*args)
+            except Exception as e:
+                logger.error("Reconciliation of %s failed: %s" % (key, e))
+            finally:
+                self._done(key)